@@ -1,14 +1,34 @@
 #!/usr/bin/python3
 
 import sys
+import os
 import glob
 import json
+import gzip
+import hashlib
+import pickle
+import struct
+import array
+import mmap
+import shutil
+import tempfile
+import functools
 import pprint
 import uuid
+import weakref
+import io
+import contextlib
 import re
 import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from json.encoder import encode_basestring
 from pathlib import Path, PureWindowsPath
 
+import numpy as np
+
+from dbtools.sources import open_source, read_source, source_stat, pack_sources
+
 pp = pprint.PrettyPrinter(indent=4, width=100)
 
 class bcolors:
@@ -22,20 +42,39 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-def create_asset_json(src_dir, dst_dir):
-    data = []
-    # data = {}
+def create_asset_json(src_dir, dst_dir, jobs=None, use_cache=True, ndjson=False, compress=False, index=False, packs=False):
     # can't do keyed objects because there are 60 duplicate asset_names :(
 
-    for file in glob.iglob('./' + str(src_dir) + '/**/*.assets', recursive=True):
-        data = data + parse_assets(file);
-        # data.update(parse_assets(file));
+    # sorted, so the output doesn't depend on directory listing order
+    if packs:
+        # src_dir is a .dbp file or a directory of them, read without unpacking
+        files = pack_sources([src_dir], '.assets')
+    else:
+        files = sorted(glob.iglob('./' + str(src_dir) + '/**/*.assets', recursive=True))
+
+    cache = AssetCache(Path(dst_dir) / '.assets-cache') if use_cache else None
+    out_files = AssetJsonWriter.output_files(dst_dir, ndjson, compress)
+    if index:
+        out_files.append(Path(dst_dir) / 'assets.idx')
+
+    if cache and cache.unchanged(files, out_files):
+        print(f"{len(files)} .assets files unchanged, assets.json is up to date")
+        return
+
+    indexer = AssetIndexWriter(Path(dst_dir) / 'assets.idx') if index else None
+
+    with AssetJsonWriter(dst_dir, ndjson=ndjson, compress=compress) as writer:
+        for file, (assets, lines) in iter_parsed(files, cache, jobs):
+            for asset, line in zip(assets, lines):
+                encoded = writer.write(asset)
+                if indexer:
+                    indexer.add(file, line, asset, encoded)
 
-    with open('./' + str(dst_dir) + '/assets.json', 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    if indexer:
+        indexer.close()
 
-    with open('./' + str(dst_dir) + '/assets.min.json', 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False)
+    if cache:
+        cache.save(files, out_files)
 
     # for a in data:
     #     pp.pprint(a['asset_name'])
@@ -43,54 +82,773 @@ def create_asset_json(src_dir, dst_dir):
     # pp.pprint(data)
     # print(len(data))
 
-def parse_assets(file):
+# Yields (file, (assets, lines)) in the order of files. Cached files are returned
+# directly, everything else is parsed concurrently.
+def iter_parsed(files, cache, jobs):
+    looked_up = {file: cache.lookup(file) for file in files} if cache else {}
+    keys = {file: key for file, (key, _) in looked_up.items()}
+    todo = [file for file in files if keys.get(file) is None]
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        parsed = pool.map(parse_assets_worker, todo, chunksize=8)
+        for file in files:
+            key = keys.get(file)
+            if key is None:
+                _, result, error, output = next(parsed)
+                sys.stdout.write(output)
+            else:
+                result = cache.load(key)
+                if result is None:
+                    # cache entry went missing since lookup()
+                    _, result, error, output = parse_assets_worker(file)
+                    sys.stdout.write(output)
+            if result is None:
+                exit(error)
+            if cache and key is None:
+                cache.put(file, result, looked_up[file][1])
+            yield file, result
+
+# runs in a pool process; parse_assets() exits on fatal syntax errors, which
+# has to be passed back to the main process instead of killing the worker.
+# What the parser prints is passed back as well and printed by the main
+# process, in file order.
+def parse_assets_worker(file):
+    lines = []
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            result = parse_assets(file, lines)
+        return file, (result, lines), 0, output.getvalue()
+    except SystemExit as e:
+        return file, None, e.code or 1, output.getvalue()
+
+# Per-file parse results, stored in <dst>/.assets-cache. A file is looked up
+# by (path, size, mtime) first; if those changed, its content hash decides
+# whether it really needs to be parsed again. Results are stored per content
+# hash, so identical files share one entry.
+class AssetCache:
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index_file = self.path / 'index.json'
+        self.entries = {}
+        self.files = []
+        self.outputs = {}
+
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == self.VERSION:
+                self.entries = index['entries']
+                self.files = index['files']
+                self.outputs = index.get('outputs', {})
+        except (OSError, ValueError, KeyError):
+            pass
+
+    # true if path, size and mtime all match what was cached
+    def fresh(self, file):
+        size, mtime = source_stat(file)
+        entry = self.entries.get(file)
+        return bool(entry) and entry['size'] == size and entry['mtime'] == mtime
+
+    # returns (key, entry): the key of the cached result for file, or None if
+    # it has to be parsed, and the file's size, mtime and hash to pass to
+    # put(), so a changed file is only hashed once
+    def lookup(self, file):
+        if self.fresh(file):
+            entry = self.entries[file]
+            return entry['hash'], entry
+
+        size, mtime = source_stat(file)
+        entry = {'size': size, 'mtime': mtime, 'hash': file_hash(file)}
+        if not self.result_path(entry['hash']).exists():
+            return None, entry
+        self.entries[file] = entry
+        return entry['hash'], entry
+
+    def result_path(self, digest):
+        return self.path / f'{digest}-{self.VERSION}.pickle'
+
+    def put(self, file, result, entry):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.result_path(entry['hash']), 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.entries[file] = entry
+
+    def load(self, digest):
+        try:
+            with open(self.result_path(digest), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    # true if the file set is the same as last time, none of them were touched
+    # and the last run wrote exactly these outputs, which are still as it left
+    # them (outputs of a run with other options may be older than the inputs)
+    def unchanged(self, files, out_files):
+        return (files == self.files and all(self.fresh(f) for f in files)
+                and self.outputs == output_stamps(out_files))
+
+    def save(self, files, out_files):
+        self.files = files
+        self.entries = {f: self.entries[f] for f in files if f in self.entries}
+        self.outputs = output_stamps(out_files)
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.index_file, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION, 'files': self.files, 'entries': self.entries, 'outputs': self.outputs}, f)
+
+# {path: [size, mtime_ns]} of the output files, None for missing ones
+def output_stamps(out_files):
+    stamps = {}
+    for path in out_files:
+        try:
+            st = os.stat(path)
+            stamps[str(path)] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            stamps[str(path)] = None
+    return stamps
+
+def file_hash(file):
+    return hashlib.sha1(read_source(file)).hexdigest()
+
+# Writes assets.json (indent=4) and assets.min.json (json.dump defaults) in one
+# pass, asset by asset. Every string is escaped once and the pretty and
+# minified forms are assembled from the same pieces; the output is identical
+# to what json.dump() writes. Optionally also writes assets.ndjson (one
+# minified asset per line) and gzips all outputs.
+class AssetJsonWriter:
+    INDENT = '    '
+
+    def __init__(self, dst_dir, ndjson=False, compress=False):
+        self.files = self.output_files(dst_dir, ndjson, compress)
+        self.compress = compress
+        self.count = 0
+        self.streams = []
+
+    @staticmethod
+    def output_files(dst_dir, ndjson=False, compress=False):
+        names = ['assets.json', 'assets.min.json']
+        if ndjson:
+            names.append('assets.ndjson')
+        suffix = '.gz' if compress else ''
+        return [Path(dst_dir) / (name + suffix) for name in names]
+
+    def __enter__(self):
+        # written to temporary files first, so a failed run leaves the old output alone
+        for path in self.files:
+            tmp = path.with_name(path.name + '.tmp')
+            if self.compress:
+                stream = gzip.open(tmp, 'wt', compresslevel=6, encoding='utf-8')
+            else:
+                stream = open(tmp, 'w', encoding='utf-8')
+            self.streams.append(stream)
+        self.streams[0].write('[')
+        self.streams[1].write('[')
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.streams[0].write('\n]' if self.count else ']')
+            self.streams[1].write(']')
+        for stream in self.streams:
+            stream.close()
+        for path in self.files:
+            tmp = path.with_name(path.name + '.tmp')
+            if exc_type is None:
+                os.replace(tmp, path)
+            else:
+                os.remove(tmp)
+        return False
+
+    def write(self, asset):
+        pretty, mini = encode_json_pair(asset, 1)
+        if self.count:
+            self.streams[0].write(',\n' + self.INDENT + pretty)
+            self.streams[1].write(', ' + mini)
+        else:
+            self.streams[0].write('\n' + self.INDENT + pretty)
+            self.streams[1].write(mini)
+        if len(self.streams) > 2:
+            self.streams[2].write(mini + '\n')
+        self.count += 1
+        return mini
+
+# Returns (pretty, minified) JSON for o, nested level deep. The parser only
+# produces dicts, lists and strings.
+def encode_json_pair(o, level):
+    if isinstance(o, str):
+        s = encode_basestring(o)
+        return s, s
+
+    if isinstance(o, dict):
+        if not o:
+            return '{}', '{}'
+        pretty = []
+        mini = []
+        for k, v in o.items():
+            key = encode_basestring(k) + ': '
+            p, m = encode_json_pair(v, level + 1)
+            pretty.append(key + p)
+            mini.append(key + m)
+        open_char, close_char = '{', '}'
+
+    elif isinstance(o, list):
+        if not o:
+            return '[]', '[]'
+        pretty = []
+        mini = []
+        for v in o:
+            p, m = encode_json_pair(v, level + 1)
+            pretty.append(p)
+            mini.append(m)
+        open_char, close_char = '[', ']'
+
+    else:
+        s = json.dumps(o)
+        return s, s
+
+    indent = '\n' + AssetJsonWriter.INDENT * (level + 1)
+    return (open_char + indent + (',' + indent).join(pretty) + '\n' + AssetJsonWriter.INDENT * level + close_char,
+            open_char + ', '.join(mini) + close_char)
+
+##############
+# CONDITIONS #
+##############
+
+# dynamic_rule conditions ('if' lines) are small boolean expressions, e.g.
+# 'neighbor_top == empty' or 'side && !top'. compile_condition() parses one into
+# an AST once and caches it per condition string; the compiled condition is
+# evaluated for a whole batch of contexts at once with numpy.
+#
+# Grammar:
+#   expr    := or
+#   or      := and (('||' | 'or') and)*
+#   and     := not (('&&' | 'and') not)*
+#   not     := ('!' | 'not') not | compare
+#   compare := primary (('==' | '=' | '!=' | '<' | '<=' | '>' | '>=') primary)?
+#   primary := NAME | NUMBER | '(' expr ')'
+#
+# A NUMBER may start with '-'. A NAME is looked up in the contexts. Names that
+# aren't a context column compare as the literal word (so 'neighbor_top ==
+# empty' compares against the string 'empty') and are false on their own.
+# Comparing a number with a word is false, whatever the operator.
+CONDITION_TOKEN = re.compile(r'\s*(?:(-?(?:\d+(?:\.\d*)?|\.\d+))|([A-Za-z_][\w.:-]*)|(==|!=|<=|>=|&&|\|\||[<>=!()]))')
+CONDITION_KEYWORDS = {'and': '&&', 'or': '||', 'not': '!'}
+COMPARE_OPS = {
+    '==': np.equal,
+    '=':  np.equal,
+    '!=': np.not_equal,
+    '<':  np.less,
+    '<=': np.less_equal,
+    '>':  np.greater,
+    '>=': np.greater_equal,
+}
+
+def tokenize_condition(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = CONDITION_TOKEN.match(text, pos)
+        if not m:
+            raise ValueError(f"invalid character in condition {text!r} at {pos}")
+        number, name, op = m.groups()
+        if number is not None:
+            tokens.append(('num', float(number)))
+        elif name is not None and name.lower() in CONDITION_KEYWORDS:
+            tokens.append(('op', CONDITION_KEYWORDS[name.lower()]))
+        elif name is not None:
+            tokens.append(('name', name))
+        else:
+            tokens.append(('op', op))
+        pos = m.end()
+    return tokens
+
+class ConditionParser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize_condition(text)
+        self.pos = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError(f"empty condition {self.text!r}")
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise ValueError(f"unexpected {self.tokens[self.pos][1]!r} in condition {self.text!r}")
+        return node
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def accept(self, *ops):
+        kind, value = self.peek()
+        if kind == 'op' and value in ops:
+            self.pos += 1
+            return value
+        return None
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.accept('||'):
+            node = ('or', node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.accept('&&'):
+            node = ('and', node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.accept('!'):
+            return ('not', self.parse_not())
+        return self.parse_compare()
+
+    def parse_compare(self):
+        node = self.parse_primary()
+        op = self.accept(*COMPARE_OPS)
+        if op:
+            node = ('cmp', op, node, self.parse_primary())
+        return node
+
+    def parse_primary(self):
+        kind, value = self.peek()
+        if kind in ('name', 'num'):
+            self.pos += 1
+            return (kind, value)
+        if self.accept('('):
+            node = self.parse_or()
+            if not self.accept(')'):
+                raise ValueError(f"missing ')' in condition {self.text!r}")
+            return node
+        raise ValueError(f"unexpected {'end' if kind is None else repr(value)} in condition {self.text!r}")
+
+# Compiled form of one condition. evaluate() takes a dict of columns (equal
+# length arrays, one per context variable) and returns a bool array.
+class Condition:
+    def __init__(self, text):
+        self.text = text
+        self.ast = ConditionParser(text).parse()
+        self.names = sorted(condition_names(self.ast))
+        self.fn = compile_node(self.ast)
+
+    def __repr__(self):
+        return f'Condition({self.text!r})'
+
+    def evaluate(self, columns, n=None):
+        if n is None:
+            n = len(next(iter(columns.values()))) if columns else 1
+        try:
+            result = truth(self.fn(columns))
+        except TypeError as e:
+            raise ValueError(f"can't evaluate condition {self.text!r}: {e}") from e
+        return np.broadcast_to(result, (n,))
+
+@functools.lru_cache(maxsize=None)
+def compile_condition(text):
+    return Condition(text)
+
+def condition_names(node):
+    if node[0] == 'name':
+        return {node[1]}
+    if node[0] == 'num':
+        return set()
+    return set().union(*(condition_names(child) for child in node[1:] if isinstance(child, tuple)))
+
+def truth(value):
+    # masked entries are contexts that don't have the column: always false
+    if isinstance(value, np.ma.MaskedArray):
+        return truth(value.data) & ~np.ma.getmaskarray(value)
+    if isinstance(value, np.ndarray):
+        if value.dtype == bool:
+            return value
+        if value.dtype.kind in 'US':
+            return value != ''
+        if value.dtype.kind == 'O':
+            return np.array([bool(v) for v in value], dtype=bool)
+        return value != 0
+    # a bare word that isn't a context column
+    if isinstance(value, str):
+        return False
+    return bool(value)
+
+# turns the AST into nested closures, so evaluation doesn't walk tuples
+def compile_node(node):
+    kind = node[0]
+
+    if kind == 'num':
+        value = node[1]
+        return lambda columns: value
+
+    if kind == 'name':
+        name = node[1]
+        return lambda columns: columns.get(name, name)
+
+    if kind == 'not':
+        a = compile_node(node[1])
+        return lambda columns: np.logical_not(truth(a(columns)))
+
+    if kind == 'and':
+        a, b = compile_node(node[1]), compile_node(node[2])
+        return lambda columns: np.logical_and(truth(a(columns)), truth(b(columns)))
+
+    if kind == 'or':
+        a, b = compile_node(node[1]), compile_node(node[2])
+        return lambda columns: np.logical_or(truth(a(columns)), truth(b(columns)))
+
+    op = COMPARE_OPS[node[1]]
+    a, b = compile_node(node[2]), compile_node(node[3])
+    return lambda columns: compare(op, a(columns), b(columns))
+
+def compare(op, a, b):
+    try:
+        return op(a, b)
+    except TypeError:
+        # numbers against strings, numpy has no loop for that
+        return np.zeros(np.broadcast_shapes(np.shape(a), np.shape(b)), dtype=bool)
+
+# Accepts either a dict of columns or a list of dicts (one per context) and
+# returns (columns, count). Columns become numpy arrays. Where some of the
+# dicts lack a key, its column is a masked array (NaN or '' underneath, so
+# numbers stay numbers) and every condition on a missing value is false.
+def context_columns(contexts):
+    if isinstance(contexts, dict):
+        columns = {k: np.asanyarray(v) for k, v in contexts.items()}
+        n = len(next(iter(columns.values()))) if columns else 0
+        return columns, n
+
+    contexts = list(contexts)
+    names = set().union(*(c.keys() for c in contexts)) if contexts else set()
+    columns = {}
+    for name in names:
+        missing = np.array([name not in c for c in contexts], dtype=bool)
+        if not missing.any():
+            columns[name] = np.asarray([c[name] for c in contexts])
+            continue
+        present = [c[name] for c in contexts if name in c]
+        if all(isinstance(v, (bool, int, float, np.number)) for v in present):
+            values = np.asarray([c.get(name, np.nan) for c in contexts], dtype=np.float64)
+        else:
+            values = np.asarray([c.get(name, '') for c in contexts])
+        columns[name] = np.ma.masked_array(values, mask=missing)
+    return columns, len(contexts)
+
+# For every context, the index of the first dynamic_rule of asset whose
+# conditions all hold (a rule without conditions always applies), or -1.
+def resolve_dynamic_rules(asset, contexts):
+    columns, n = context_columns(contexts)
+    chosen = np.full(n, -1, dtype=np.int32)
+    open_ = np.ones(n, dtype=bool)
+
+    for i, rule in enumerate(asset.get('dynamic_rules', [])):
+        mask = open_.copy()
+        for text in rule['conditions']:
+            mask &= compile_condition(text).evaluate(columns, n)
+            if not mask.any():
+                break
+        chosen[mask] = i
+        open_ &= ~mask
+        if not open_.any():
+            break
+
+    return chosen
+
+# The rule each context resolves to, or None where no rule applies.
+def resolve_variants(asset, contexts):
+    rules = asset.get('dynamic_rules', [])
+    return [rules[i] if i >= 0 else None for i in resolve_dynamic_rules(asset, contexts)]
+
+##########
+# INDEX  #
+##########
+
+# assets.idx is a read-only lookup table for the parsed assets. All integers
+# are little endian:
+#
+# header    magic 'DBAI', version, asset/file/term counts, section offsets
+# files     (data offset, length) of every source file path
+# records   per asset: file number, line, (data offset, length) of its minified JSON
+# terms     (hash, data offset, length, first posting, posting count), sorted by hash
+# postings  asset numbers (u32), grouped by term
+# data      utf-8 strings the tables point into
+#
+# Terms are 'name', 'field' (any top level key = value) and 'select'/'pick'
+# (entries of dynamic_rules). Lookups hash the term and binary search the
+# terms table, so nothing is read apart from the pages that are touched.
+INDEX_MAGIC = b'DBAI'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sIIII5Q')
+INDEX_FILE = struct.Struct('<QI')
+INDEX_RECORD = struct.Struct('<IIQI')
+INDEX_TERM = struct.Struct('<QQIII')
+
+def index_term(kind, *parts):
+    return '\0'.join((kind,) + parts)
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def asset_terms(asset):
+    yield index_term('name', asset['asset_name'])
+    for key, value in asset.items():
+        if key != 'asset_name' and isinstance(value, str):
+            yield index_term('field', key, value)
+    for rule in asset['dynamic_rules']:
+        for kind in ('select', 'pick'):
+            for entry in rule.get(kind, []):
+                yield index_term(kind, entry.strip())
+
+class AssetIndexWriter:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp = self.path.with_name(self.path.name + '.tmp')
+        self.data = tempfile.TemporaryFile()
+        self.data_size = 0
+        self.files = {}
+        self.records = []
+        self.postings = {}
+
+    def add_data(self, b):
+        offset = self.data_size
+        self.data.write(b)
+        self.data_size += len(b)
+        return offset, len(b)
+
+    def add(self, file, line, asset, encoded=None):
+        if file not in self.files:
+            self.files[file] = (len(self.files),) + self.add_data(file.encode('utf-8'))
+        file_id = self.files[file][0]
+
+        n = len(self.records)
+        if encoded is None:
+            encoded = json.dumps(asset, ensure_ascii=False)
+        self.records.append((file_id, line) + self.add_data(encoded.encode('utf-8')))
+
+        for term in asset_terms(asset):
+            ids = self.postings.setdefault(term, [])
+            if not ids or ids[-1] != n:
+                ids.append(n)
+
+    def close(self):
+        terms = []
+        postings = array.array('I')
+        for term, ids in self.postings.items():
+            offset, length = self.add_data(term.encode('utf-8'))
+            terms.append((term_hash(term), offset, length, len(postings), len(ids)))
+            postings.extend(ids)
+        terms.sort()
+
+        files_off = INDEX_HEADER.size
+        records_off = files_off + INDEX_FILE.size * len(self.files)
+        terms_off = records_off + INDEX_RECORD.size * len(self.records)
+        postings_off = terms_off + INDEX_TERM.size * len(terms)
+        data_off = postings_off + postings.itemsize * len(postings)
+
+        if sys.byteorder != 'little':
+            postings.byteswap()
+
+        with open(self.tmp, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(self.records), len(self.files), len(terms),
+                                      files_off, records_off, terms_off, postings_off, data_off))
+            f.write(b''.join(INDEX_FILE.pack(*v[1:]) for v in self.files.values()))
+            f.write(b''.join(INDEX_RECORD.pack(*r) for r in self.records))
+            f.write(b''.join(INDEX_TERM.pack(*t) for t in terms))
+            f.write(postings.tobytes())
+            self.data.seek(0)
+            shutil.copyfileobj(self.data, f)
+
+        self.data.close()
+        os.replace(self.tmp, self.path)
+
+# Read side of assets.idx. Results are dicts with the source file, the line the
+# asset starts on and the asset itself, in the same order as in assets.json.
+#
+#   with AssetIndex('assets.idx') as idx:
+#       idx.find('block_stone')            # every asset with that name
+#       idx.where('material', 'stone')     # assets with material = stone
+#       idx.rules_with('block_stone')      # assets whose dynamic_rules select/pick it
+#
+# An index that isn't closed explicitly is closed once nothing references it.
+class AssetIndex:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.finalizer = weakref.finalize(self, self.release, self.mm, self.file)
+
+        (magic, version, self.asset_count, self.file_count, self.term_count,
+         self.files_off, self.records_off, self.terms_off, self.postings_off, self.data_off) = INDEX_HEADER.unpack_from(self.mm, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{path} is not an asset index (version {INDEX_VERSION})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.asset_count
+
+    def close(self):
+        self.finalizer()
+
+    @staticmethod
+    def release(mm, file):
+        mm.close()
+        file.close()
+
+    def string(self, offset, length):
+        start = self.data_off + offset
+        return self.mm[start:start + length].decode('utf-8')
+
+    # asset numbers for a term, empty if it isn't in the index
+    def postings(self, term):
+        h = term_hash(term)
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if INDEX_TERM.unpack_from(self.mm, self.terms_off + mid * INDEX_TERM.size)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # check the term itself, in case two terms share a hash
+        for i in range(lo, self.term_count):
+            th, offset, length, first, count = INDEX_TERM.unpack_from(self.mm, self.terms_off + i * INDEX_TERM.size)
+            if th != h:
+                break
+            if self.string(offset, length) == term:
+                return list(struct.unpack_from(f'<{count}I', self.mm, self.postings_off + first * 4))
+        return []
+
+    def record(self, n):
+        file_id, line, offset, length = INDEX_RECORD.unpack_from(self.mm, self.records_off + n * INDEX_RECORD.size)
+        file_offset, file_length = INDEX_FILE.unpack_from(self.mm, self.files_off + file_id * INDEX_FILE.size)
+        return {
+            'file': self.string(file_offset, file_length),
+            'line': line,
+            'asset': json.loads(self.string(offset, length)),
+        }
+
+    def lookup(self, term):
+        return [self.record(n) for n in self.postings(term)]
+
+    def find(self, name):
+        return self.lookup(index_term('name', name))
+
+    def where(self, key, value):
+        return self.lookup(index_term('field', key, value))
+
+    # kind limits the search to 'select' or 'pick' entries
+    def rules_with(self, name, kind=None):
+        if kind is not None:
+            return self.lookup(index_term(kind, name))
+        ids = sorted(set(self.postings(index_term('select', name))) | set(self.postings(index_term('pick', name))))
+        return [self.record(n) for n in ids]
+
+# Token kinds produced by tokenize_assets()
+ASSET = 'asset'
+DYNAMIC_RULE = 'dynamic_rule'
+OPEN = 'open'
+CLOSE = 'close'
+SKIP = 'skip'
+KEY_VALUE = 'key_value'
+
+# index:  position among the non-blank, non-comment lines (used in messages)
+# lineno: line number in the file
+# text:   the normalised line
+# key/value: first word and the rest of the line (value is None without a space)
+Token = namedtuple('Token', ['kind', 'index', 'lineno', 'text', 'key', 'value'])
+
+MULTI_WHITESPACE = re.compile(' {2,}|\t+')
+REMOVED_CHARS = str.maketrans('', '', '\u00A8\u00A7') # ¨ and §
+
+# Streams the lines of an .assets file and yields one Token per meaningful
+# line. Lines are stripped, blank and comment lines dropped, runs of spaces and
+# tabs collapsed to one space and ¨/§ removed, in a single pass per line.
+def tokenize_assets(lines):
+    index = 0
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('/'):
+            continue
+        if '  ' in line or '\t' in line:
+            line = MULTI_WHITESPACE.sub(' ', line)
+        if '\u00A8' in line or '\u00A7' in line:
+            line = line.translate(REMOVED_CHARS)
+            if not line:
+                continue
+            text = line.strip()
+        else:
+            text = line
+
+        first = text[:1]
+        if first == 'a' and text.startswith('asset'):
+            kind = ASSET
+        elif first == 'd' and text.startswith('dynamic_rule'):
+            kind = DYNAMIC_RULE
+        elif first == '{':
+            kind = OPEN
+        elif first == 'x' and text.startswith('xmin'): # work around syntax error in some files
+            kind = SKIP
+        elif first == '}':
+            kind = CLOSE
+        else:
+            kind = KEY_VALUE
+
+        key, _, value = text.partition(' ')
+        yield Token(kind, index, lineno, text, key, value if _ else None)
+        index += 1
+
+# (previous, current, next) for every token; previous/next are None at the ends
+def with_neighbours(tokens):
+    previous = None
+    current = next(tokens, None)
+    while current is not None:
+        following = next(tokens, None)
+        yield previous, current, following
+        previous = current
+        current = following
+
+# If lines is a list, the line number each returned asset starts on is appended to it.
+def parse_assets(file, lines=None):
     print(f'processing {file} ...')
 
     assets = []
     # assets = {}
     current_asset = None
     current_dynamic_rule = None
+    asset_line = None
+
+    with open_source(file, 'r') as file_object:
+        for previous, token, following in with_neighbours(tokenize_assets(file_object)):
+            i = token.index
+            line = token.text
+            next_line = following.text if following is not None else None
+            previous_line = previous.text if i > 1 else None
 
-    with open(file, 'r') as file_object:
-        lines = list(line.strip() for line in file_object) # all lines
-        lines = list(line for line in lines if line) # filter blank lines
-        lines = list(line for line in lines if not line.startswith('/')) # filter comments
-        lines = list(re.sub(' +', ' ', line) for line in lines) # replace multi whitespaces
-        lines = list(re.sub(' +', ' ', line) for line in lines) # replace multi whitespaces
-        lines = list(re.sub('\t+', ' ', line) for line in lines) # replace tabs
-        lines = list(re.sub('\u00A8', '', line) for line in lines) # remove ¨
-        lines = list(re.sub('\u00A7', '', line) for line in lines) # remove §
-        lines = list(line for line in lines if line) # filter blank lines
-
-        for i, l in enumerate(lines):
-            line = l.strip()
-            next_line = None
-            previous_line = None
-
-            if i+1 < len(lines):
-                next_line = lines[i+1].strip()
-
-            if i > 1:
-                previous_line = lines[i-1].strip()
-
-            if line.startswith('asset'):
+            if token.kind == ASSET:
                 if not next_line.startswith('{'):
                     print(f"{bcolors.FAIL}Error: asset next line is not bracket on line {i} in {file} {bcolors.ENDC}")
                     exit(1)
 
 
-                if len(line.split(' ', 1)) == 1:
+                if token.value is None:
                     print(f"{bcolors.WARNING}WARNING: asset without a name (generated random name) on line {i} {file} {bcolors.ENDC}")
                     name = str(uuid.uuid4())
                 else:
-                    name = line.split(' ', 1)[1]
+                    name = token.value
 
                 current_asset = {
                     'asset_name': name,
                     'dynamic_rules': []
                 }
+                asset_line = token.lineno
 
-            elif line.startswith('dynamic_rule'):
+            elif token.kind == DYNAMIC_RULE:
                 error = 0
 
                 if not next_line.startswith('{'):
@@ -110,7 +868,7 @@ def parse_assets(file):
                         'conditions': []
                     }
 
-            elif line.startswith('{'):
+            elif token.kind == OPEN:
                 if previous_line and ((not previous_line.startswith('asset')) and (not previous_line.startswith('dynamic_rule'))):
                     print(f"{bcolors.WARNING}WARNING: opening bracket without a top level context on line {i} in {file} {bcolors.ENDC}")
                     if current_asset is not None:
@@ -125,6 +883,7 @@ def parse_assets(file):
                             'asset_name': name,
                             'dynamic_rules': []
                         }
+                        asset_line = token.lineno
 
                 if not previous_line and current_asset is None:
                     name = str(uuid.uuid4())
@@ -134,22 +893,24 @@ def parse_assets(file):
                         'asset_name': name,
                         'dynamic_rules': []
                     }
+                    asset_line = token.lineno
 
                 continue
 
-            # work around syntax error in some files
-            elif line.startswith('xmin'):
+            elif token.kind == SKIP:
                 continue
 
-            elif line.startswith('}'):
+            elif token.kind == CLOSE:
                 if current_dynamic_rule is not None:
                     current_asset['dynamic_rules'].append(current_dynamic_rule)
                     current_dynamic_rule = None
                 elif current_asset is not None:
                     assets.append(current_asset)
+                    if lines is not None:
+                        lines.append(asset_line)
                     # assets[current_asset['asset_name']] = current_asset
                     current_asset = None
-                elif i+1 == len(lines):
+                elif following is None:
                     print(f"{bcolors.WARNING}WARNING: couldn't match closing bracket on last line in (ignoring) {file} {bcolors.ENDC}")
                 else:
                     print(f"{bcolors.FAIL}Error: couldn't match closing bracket on line {i} in {file} {bcolors.ENDC}")
@@ -157,26 +918,33 @@ def parse_assets(file):
 
             # any other line apart from the structure ones
             else:
-                key = line.split(' ', 1)[0]
+                key = token.key
 
-                if len(line.split(' ', 1)) == 1:
+                if token.value is None:
                     print(f"{bcolors.WARNING}WARNING: key without a value, ignoring line {i} {file} {bcolors.ENDC}")
                     continue
                 else:
-                    value = line.split(' ', 1)[1]
+                    value = token.value
 
                 if key == 'dynamic_dimensions':
+                    dims = value.split(' ')
                     value = {
-                        'xmin': value.split(' ')[0],
-                        'ymin': value.split(' ')[1],
-                        'zmin': value.split(' ')[2],
-                        'xmax': value.split(' ')[3],
-                        'ymax': value.split(' ')[4],
-                        'zmax': value.split(' ')[5],
+                        'xmin': dims[0],
+                        'ymin': dims[1],
+                        'zmin': dims[2],
+                        'xmax': dims[3],
+                        'ymax': dims[4],
+                        'zmax': dims[5],
                     }
 
                 if current_dynamic_rule is not None:
                     if key == 'if':
+                        # compiled right away, so broken conditions show up
+                        # here and resolving rules later finds them cached
+                        try:
+                            compile_condition(value)
+                        except ValueError as e:
+                            print(f"{bcolors.WARNING}WARNING: invalid condition ({e}) on line {i} {file} {bcolors.ENDC}")
                         current_dynamic_rule['conditions'].append(value)
                     elif key == 'select':
                         current_dynamic_rule['select'] = value.split(',')
@@ -196,6 +964,8 @@ def parse_assets(file):
 
     if current_asset is not None:
         assets.append(current_asset)
+        if lines is not None:
+            lines.append(asset_line)
         # assets[current_asset['asset_name']] = current_asset
         current_asset = None
 
@@ -203,8 +973,14 @@ def parse_assets(file):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='assets-parser.py', description='.assets file parser for Diabotical')
-    parser.add_argument('src_directory', type=Path, help="this directory will be recursively searched for .assets files")
+    parser.add_argument('src_directory', type=Path, help="this directory will be recursively searched for .assets files (with --packs: a .dbp file or a directory of them)")
     parser.add_argument('dest_directory', type=Path, help="put the resulting json into this directory")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of parser processes (default: number of CPUs)")
+    parser.add_argument('--ndjson', action='store_true', help="also write assets.ndjson with one asset per line")
+    parser.add_argument('--gzip', action='store_true', help="gzip all output files")
+    parser.add_argument('--index', action='store_true', help="also write assets.idx for looking up assets by name, field or dynamic_rule select/pick entry")
+    parser.add_argument('--packs', action='store_true', help="read the .assets files straight from the .dbp packs in src_directory instead of unpacked files")
+    parser.add_argument('--no-cache', action='store_true', help="parse every file again instead of reusing results from <dest_directory>/.assets-cache")
 
     if len(sys.argv)==1:
         parser.print_help(sys.stderr)
@@ -212,4 +988,4 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    create_asset_json(args.src_directory, args.dest_directory)
\ No newline at end of file
+    create_asset_json(args.src_directory, args.dest_directory, jobs=args.jobs, use_cache=not args.no_cache, ndjson=args.ndjson, compress=args.gzip, index=args.index, packs=args.packs)
\ No newline at end of file
@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+import sys
+import io
+import json
+import time
+import struct
+import random
+import argparse
+
+import numpy as np
+
+from dbtools.binary import BinaryCursor, BinaryWriter
+
+###################
+# FILE OBJECT API #
+###################
+
+# How the parsers decoded fields before dbtools.binary: one f.read() and one
+# temporary bytes object per field.
+def decodeInt(data):
+    return int.from_bytes(data, byteorder='little', signed=True)
+
+def decodeFloat(data):
+    return struct.unpack('<f', data)[0]
+
+def decodeDouble(data):
+    return struct.unpack('<d', data)[0]
+
+def encodeInt(data, bytes):
+    return data.to_bytes(bytes, byteorder='little', signed=True)
+
+def encodeFloat(data):
+    return struct.pack('<f', data)
+
+def encodeDouble(data):
+    return struct.pack('<d', data)
+
+#########
+# CASES #
+#########
+
+# Every case is (field size in bytes, data generator, file object reader,
+# cursor reader, file object writer, buffer writer). Readers decode n fields
+# from the data and return the last value; writers encode n values.
+
+def int32_data(rng, n):
+    return [rng.randint(-2**31, 2**31 - 1) for _ in range(n)]
+
+def int64_data(rng, n):
+    return [rng.randint(-2**63, 2**63 - 1) for _ in range(n)]
+
+def float_data(rng, n):
+    return [rng.uniform(-1e4, 1e4) for _ in range(n)]
+
+def string_data(rng, n):
+    return [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz_') for _ in range(rng.randint(4, 24))) for _ in range(n)]
+
+# 64 int32 per field, the size of a small block table
+ARRAY_LEN = 64
+
+def array_data(rng, n):
+    return [[rng.randint(-2**31, 2**31 - 1) for _ in range(ARRAY_LEN)] for _ in range(n)]
+
+def old_read(size, decode):
+    def read(data, n):
+        f = io.BytesIO(data)
+        v = None
+        for _ in range(n):
+            v = decode(f.read(size))
+        return v
+    return read
+
+def new_read(method):
+    def read(data, n):
+        f = BinaryCursor(data)
+        fn = getattr(f, method)
+        v = None
+        for _ in range(n):
+            v = fn()
+        return v
+    return read
+
+def old_write(encode):
+    def write(values):
+        f = io.BytesIO()
+        for v in values:
+            f.write(encode(v))
+        return f.getvalue()
+    return write
+
+def new_write(method):
+    def write(values):
+        f = BinaryWriter()
+        fn = getattr(f, method)
+        for v in values:
+            fn(v)
+        return f.getvalue()
+    return write
+
+def old_read_string(data, n):
+    f = io.BytesIO(data)
+    v = None
+    for _ in range(n):
+        length = decodeInt(f.read(4))
+        v = f.read(length).decode('utf-8')
+    return v
+
+def new_read_string(data, n):
+    f = BinaryCursor(data)
+    v = None
+    for _ in range(n):
+        v = f.read_string()
+    return v
+
+def old_write_string(values):
+    f = io.BytesIO()
+    for v in values:
+        data = v.encode('utf-8')
+        f.write(encodeInt(len(data), 4))
+        f.write(data)
+    return f.getvalue()
+
+def new_write_string(values):
+    f = BinaryWriter()
+    for v in values:
+        f.write_string(v)
+    return f.getvalue()
+
+def old_read_array(data, n):
+    f = io.BytesIO(data)
+    v = None
+    for _ in range(n):
+        v = [decodeInt(f.read(4)) for _ in range(ARRAY_LEN)]
+    return v
+
+def new_read_array(data, n):
+    f = BinaryCursor(data)
+    v = None
+    for _ in range(n):
+        v = f.read_array('<i4', ARRAY_LEN)
+    return v
+
+def old_write_array(values):
+    f = io.BytesIO()
+    for arr in values:
+        for v in arr:
+            f.write(encodeInt(v, 4))
+    return f.getvalue()
+
+def new_write_array(values):
+    f = BinaryWriter()
+    for arr in values:
+        f.write_array(arr, '<i4')
+    return f.getvalue()
+
+CASES = {
+    'int32':   (4, int32_data, old_read(4, decodeInt), new_read('i32'), old_write(lambda v: encodeInt(v, 4)), new_write('i32')),
+    'int64':   (8, int64_data, old_read(8, decodeInt), new_read('i64'), old_write(lambda v: encodeInt(v, 8)), new_write('i64')),
+    'float32': (4, float_data, old_read(4, decodeFloat), new_read('f32'), old_write(encodeFloat), new_write('f32')),
+    'float64': (8, float_data, old_read(8, decodeDouble), new_read('f64'), old_write(encodeDouble), new_write('f64')),
+    'string':  (None, string_data, old_read_string, new_read_string, old_write_string, new_write_string),
+    'array':   (ARRAY_LEN * 4, array_data, old_read_array, new_read_array, old_write_array, new_write_array),
+}
+
+#############
+# BENCHMARK #
+#############
+
+def timed(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        t = time.perf_counter() - t0
+        best = t if best is None or t < best else best
+    return best, result
+
+def bench_case(name, count, repeat, seed):
+    size, generate, old_read, new_read, old_write, new_write = CASES[name]
+    values = generate(random.Random(seed), count)
+
+    old_write_s, data = timed(lambda: old_write(values), repeat)
+    new_write_s, new_data = timed(lambda: new_write(values), repeat)
+    old_read_s, old_last = timed(lambda: old_read(data, count), repeat)
+    new_read_s, new_last = timed(lambda: new_read(data, count), repeat)
+
+    if isinstance(new_last, np.ndarray):
+        new_last = new_last.tolist()
+    equal = data == new_data and old_last == new_last
+
+    return {
+        'field': name,
+        'count': count,
+        'bytes': len(data),
+        'old_read_s': old_read_s,
+        'new_read_s': new_read_s,
+        'old_write_s': old_write_s,
+        'new_write_s': new_write_s,
+        'old_read_fields_per_s': count / old_read_s if old_read_s else None,
+        'new_read_fields_per_s': count / new_read_s if new_read_s else None,
+        'read_speedup': old_read_s / new_read_s if new_read_s else None,
+        'write_speedup': old_write_s / new_write_s if new_write_s else None,
+        'equal': equal,
+    }
+
+def print_table(results):
+    cols = ['field', 'count', 'old_read_fields_per_s', 'new_read_fields_per_s', 'read_speedup', 'write_speedup', 'equal']
+    print('\t'.join(cols))
+    for r in results:
+        row = []
+        for c in cols:
+            v = r[c]
+            if isinstance(v, float):
+                v = f'{v:.2f}' if v < 1000 else f'{v:.0f}'
+            row.append(str(v))
+        print('\t'.join(row))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='binary-bench.py', description="per-field micro benchmark of dbtools.binary against file object decoding")
+    parser.add_argument('--fields', nargs='+', choices=list(CASES), default=list(CASES), help="field types to benchmark (default: all)")
+    parser.add_argument('--count', type=int, default=200000, help="fields per run (default: 200000)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best one is reported (default: 3)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    parser.add_argument('--json', type=str, help="also write the results to this JSON file")
+
+    args = parser.parse_args()
+
+    results = [bench_case(name, args.count, args.repeat, args.seed) for name in args.fields]
+
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+
+    if not all(r['equal'] for r in results):
+        print("ERROR: dbtools.binary decoded or encoded at least one field differently")
+        sys.exit(1)
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+
+import sys
+import io
+import os
+import json
+import math
+import time
+import random
+import shutil
+import filecmp
+import fnmatch
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from pathlib import Path, PureWindowsPath
+
+from dbtools import load_script
+
+dbp_packer = load_script('dbp-packer')
+
+ENTRY_COUNTS = [10000, 100000, 1000000]
+SIZE_DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal']
+EXTENSIONS = ['rbe', 'js', 'css', 'png', 'ogg', 'json', 'txt', 'ttf']
+DIR_NAMES = ['maps', 'ui', 'sounds', 'textures', 'models', 'fonts', 'shaders', 'lang']
+ROOT_DIR = 'synthetic'
+STEPS = ['index', 'list', 'unpack', 'unpack_filtered', 'pack']
+
+###################
+# SYNTHETIC PACKS #
+###################
+
+def entry_size(rng, dist, mean_size, max_size):
+    if dist == 'fixed':
+        size = mean_size
+    elif dist == 'uniform':
+        size = rng.randint(0, 2 * mean_size)
+    else:
+        # sigma 1, mu chosen so the distribution has the requested mean
+        size = int(rng.lognormvariate(math.log(max(mean_size, 1)) - 0.5, 1.0))
+    return min(size, max_size)
+
+# (name, data) pairs sorted by name, the order DBPWriter.write packs files in.
+# Names are '<ROOT_DIR>\<depth directories>\fNNNNNNN.<ext>', with 8 possible
+# names per directory level. With probability `duplicates` an entry gets the
+# content of an earlier entry instead of its own. Contents are views into one
+# random buffer, so even a million entries don't need their own memory.
+# Everything is derived from the seed, so the same arguments always produce the
+# same pack.
+def generate_entries(count, seed=0, dist='lognormal', mean_size=512, max_size=1 << 20, depth=3, duplicates=0.1):
+    rng = random.Random(seed)
+    pool = memoryview(rng.randbytes(2 * max_size + 4096))
+
+    entries = []
+    contents = []
+    for i in range(count):
+        if contents and rng.random() < duplicates:
+            data = rng.choice(contents)
+        else:
+            size = entry_size(rng, dist, mean_size, max_size)
+            start = rng.randrange(len(pool) - size)
+            data = pool[start:start + size]
+            contents.append(data)
+
+        dirs = [rng.choice(DIR_NAMES) for _ in range(depth)]
+        name = '\\'.join([ROOT_DIR] + dirs + [f'f{i:07d}.{rng.choice(EXTENSIONS)}'])
+        entries.append((name, data))
+
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+def pack_name(count):
+    return f'synthetic_{count}.dbp'
+
+def generate_pack(path, count, **options):
+    entries = generate_entries(count, **options)
+    dbp_packer.DBPWriter.write_entries(entries, open(path, 'wb'))
+    return path
+
+def generate_corpus(dst, counts, options):
+    dst = Path(dst)
+    os.makedirs(dst, exist_ok=True)
+    packs = []
+    for count in counts:
+        path = generate_pack(dst / pack_name(count), count, **options)
+        print(f"{path}\t{path.stat().st_size}")
+        packs.append(path)
+    return packs
+
+#########
+# STEPS #
+#########
+
+# One operation of dbp-packer, run by `dbp-bench.py step` in its own process
+# so its peak RSS can be measured separately. Returns the entries and bytes
+# handled (the index size for index/list, the data written for unpack and the
+# pack size for pack) and the time the operation took.
+def run_step(step, source, destination=None, pattern=None):
+    t0 = time.perf_counter()
+    if step == 'pack':
+        dbp_packer.DBPWriter.write(source, open(destination, 'wb'))
+        seconds = time.perf_counter() - t0
+        with open(destination, 'rb') as f:
+            entries = dbp_packer.DBPReader.read(f).num_files
+        return entries, os.path.getsize(destination), seconds
+
+    with open(source, 'rb') as f:
+        d = dbp_packer.DBPReader.read(f)
+        if step == 'index':
+            return d.num_files, d.start_offset, time.perf_counter() - t0
+
+        if step == 'list':
+            # like `dbp-packer.py list`
+            for df in d.index:
+                print(Path(PureWindowsPath(df.name)))
+            return d.num_files, d.start_offset, time.perf_counter() - t0
+
+        if step == 'unpack':
+            pattern = None
+        count = dbp_packer.unpack(d, destination, pattern)
+        seconds = time.perf_counter() - t0
+
+    size = sum(df.size for df in d.index
+               if pattern is None or fnmatch.fnmatch(df.name.replace('\\', '/'), pattern))
+    return count, size, seconds
+
+# Peak RSS of this process in MB. VmHWM only covers the running program, while
+# ru_maxrss also counts the parent's memory at the time it forked us.
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        return None
+
+# Runs one step in a fresh interpreter. Output of the step itself goes to
+# /dev/null, the child reports its result on stderr.
+def measure_step(step, source, destination=None, pattern=None, cwd=None):
+    cmd = [sys.executable, str(Path(__file__).resolve()), 'step', step, str(source)]
+    if destination is not None:
+        cmd.append(str(destination))
+    if pattern is not None:
+        cmd += ['--filter', pattern]
+
+    proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"step {step} failed:\n{proc.stderr.decode(errors='replace')}")
+    return json.loads(proc.stderr.decode().splitlines()[-1])
+
+#############
+# BENCHMARK #
+#############
+
+def best(runs):
+    return min(runs, key=lambda r: r['seconds'])
+
+def bench_pack(path, repeat, pattern, tmp_dir):
+    path = Path(path)
+    work = Path(tmp_dir) / path.stem
+    results = []
+
+    def add(step, r):
+        results.append({
+            'pack': path.name,
+            'step': step,
+            'entries': r['entries'],
+            'bytes': r['bytes'],
+            'seconds': r['seconds'],
+            'entries_per_s': r['entries'] / r['seconds'] if r['seconds'] else None,
+            'mb_per_s': r['bytes'] / r['seconds'] / 1e6 if r['seconds'] else None,
+            'peak_rss_mb': r['peak_rss_mb'],
+        })
+
+    for step in ('index', 'list'):
+        add(step, best([measure_step(step, path) for _ in range(repeat)]))
+
+    # every run unpacks into an empty directory (given relative to work, as
+    # `dbp-packer.py unpack` reads the destination as a Windows path); the last
+    # full unpack is kept and packed again for the round trip. Packing '.' from
+    # inside it stores the names without a directory prefix, as in the pack.
+    os.makedirs(work, exist_ok=True)
+    for step, name in (('unpack_filtered', 'filtered'), ('unpack', 'unpacked')):
+        runs = []
+        for _ in range(repeat):
+            if (work / name).exists():
+                shutil.rmtree(work / name)
+            runs.append(measure_step(step, path.resolve(), name, pattern, cwd=work))
+        add(step, best(runs))
+    shutil.rmtree(work / 'filtered')
+
+    repacked = work / path.name
+    runs = [measure_step('pack', '.', repacked.resolve(), cwd=work / 'unpacked') for _ in range(repeat)]
+    add('pack', best(runs))
+
+    equal = filecmp.cmp(path, repacked, shallow=False)
+    for r in results:
+        r['roundtrip_equal'] = equal
+    shutil.rmtree(work)
+    return results
+
+def print_table(results):
+    cols = ['pack', 'step', 'entries', 'seconds', 'entries_per_s', 'mb_per_s', 'peak_rss_mb', 'roundtrip_equal']
+    print('\t'.join(cols))
+    for r in results:
+        row = []
+        for c in cols:
+            v = r[c]
+            if isinstance(v, float):
+                v = f'{v:.4f}' if v < 1000 else f'{v:.0f}'
+            row.append(str(v))
+        print('\t'.join(row))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='dbp-bench.py', description="synthetic .dbp pack generator and dbp-packer benchmark")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_gen = subparsers.add_parser('generate', aliases=['g'], help='write synthetic packs')
+    parser_gen.add_argument('destination', type=str, help="destination directory")
+
+    parser_run = subparsers.add_parser('run', aliases=['r'], help='benchmark dbp-packer on synthetic packs')
+    parser_run.add_argument('packs', nargs='*', default=[], help="existing .dbp files to benchmark instead of generated ones")
+    parser_run.add_argument('--repeat', type=int, default=1, help="runs per step, the fastest one is reported (default: 1)")
+    parser_run.add_argument('--filter', type=str, default='*.rbe', help="glob pattern for the filtered unpack (default: *.rbe)")
+    parser_run.add_argument('--json', type=str, help="also write the results to this JSON file")
+
+    for p in (parser_gen, parser_run):
+        p.add_argument('--entries', type=int, nargs='+', default=ENTRY_COUNTS, help="entries per pack (default: 10000 100000 1000000)")
+        p.add_argument('--size-dist', choices=SIZE_DISTRIBUTIONS, default='lognormal', help="distribution of entry sizes (default: lognormal)")
+        p.add_argument('--mean-size', type=int, default=512, help="mean entry size in bytes (default: 512)")
+        p.add_argument('--max-size', type=int, default=1 << 20, help="largest entry size in bytes (default: 1048576)")
+        p.add_argument('--depth', type=int, default=3, help="directory levels below the pack's root directory (default: 3)")
+        p.add_argument('--duplicates', type=float, default=0.1, help="share of entries that repeat the content of an earlier one (default: 0.1)")
+        p.add_argument('--seed', type=int, default=0, help="random seed")
+
+    # used by `run` to measure one step in its own process
+    parser_step = subparsers.add_parser('step')
+    parser_step.add_argument('step', choices=STEPS)
+    parser_step.add_argument('source')
+    parser_step.add_argument('destination', nargs='?')
+    parser_step.add_argument('--filter', type=str)
+
+    if len(sys.argv)==1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    if args.command == "step":
+        entries, size, seconds = run_step(args.step, args.source, args.destination, args.filter)
+        print(json.dumps({'entries': entries, 'bytes': size, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}), file=sys.stderr)
+        sys.exit(0)
+
+    options = {
+        'seed': args.seed,
+        'dist': args.size_dist,
+        'mean_size': args.mean_size,
+        'max_size': args.max_size,
+        'depth': args.depth,
+        'duplicates': args.duplicates,
+    }
+
+    if args.command.startswith("g"):
+        generate_corpus(args.destination, args.entries, options)
+        print("DONE")
+
+    elif args.command.startswith("r"):
+        results = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            packs = args.packs
+            if not packs:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    packs = generate_corpus(Path(tmp_dir) / 'packs', args.entries, options)
+
+            for path in packs:
+                results.extend(bench_pack(path, args.repeat, args.filter, tmp_dir))
+
+        print_table(results)
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=4)
+
+        if not all(r['roundtrip_equal'] for r in results):
+            print("ERROR: pack -> unpack -> pack changed at least one pack")
+            sys.exit(1)
@@ -1,12 +1,15 @@
 #!/usr/bin/python3
 
-import struct
 import sys
 import os
 import io
+import mmap
+import fnmatch
 import argparse
 from pathlib import Path, PureWindowsPath
 
+from dbtools.binary import BinaryCursor, BinaryWriter
+
 # > Header
 # 4 byte header (DBP1)
 # 4 byte unknown (version?)
@@ -51,29 +54,45 @@ class DBPReader(object):
         dbp = cls()
         dbp.file = file
 
-        magic = file.read(4)
-        if magic != DBPHeader.magic:
-            raise ValueError('Invalid file!')
-
-        # unknown, but appears to be always zero?
-        unk = file.read(4)
-        if unk != DBPHeader.unk:
-            print("Warning: unexpected unk")
-
-        # number of files
-        dbp.num_files = struct.unpack('<I', file.read(4))[0]
-
-        for i in range(dbp.num_files):
-            dbpf = DBPFile()
-            dbpf.name_len = struct.unpack('<I', file.read(4))[0]
-            dbpf.name = file.read(dbpf.name_len).decode('ascii')
-            dbpf.offset = struct.unpack('<I', file.read(4))[0]
-            dbpf.size = struct.unpack('<I', file.read(4))[0]
-            dbp.index.append(dbpf)
-
-        # once all files are read we know the offset from which files are read
-        dbp.start_offset = file.tell()
-        print(dbp.start_offset)
+        # the index is parsed straight from a memory map of the pack (or from
+        # the whole contents for file objects that can't be mapped)
+        mm = None
+        base = file.tell()
+        try:
+            mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            f = BinaryCursor(mm, base)
+            base = 0
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            f = BinaryCursor(file.read())
+
+        try:
+            magic = f.read_bytes(4)
+            if magic != DBPHeader.magic:
+                raise ValueError('Invalid file!')
+
+            # unknown, but appears to be always zero?
+            unk = f.read_bytes(4)
+            if unk != DBPHeader.unk:
+                print("Warning: unexpected unk")
+
+            # number of files
+            dbp.num_files = f.u32()
+
+            for i in range(dbp.num_files):
+                dbpf = DBPFile()
+                dbpf.name_len = f.u32()
+                dbpf.name = f.read_text(dbpf.name_len, 'ascii')
+                dbpf.offset = f.u32()
+                dbpf.size = f.u32()
+                dbp.index.append(dbpf)
+            # once all files are read we know the offset from which files are read
+            dbp.start_offset = base + f.tell()
+        except EOFError:
+            raise ValueError('Invalid file!') from None
+        finally:
+            f.release()
+            if mm is not None:
+                mm.close()
 
         return dbp
 
@@ -85,6 +104,34 @@ class DBPWriter(object):
         self.output_file = None
         self.input_path = None
 
+    # header and index for (name, size) pairs, in pack order; the data of
+    # every entry has to be written right after, in the same order
+    def write_index(self, entries):
+        self.output_file.write(DBPHeader.magic)
+        self.output_file.write(DBPHeader.unk)
+
+        self.num_files = len(entries)
+        index = BinaryWriter()
+        index.u32(self.num_files)
+
+        offset = 0
+        for name, size in entries:
+            dbpFile = DBPFile()
+            dbpFile.name_len = len(name)
+            dbpFile.name = name.encode('ascii')
+            dbpFile.offset = offset
+            dbpFile.size = size
+
+            offset = offset+size
+
+            index.u32(dbpFile.name_len)
+            index.write(dbpFile.name)
+            index.u32(dbpFile.offset)
+            index.u32(dbpFile.size)
+
+        self.output_file.write(index.getbuffer())
+        self.start_offset = 8 + len(index.getbuffer())
+
     @classmethod
     def write(cls, input_path, output_file):
         dbp = cls()
@@ -94,50 +141,63 @@ class DBPWriter(object):
         if dbp.input_path == None:
             raise ValueError('Invalid input path!')
 
-        # write header
-        dbp.output_file.write(DBPHeader.magic)
-        dbp.output_file.write(DBPHeader.unk)
-
-        # number of files
         for file in dbp.input_path.glob('**/*.*'):
             path = str(file).replace("/", "\\")
             dbp.index.append(path)
-
-        dbp.num_files = struct.pack('<I', len(dbp.index))
-        dbp.output_file.write(dbp.num_files)
-
-        # index
         dbp.index = sorted(dbp.index)
-        offset = 0
-        data = bytearray()
 
-        for file in dbp.index:
-            dbpFile = DBPFile()
+        # the index needs every size up front, the files are then copied into
+        # the pack one at a time instead of being collected in memory first
+        local_files = [Path(PureWindowsPath(file)) for file in dbp.index]
+        sizes = [os.path.getsize(local_file) for local_file in local_files]
+        dbp.write_index(list(zip(dbp.index, sizes)))
 
-            local_file = Path(PureWindowsPath(file))
-
-            mf = io.open(local_file, "rb")
-            file_content = mf.read()
-            data = data + file_content
-
-            size = len(file_content)
-
-            dbpFile.name_len = len(file)
-            dbpFile.name = file.encode('ascii')
-            dbpFile.offset = offset
-            dbpFile.size = size
-
-            offset = offset+size
+        # data
+        for local_file, size in zip(local_files, sizes):
+            with io.open(local_file, "rb") as mf:
+                file_content = mf.read()
+            if len(file_content) != size:
+                raise ValueError(f"{local_file} changed while packing")
+            dbp.output_file.write(file_content)
+        dbp.output_file.close()
 
-            dbp.output_file.write(struct.pack('<I', dbpFile.name_len))
-            dbp.output_file.write(dbpFile.name)
-            dbp.output_file.write(struct.pack('<I', dbpFile.offset))
-            dbp.output_file.write(struct.pack('<I', dbpFile.size))
+    # packs (name, bytes) pairs, e.g. files that only exist in memory; names
+    # use backslashes and are stored in the given order
+    @classmethod
+    def write_entries(cls, entries, output_file):
+        dbp = cls()
+        dbp.output_file = output_file
+        dbp.index = [name for name, _ in entries]
+        dbp.write_index([(name, len(data)) for name, data in entries])
 
-        # data
-        dbp.output_file.write(data)
+        for _, data in entries:
+            dbp.output_file.write(data)
         dbp.output_file.close()
 
+# Writes the entries of a pack (only those matching the glob pattern, if one
+# is given) below destination and returns how many were written
+def unpack(dbp, destination, pattern=None, verbose=True):
+    path_prefix = Path(PureWindowsPath(destination))
+    os.makedirs(path_prefix, 0o766, True)
+
+    count = 0
+    made = set()
+    for df in dbp.index:
+        if pattern is not None and not fnmatch.fnmatch(df.name.replace('\\', '/'), pattern):
+            continue
+        path = Path(PureWindowsPath(df.name))
+        full_path = path_prefix.joinpath(path)
+        if verbose:
+            print(f"{path}\t{df.offset:08x}\t{df.size}")
+
+        parent = full_path.parents[0]
+        if parent not in made:
+            os.makedirs(parent, 0o766, True)
+            made.add(parent)
+        with io.open(full_path, "wb") as out:
+            out.write(dbp.read_file(df))
+        count += 1
+    return count
 
 def dir_path(path):
     if os.path.isdir(path):
@@ -156,6 +216,7 @@ if __name__ == '__main__':
     parser_unpack = subparsers.add_parser('unpack', aliases=['u'], help='unpack the .dbp file')
     parser_unpack.add_argument('source', type=argparse.FileType('r'), help="source file")
     parser_unpack.add_argument('destination', type=str, help="destination directory")
+    parser_unpack.add_argument('--filter', type=str, help="only unpack entries matching this glob pattern, e.g. '*.rbe' or 'maps/*'")
 
     parser_pack = subparsers.add_parser('pack', aliases=['p'], help='pack a directory into a .dbp file')
     parser_pack.add_argument('source', type=dir_path, help="source directory")
@@ -172,6 +233,7 @@ if __name__ == '__main__':
         # list
         f = io.open(args.source.name, 'rb')
         d = DBPReader.read(f)
+        print(d.start_offset)
 
         for df in d.index:
             path = Path(PureWindowsPath(df.name))
@@ -179,19 +241,11 @@ if __name__ == '__main__':
 
     elif args.command.startswith("u"):
         # unpack
-        path_prefix = Path(PureWindowsPath(args.destination))
-        os.makedirs(path_prefix, 0o766, True)
-
         f = io.open(args.source.name, 'rb')
         d = DBPReader.read(f)
+        print(d.start_offset)
 
-        for df in d.index:
-            path = Path(PureWindowsPath(df.name))
-            full_path = path_prefix.joinpath(path)
-            print(f"{path}\t{df.offset:08x}\t{df.size}")
-
-            os.makedirs(full_path.parents[0], 0o766, True)
-            io.open(full_path, "wb").write(d.read_file(df))
+        unpack(d, args.destination, args.filter)
         print("DONE")
 
     elif args.command.startswith("p"):
@@ -0,0 +1,24 @@
+# Shared code for the Diabotical tools in the repository root.
+#
+# The tools themselves are standalone scripts with hyphenated names
+# (rbe-parser.py, dbp-packer.py, ...), which can't be imported with a plain
+# `import`. load_script() imports one of them by file name so other tools can
+# reuse its classes without duplicating them.
+
+import importlib.util
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def load_script(name):
+    module_name = name.replace('-', '_')
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    spec = importlib.util.spec_from_file_location(module_name, ROOT / (name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    # registered before executing so pickled objects (process pools) resolve
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,194 @@
+# Little-endian binary reading and writing shared by the parsers.
+#
+# BinaryCursor reads from anything that supports the buffer protocol (bytes,
+# bytearray, mmap, ...) through a memoryview, so read() returns views instead
+# of copies and fixed-width fields are decoded in place with precompiled
+# struct.Struct objects. BinaryWriter is the counterpart that appends to a
+# growable bytearray. Both have tell() so they can stand in for file objects
+# where only the position is needed.
+
+import sys
+import struct
+
+INT8 = struct.Struct('<b')
+UINT8 = struct.Struct('<B')
+INT16 = struct.Struct('<h')
+UINT16 = struct.Struct('<H')
+INT32 = struct.Struct('<i')
+UINT32 = struct.Struct('<I')
+INT64 = struct.Struct('<q')
+UINT64 = struct.Struct('<Q')
+FLOAT32 = struct.Struct('<f')
+FLOAT64 = struct.Struct('<d')
+
+def _reader(st):
+    size = st.size
+    unpack_from = st.unpack_from
+
+    def read(self):
+        try:
+            v, = unpack_from(self.view, self.pos)
+        except struct.error:
+            raise EOFError(f"{size} bytes needed at offset {self.pos}, {len(self.view) - self.pos} left") from None
+        self.pos += size
+        return v
+    return read
+
+def _writer(st):
+    pack = st.pack
+
+    def write(self, v):
+        self.buf += pack(v)
+    return write
+
+class BinaryCursor:
+    def __init__(self, data, offset=0):
+        self.view = memoryview(data).cast('B')
+        self.pos = offset
+
+    def __len__(self):
+        return len(self.view)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def remaining(self):
+        return len(self.view) - self.pos
+
+    # releases the view, needed before e.g. closing an mmap the cursor reads from
+    def release(self):
+        self.view.release()
+
+    i8 = _reader(INT8)
+    u8 = _reader(UINT8)
+    i16 = _reader(INT16)
+    u16 = _reader(UINT16)
+    i32 = _reader(INT32)
+    u32 = _reader(UINT32)
+    i64 = _reader(INT64)
+    u64 = _reader(UINT64)
+    f32 = _reader(FLOAT32)
+    f64 = _reader(FLOAT64)
+
+    # a view of the next n bytes (no copy)
+    def read(self, n):
+        end = self.pos + n
+        if n < 0 or end > len(self.view):
+            raise EOFError(f"{n} bytes needed at offset {self.pos}, {len(self.view) - self.pos} left")
+        v = self.view[self.pos:end]
+        self.pos = end
+        return v
+
+    def read_bytes(self, n):
+        return self.read(n).tobytes()
+
+    def read_rest(self):
+        return self.read(len(self.view) - self.pos)
+
+    # integers of any width, e.g. 6 byte fields
+    def read_int(self, width, signed=True):
+        return int.from_bytes(self.read(width), 'little', signed=signed)
+
+    def read_struct(self, st):
+        try:
+            values = st.unpack_from(self.view, self.pos)
+        except struct.error:
+            raise EOFError(f"{st.size} bytes needed at offset {self.pos}, {len(self.view) - self.pos} left") from None
+        self.pos += st.size
+        return values
+
+    # n bytes decoded as text (bytes.decode is a lot faster than str(memoryview))
+    def read_text(self, n, encoding='utf-8'):
+        return self.read(n).tobytes().decode(encoding)
+
+    # a string preceded by its length in bytes (int32 unless prefix says otherwise)
+    def read_string(self, prefix=INT32, encoding='utf-8'):
+        pos = self.pos
+        try:
+            n, = prefix.unpack_from(self.view, pos)
+        except struct.error:
+            raise EOFError(f"{prefix.size} bytes needed at offset {pos}, {len(self.view) - pos} left") from None
+        start = pos + prefix.size
+        end = start + n
+        if n < 0 or end > len(self.view):
+            raise EOFError(f"{n} bytes needed at offset {start}, {len(self.view) - start} left")
+        self.pos = end
+        return self.view[start:end].tobytes().decode(encoding)
+
+    # Like read_string, but returns (length, text) and decodes every distinct
+    # string only once: strings maps the raw bytes of the strings seen so far
+    # to their (interned) text, so repeated strings share one object.
+    def read_shared_string(self, strings, prefix=INT32, encoding='utf-8'):
+        pos = self.pos
+        view = self.view
+        try:
+            n, = prefix.unpack_from(view, pos)
+        except struct.error:
+            raise EOFError(f"{prefix.size} bytes needed at offset {pos}, {len(view) - pos} left") from None
+        start = pos + prefix.size
+        end = start + n
+        if n < 0 or end > len(view):
+            raise EOFError(f"{n} bytes needed at offset {start}, {len(view) - start} left")
+        self.pos = end
+        raw = view[start:end].tobytes()
+        text = strings.get(raw)
+        if text is None:
+            text = strings[raw] = sys.intern(raw.decode(encoding))
+        return n, text
+
+    # n items of a numpy dtype, as a read-only array over the underlying buffer
+    def read_array(self, dtype, n):
+        import numpy as np
+        dtype = np.dtype(dtype)
+        arr = np.frombuffer(self.read(dtype.itemsize * n), dtype=dtype, count=n)
+        return arr
+
+class BinaryWriter:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def __len__(self):
+        return len(self.buf)
+
+    def tell(self):
+        return len(self.buf)
+
+    def getbuffer(self):
+        return memoryview(self.buf)
+
+    def getvalue(self):
+        return bytes(self.buf)
+
+    i8 = _writer(INT8)
+    u8 = _writer(UINT8)
+    i16 = _writer(INT16)
+    u16 = _writer(UINT16)
+    i32 = _writer(INT32)
+    u32 = _writer(UINT32)
+    i64 = _writer(INT64)
+    u64 = _writer(UINT64)
+    f32 = _writer(FLOAT32)
+    f64 = _writer(FLOAT64)
+
+    def write(self, data):
+        self.buf += data
+        return len(data)
+
+    def write_int(self, v, width, signed=True):
+        self.buf += v.to_bytes(width, 'little', signed=signed)
+
+    def write_struct(self, st, *values):
+        self.buf += st.pack(*values)
+
+    # counterpart of BinaryCursor.read_string()
+    def write_string(self, s, prefix=INT32, encoding='utf-8'):
+        data = s.encode(encoding)
+        self.buf += prefix.pack(len(data))
+        self.buf += data
+
+    def write_array(self, arr, dtype=None):
+        import numpy as np
+        self.buf += np.ascontiguousarray(arr, dtype=dtype).tobytes()
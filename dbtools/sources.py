@@ -0,0 +1,188 @@
+# What the parsers can read from, besides plain file paths:
+#
+#   'pack.dbp::maps\wo_wellspring.rbe'   an entry inside a .dbp pack (either
+#                                        kind of slash works for the entry)
+#   bytes / bytearray / memoryview       a file that is already in memory
+#
+# Pack entries are located with the pack's index and read from an mmap of the
+# pack, so nothing has to be unpacked to disk first. Opened packs are kept
+# open for the lifetime of the process and reopened if the pack changes; the
+# old mapping is closed once nothing uses it any more.
+
+import io
+import argparse
+import mmap
+import os
+from pathlib import PureWindowsPath
+
+from dbtools import load_script
+
+SEPARATOR = '::'
+
+BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+# (pack, entry name) for pack sources, (None, source) for everything else
+def split_source(source):
+    if isinstance(source, str) and SEPARATOR in source:
+        pack, _, name = source.partition(SEPARATOR)
+        return pack, name
+    return None, source
+
+def is_pack_source(source):
+    return split_source(source)[0] is not None
+
+# true for plain file paths, which other files (indexes, ...) can sit next to
+def is_file_source(source):
+    return not isinstance(source, BUFFER_TYPES) and not is_pack_source(source)
+
+def pack_source(pack, name):
+    return f'{pack}{SEPARATOR}{name}'
+
+# entry names are stored with backslashes
+def entry_key(name):
+    return str(PureWindowsPath(name))
+
+class Pack:
+    def __init__(self, path):
+        dbp_packer = load_script('dbp-packer')
+        self.path = path
+        with open(path, 'rb') as f:
+            self.reader = dbp_packer.DBPReader.read(f)
+            st = os.fstat(f.fileno())
+            self.stamp = (st.st_size, st.st_mtime_ns)
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        self.entries = {entry_key(df.name): df for df in self.reader.index}
+
+    def names(self):
+        return [df.name for df in self.reader.index]
+
+    def entry(self, name):
+        df = self.entries.get(entry_key(name))
+        if df is None:
+            raise FileNotFoundError(f"{name} not found in {self.path}")
+        return df
+
+    # the entry's bytes, as a view into the mmap
+    def read(self, name):
+        df = self.entry(name)
+        start = self.reader.start_offset + df.offset
+        return self.view[start:start + df.size]
+
+    # Unmaps the pack now if none of its entries are still in use. Otherwise
+    # the mmap is unmapped together with the last view of it (parsed arrays
+    # can point straight into the pack).
+    def close(self):
+        try:
+            self.view.release()
+            self.mm.close()
+        except BufferError:
+            pass
+
+_packs = {}
+
+def open_pack(path):
+    st = os.stat(path)
+    pack = _packs.get(path)
+    if pack is None or pack.stamp != (st.st_size, st.st_mtime_ns):
+        if pack is not None:
+            pack.close()
+        pack = _packs[path] = Pack(path)
+    return pack
+
+# Read-only, seekable file object over a buffer, without copying it
+class BufferFile(io.RawIOBase):
+    def __init__(self, data):
+        self.view = memoryview(data).cast('B')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self.view) - self.pos)
+        if n <= 0:
+            return 0
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+# A file object for any source; mode is 'rb' or 'r'
+def open_source(source, mode='rb'):
+    if isinstance(source, BUFFER_TYPES):
+        data = source
+    else:
+        pack, name = split_source(source)
+        if pack is None:
+            return open(source, mode)
+        data = open_pack(pack).read(name)
+    f = io.BufferedReader(BufferFile(data))
+    return f if mode == 'rb' else io.TextIOWrapper(f)
+
+# The whole content of a source, as a buffer (a view for pack entries)
+def read_source(source):
+    if isinstance(source, BUFFER_TYPES):
+        return source
+    pack, name = split_source(source)
+    if pack is None:
+        with open(source, 'rb') as f:
+            return f.read()
+    return open_pack(pack).read(name)
+
+# (size, mtime_ns) of a source; pack entries have the mtime of their pack
+def source_stat(source):
+    pack, name = split_source(source)
+    if pack is None:
+        st = os.stat(source)
+        return st.st_size, st.st_mtime_ns
+    p = open_pack(pack)
+    return p.entry(name).size, p.stamp[1]
+
+def source_exists(source):
+    pack, name = split_source(source)
+    if pack is None:
+        return os.path.isfile(source)
+    try:
+        open_pack(pack).entry(name)
+        return True
+    except (OSError, ValueError):
+        return False
+
+# Sources for every entry ending in suffix in the given packs; directories are
+# searched for .dbp files. Sorted by pack, then entry name.
+def pack_sources(paths, suffix=''):
+    packs = []
+    for path in paths:
+        path = str(path)
+        if os.path.isdir(path):
+            packs.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith('.dbp')))
+        else:
+            packs.append(path)
+
+    sources = []
+    for pack in packs:
+        names = open_pack(pack).names()
+        sources.extend(pack_source(pack, name) for name in sorted(names) if name.lower().endswith(suffix.lower()))
+    return sources
+
+# argparse type for source arguments
+def source_arg(source):
+    if source_exists(source):
+        return source
+    raise argparse.ArgumentTypeError(f"can't open '{source}'")
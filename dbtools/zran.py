@@ -0,0 +1,294 @@
+# Random access into gzip streams, after zlib's examples/zran.c.
+#
+# While a gzip stream is inflated once from the start, a checkpoint is taken
+# at a deflate block boundary every `span` bytes of output: the uncompressed
+# and compressed offsets, the bit offset into the compressed byte and the last
+# 32 KiB of output (the window later blocks may refer back to). Reading at any
+# uncompressed offset then starts inflating at the closest checkpoint before
+# it instead of at the beginning of the stream.
+#
+# Python's zlib module doesn't expose Z_BLOCK, inflatePrime() or raw
+# dictionaries for this, so libz is used directly through ctypes.
+
+import bisect
+import ctypes
+import ctypes.util
+import functools
+import os
+import struct
+import zlib
+
+WINDOW_SIZE = 32768
+CHUNK_SIZE = 1 << 16
+DEFAULT_SPAN = 1 << 20
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in',   ctypes.c_void_p),
+        ('avail_in',  ctypes.c_uint),
+        ('total_in',  ctypes.c_ulong),
+        ('next_out',  ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg',       ctypes.c_char_p),
+        ('state',     ctypes.c_void_p),
+        ('zalloc',    ctypes.c_void_p),
+        ('zfree',     ctypes.c_void_p),
+        ('opaque',    ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler',     ctypes.c_ulong),
+        ('reserved',  ctypes.c_ulong),
+    ]
+
+@functools.lru_cache(maxsize=None)
+def libz():
+    path = ctypes.util.find_library('z')
+    if path is None:
+        raise OSError("zlib shared library not found, random access into gzip streams is not available")
+    lib = ctypes.CDLL(path)
+    lib.zlibVersion.restype = ctypes.c_char_p
+    p = ctypes.POINTER(ZStream)
+    lib.inflateInit2_.argtypes = [p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    lib.inflate.argtypes = [p, ctypes.c_int]
+    lib.inflateEnd.argtypes = [p]
+    lib.inflateReset.argtypes = [p]
+    lib.inflateReset2.argtypes = [p, ctypes.c_int]
+    lib.inflatePrime.argtypes = [p, ctypes.c_int, ctypes.c_int]
+    lib.inflateSetDictionary.argtypes = [p, ctypes.c_char_p, ctypes.c_uint]
+    return lib
+
+def available():
+    try:
+        libz()
+        return True
+    except OSError:
+        return False
+
+# Thin wrapper around a z_stream and its input buffer. window_bits follows
+# inflateInit2(): -15 for raw deflate, 31 for gzip, 47 for zlib or gzip.
+class Inflater:
+    def __init__(self, f, window_bits):
+        self.lib = libz()
+        self.f = f
+        self.strm = ZStream()
+        self.input = ctypes.create_string_buffer(CHUNK_SIZE)
+        self.eof = False
+        self.read_total = 0
+        self.check(self.lib.inflateInit2_(ctypes.byref(self.strm), window_bits, self.lib.zlibVersion(), ctypes.sizeof(ZStream)))
+
+    def close(self):
+        self.lib.inflateEnd(ctypes.byref(self.strm))
+
+    def check(self, ret):
+        if ret < 0 and ret != Z_BUF_ERROR:
+            msg = self.strm.msg.decode() if self.strm.msg else f'error {ret}'
+            raise zlib.error(f"inflate failed: {msg}")
+        return ret
+
+    # refills the input buffer once it ran dry, returns False at end of file
+    def fill(self):
+        if self.strm.avail_in:
+            return True
+        data = self.f.read(CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.read_total += len(data)
+        ctypes.memmove(self.input, data, len(data))
+        self.strm.next_in = ctypes.addressof(self.input)
+        self.strm.avail_in = len(data)
+        return True
+
+    # number of input bytes consumed so far
+    def position(self):
+        return self.read_total - self.strm.avail_in
+
+    # gzip files may be padded with zeros after the last member
+    def skip_padding(self):
+        while self.fill():
+            data = ctypes.string_at(self.strm.next_in, self.strm.avail_in)
+            k = len(data) - len(data.lstrip(b'\0'))
+            self.strm.next_in += k
+            self.strm.avail_in -= k
+            if self.strm.avail_in:
+                return True
+        return False
+
+    def skip_input(self, n):
+        while n:
+            if not self.fill():
+                return
+            k = min(n, self.strm.avail_in)
+            self.strm.next_in += k
+            self.strm.avail_in -= k
+            n -= k
+
+    # inflates into out[pos:pos+size], returns (zlib return code, bytes produced, bytes consumed)
+    def inflate(self, out, pos, size, flush=Z_NO_FLUSH):
+        self.strm.next_out = ctypes.addressof(out) + pos
+        self.strm.avail_out = size
+        avail_in = self.strm.avail_in
+        ret = self.check(self.lib.inflate(ctypes.byref(self.strm), flush))
+        return ret, size - self.strm.avail_out, avail_in - self.strm.avail_in
+
+Checkpoint = struct.Struct('<QQB')  # uncompressed offset, compressed offset, bits
+
+class GzipIndex:
+    MAGIC = b'DBZI'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQQQQI')   # magic, version, file size, mtime, stream start, span, count
+
+    def __init__(self, start=0, span=DEFAULT_SPAN):
+        self.start = start      # file offset the gzip stream starts at
+        self.span = span
+        self.outs = []          # uncompressed offsets, ascending
+        self.ins = []           # compressed offsets, relative to start
+        self.bits = []
+        self.windows = []
+
+    def __len__(self):
+        return len(self.outs)
+
+    # Inflates the gzip stream in f from self.start to its end (including any
+    # further gzip members), yielding the output in chunks and recording a
+    # checkpoint every self.span bytes of output.
+    def build(self, f):
+        f.seek(self.start)
+        z = Inflater(f, 47)
+        window = ctypes.create_string_buffer(WINDOW_SIZE)
+        pos = 0
+        total_out = 0
+        last = 0
+        full = False
+        try:
+            # inflate may hold back output when the buffer fills up, so keep
+            # going after that even without new input
+            while z.fill() or full:
+                if pos == WINDOW_SIZE:
+                    pos = 0
+                ret, produced, _ = z.inflate(window, pos, WINDOW_SIZE - pos, Z_BLOCK)
+                full = pos + produced == WINDOW_SIZE
+                if produced:
+                    yield ctypes.string_at(ctypes.addressof(window) + pos, produced)
+                pos += produced
+                total_out += produced
+
+                if ret == Z_STREAM_END:
+                    # another gzip member may follow
+                    if not z.skip_padding():
+                        break
+                    z.check(z.lib.inflateReset(ctypes.byref(z.strm)))
+                    full = False
+                    continue
+
+                data_type = z.strm.data_type
+                if data_type & 128 and not data_type & 64 and total_out - last >= self.span:
+                    self.outs.append(total_out)
+                    self.ins.append(z.position())
+                    self.bits.append(data_type & 7)
+                    if total_out >= WINDOW_SIZE:
+                        self.windows.append(window.raw[pos:] + window.raw[:pos])
+                    else:
+                        self.windows.append(window.raw[:pos])
+                    last = total_out
+        finally:
+            z.close()
+
+    # Yields the uncompressed stream from offset to the end, in chunks.
+    def iter_from(self, f, offset):
+        i = bisect.bisect_right(self.outs, offset) - 1
+        if i < 0:
+            f.seek(self.start)
+            z = Inflater(f, 47)
+            skip = offset
+            raw = False
+        else:
+            bits = self.bits[i]
+            f.seek(self.start + self.ins[i] - (1 if bits else 0))
+            z = Inflater(f, -15)
+            if bits:
+                c = f.read(1)[0]
+                z.check(z.lib.inflatePrime(ctypes.byref(z.strm), bits, c >> (8 - bits)))
+            window = self.windows[i]
+            z.check(z.lib.inflateSetDictionary(ctypes.byref(z.strm), window, len(window)))
+            skip = offset - self.outs[i]
+            raw = True
+
+        out = ctypes.create_string_buffer(CHUNK_SIZE)
+        full = False
+        try:
+            while z.fill() or full:
+                ret, produced, _ = z.inflate(out, 0, CHUNK_SIZE)
+                full = produced == CHUNK_SIZE
+                if produced > skip:
+                    yield ctypes.string_at(ctypes.addressof(out) + skip, produced - skip)
+                    skip = 0
+                else:
+                    skip -= produced
+
+                if ret == Z_STREAM_END:
+                    if raw:
+                        # a raw stream stops before the member's gzip trailer
+                        z.skip_input(8)
+                        z.check(z.lib.inflateReset2(ctypes.byref(z.strm), 31))
+                        raw = False
+                    else:
+                        z.check(z.lib.inflateReset(ctypes.byref(z.strm)))
+                    full = False
+                    if not z.skip_padding():
+                        break
+        finally:
+            z.close()
+
+    def read(self, f, offset, length):
+        parts = []
+        for chunk in self.iter_from(f, offset):
+            parts.append(chunk)
+            length -= len(chunk)
+            if length <= 0:
+                if length < 0:
+                    parts[-1] = parts[-1][:length]
+                break
+        return b''.join(parts)
+
+    # The file is HEADER, the checkpoint table and the zlib compressed windows
+    # (u32 length each). size/mtime tie it to the file the stream is in.
+    def save(self, path, source_file):
+        st = os.stat(source_file)
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, st.st_size, st.st_mtime_ns, self.start, self.span, len(self)))
+            for i in range(len(self)):
+                f.write(Checkpoint.pack(self.outs[i], self.ins[i], self.bits[i]))
+            for window in self.windows:
+                data = zlib.compress(window)
+                f.write(struct.pack('<I', len(data)))
+                f.write(data)
+
+    # returns None if there's no index or source_file changed since it was written
+    @classmethod
+    def load(cls, path, source_file):
+        try:
+            with open(path, 'rb') as f:
+                magic, version, size, mtime, start, span, count = cls.HEADER.unpack(f.read(cls.HEADER.size))
+                st = os.stat(source_file)
+                if magic != cls.MAGIC or version != cls.VERSION or size != st.st_size or mtime != st.st_mtime_ns:
+                    return None
+                index = cls(start, span)
+                for _ in range(count):
+                    out, in_, bits = Checkpoint.unpack(f.read(Checkpoint.size))
+                    index.outs.append(out)
+                    index.ins.append(in_)
+                    index.bits.append(bits)
+                for _ in range(count):
+                    length, = struct.unpack('<I', f.read(4))
+                    index.windows.append(zlib.decompress(f.read(length)))
+                return index
+        except (OSError, struct.error, zlib.error):
+            return None
@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import json
+import hashlib
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from dbtools import load_script
+
+demo_parser = load_script('demo-parser')
+
+SCHEMA_VERSION = 1
+
+# files next to demos that were written by demo-parser itself
+SIDECAR_SUFFIXES = ('.pidx', '.zidx', '.json')
+
+# the first 4 bytes of client and server demos, see Demo.parse_header
+DEMO_FORMATS = (b'EVGR', b'DBSR')
+
+PARSE_ERRORS = (OSError, ValueError, EOFError, demo_parser.zlib.error)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS demos (
+    id              INTEGER PRIMARY KEY,
+    path            TEXT NOT NULL UNIQUE,
+    size            INTEGER NOT NULL,
+    mtime_ns        INTEGER NOT NULL,
+    sha1            TEXT NOT NULL,
+    error           TEXT,
+    format          TEXT,
+    format_version  INTEGER,
+    game_version    TEXT,
+    mode            TEXT,
+    map             TEXT,
+    created_at      TEXT,
+    u1              INTEGER,
+    start_json      TEXT,
+    end_json        TEXT
+);
+CREATE TABLE IF NOT EXISTS players (
+    demo_id         INTEGER NOT NULL REFERENCES demos(id) ON DELETE CASCADE,
+    idx             INTEGER NOT NULL,
+    name            TEXT,
+    user_id         TEXT,
+    p_u1            INTEGER,
+    p_u2            INTEGER,
+    p_u3            INTEGER
+);
+CREATE TABLE IF NOT EXISTS reconnects (
+    demo_id         INTEGER NOT NULL REFERENCES demos(id) ON DELETE CASCADE,
+    idx             INTEGER NOT NULL,
+    user_id         TEXT,
+    r_u1            INTEGER,
+    r_u2            INTEGER
+);
+CREATE TABLE IF NOT EXISTS stats (
+    demo_id         INTEGER NOT NULL REFERENCES demos(id) ON DELETE CASCADE,
+    source          TEXT NOT NULL,
+    path            TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS demos_map ON demos(map);
+CREATE INDEX IF NOT EXISTS demos_mode ON demos(mode);
+CREATE INDEX IF NOT EXISTS demos_sha1 ON demos(sha1);
+CREATE INDEX IF NOT EXISTS players_user_id ON players(user_id);
+CREATE INDEX IF NOT EXISTS players_name ON players(name);
+CREATE INDEX IF NOT EXISTS players_demo ON players(demo_id);
+CREATE INDEX IF NOT EXISTS reconnects_user_id ON reconnects(user_id);
+CREATE INDEX IF NOT EXISTS reconnects_demo ON reconnects(demo_id);
+CREATE INDEX IF NOT EXISTS stats_path_value ON stats(path, value);
+CREATE INDEX IF NOT EXISTS stats_demo ON stats(demo_id);
+'''
+
+def open_db(path):
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA foreign_keys = ON')
+    db.execute('PRAGMA journal_mode = WAL')
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    if version not in (0, SCHEMA_VERSION):
+        print(f"ERROR: {path} was created by a different version of demo-indexer")
+        sys.exit(1)
+    db.executescript(SCHEMA)
+    db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    return db
+
+def is_demo(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(4) in DEMO_FORMATS
+    except OSError:
+        return False
+
+# Files given directly are always taken, in directories only the files that
+# start like a demo
+def find_demos(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file = os.path.join(root, name)
+                    if not name.endswith(SIDECAR_SUFFIXES) and is_demo(file):
+                        yield file
+        else:
+            yield path
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Hashes a file as it's read through it. Demo.read_header reads ahead and
+# seeks back, so only bytes that weren't hashed yet are added.
+class HashingReader:
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+        self.hashed = 0
+
+    def read(self, size=-1):
+        pos = self.f.tell()
+        data = self.f.read(size)
+        if pos <= self.hashed < pos + len(data):
+            self.sha1.update(memoryview(data)[self.hashed - pos:])
+            self.hashed = pos + len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        return self.f.seek(pos, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    # also hashes whatever the parser didn't read
+    def hexdigest(self):
+        self.f.seek(self.hashed)
+        while self.read(1 << 20):
+            pass
+        return self.sha1.hexdigest()
+
+# Parses the demo file at path into demo and returns (sha1, error), reading
+# the file only once
+def parse_hashed(demo, path):
+    with open(path, 'rb') as f:
+        reader = HashingReader(f)
+        error = None
+        try:
+            demo.parse_file(reader)
+        except PARSE_ERRORS as e:
+            error = str(e) or type(e).__name__
+        return reader.hexdigest(), error
+
+# Scalar leaves of a JSON document as (path, value), e.g. ('teams[0].score', 3)
+def flatten(value, path=''):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            yield from flatten(v, f'{path}.{k}' if path else str(k))
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            yield from flatten(v, f'{path}[{i}]')
+    else:
+        yield path, value
+
+# runs in a pool process
+def parse_demo(job):
+    path, size, mtime_ns = job
+    d = demo_parser.Demo()
+    sha1, error = parse_hashed(d, path)
+    row = {'path': path, 'size': size, 'mtime_ns': mtime_ns, 'sha1': sha1, 'error': error}
+    if error:
+        return row, [], [], []
+
+    for key in ('format', 'format_version', 'game_version', 'mode', 'map', 'u1'):
+        row[key] = getattr(d, key, None)
+    row['created_at'] = d.created_at.isoformat() if hasattr(d, 'created_at') else None
+
+    stats = []
+    for source in ('start_json', 'end_json'):
+        payload = getattr(d, source, None)
+        row[source] = json.dumps(payload, ensure_ascii=False) if payload is not None else None
+        if payload is not None:
+            stats.extend((source[:-5], p, v if not isinstance(v, bool) else int(v)) for p, v in flatten(payload))
+
+    players = [(i, p['name'], p['user_id'], p['p_u1'], p['p_u2'], p['p_u3']) for i, p in enumerate(getattr(d, 'players', []))]
+    reconnects = [(i, r['user_id'], r['r_u1'], r['r_u2']) for i, r in enumerate(getattr(d, 'reconnects', []))]
+    return row, players, reconnects, stats
+
+DEMO_COLUMNS = ['path', 'size', 'mtime_ns', 'sha1', 'error', 'format', 'format_version', 'game_version',
+                'mode', 'map', 'created_at', 'u1', 'start_json', 'end_json']
+
+def store(db, row, players, reconnects, stats):
+    db.execute('DELETE FROM demos WHERE path = ?', (row['path'],))
+    cur = db.execute(f'INSERT INTO demos ({", ".join(DEMO_COLUMNS)}) VALUES ({", ".join("?" * len(DEMO_COLUMNS))})',
+                     [row.get(c) for c in DEMO_COLUMNS])
+    demo_id = cur.lastrowid
+    db.executemany('INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, ?)', [(demo_id,) + p for p in players])
+    db.executemany('INSERT INTO reconnects VALUES (?, ?, ?, ?, ?)', [(demo_id,) + r for r in reconnects])
+    db.executemany('INSERT INTO stats VALUES (?, ?, ?, ?)', [(demo_id,) + s for s in stats])
+
+# Adds new and changed demos to the database. A demo whose size and mtime
+# didn't change is skipped without reading it; if they changed but the
+# content hash didn't, only the stored size/mtime are updated.
+def index_demos(db, paths, jobs=None, prune=False):
+    known = {path: (size, mtime_ns, sha1) for path, size, mtime_ns, sha1 in db.execute('SELECT path, size, mtime_ns, sha1 FROM demos')}
+
+    seen = set()
+    todo = []
+    touched = 0
+    for path in find_demos(paths):
+        path = os.path.abspath(path)
+        seen.add(path)
+        st = os.stat(path)
+        entry = known.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            continue
+        if entry and entry[0] == st.st_size and file_hash(path) == entry[2]:
+            db.execute('UPDATE demos SET mtime_ns = ? WHERE path = ?', (st.st_mtime_ns, path))
+            touched += 1
+            continue
+        todo.append((path, st.st_size, st.st_mtime_ns))
+
+    errors = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for i, (row, players, reconnects, stats) in enumerate(pool.map(parse_demo, todo, chunksize=4), 1):
+            store(db, row, players, reconnects, stats)
+            if row['error']:
+                errors += 1
+                print(f"WARNING: {row['path']}: {row['error']}", file=sys.stderr)
+            if i % 1000 == 0:
+                db.commit()
+                print(f"{i}/{len(todo)} demos indexed")
+
+    pruned = 0
+    if prune:
+        gone = [(path,) for path in known if path not in seen]
+        db.executemany('DELETE FROM demos WHERE path = ?', gone)
+        pruned = len(gone)
+
+    db.commit()
+    print(f"{len(todo)} indexed ({errors} failed), {touched} touched, {len(seen) - len(todo) - touched} unchanged, {pruned} removed")
+
+# Demos matching all given filters, newest first
+def query_demos(db, user_id=None, player=None, map=None, mode=None, stats=(), limit=100):
+    where = ['d.error IS NULL']
+    params = []
+    if user_id:
+        where.append('(d.id IN (SELECT demo_id FROM players WHERE user_id = ?) OR d.id IN (SELECT demo_id FROM reconnects WHERE user_id = ?))')
+        params += [user_id, user_id]
+    if player:
+        where.append('d.id IN (SELECT demo_id FROM players WHERE name = ?)')
+        params.append(player)
+    if map:
+        where.append('d.map = ?')
+        params.append(map)
+    if mode:
+        where.append('d.mode = ?')
+        params.append(mode)
+    for path, value in stats:
+        where.append('d.id IN (SELECT demo_id FROM stats WHERE path = ? AND value = ?)')
+        params += [path, value]
+
+    sql = f'SELECT d.* FROM demos d WHERE {" AND ".join(where)} ORDER BY d.created_at DESC, d.path LIMIT ?'
+    params.append(limit)
+
+    cur = db.execute(sql, params)
+    names = [c[0] for c in cur.description]
+    results = []
+    for values in cur.fetchall():
+        r = dict(zip(names, values))
+        r['players'] = [dict(zip(('name', 'user_id'), p)) for p in
+                        db.execute('SELECT name, user_id FROM players WHERE demo_id = ? ORDER BY idx', (r['id'],))]
+        for key in ('start_json', 'end_json'):
+            r[key] = json.loads(r[key]) if r[key] is not None else None
+        results.append(r)
+    return results
+
+# 'teams[0].score=3' -> ('teams[0].score', 3); values that parse as JSON are compared as such
+def stat_filter(s):
+    path, sep, value = s.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected PATH=VALUE, got '{s}'")
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return path, value
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='demo-indexer.py', description="index Diabotical demos into a SQLite database")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_index = subparsers.add_parser('index', aliases=['i'], help='add new and changed demos to the database')
+    parser_index.add_argument('database', type=str, help="SQLite database file, created if it doesn't exist")
+    parser_index.add_argument('demos', nargs='+', help="demo files or directories to search for demos")
+    parser_index.add_argument('--jobs', type=int, default=None, help="number of parser processes (default: number of CPUs)")
+    parser_index.add_argument('--prune', action='store_true', help="remove demos from the database that weren't found this time")
+
+    parser_query = subparsers.add_parser('query', aliases=['q'], help='search the database, prints one JSON object per demo')
+    parser_query.add_argument('database', type=str, help="SQLite database file")
+    parser_query.add_argument('--user-id', type=str, help="demos with this player user_id (including reconnects)")
+    parser_query.add_argument('--player', type=str, help="demos with a player of this name")
+    parser_query.add_argument('--map', type=str, help="demos on this map")
+    parser_query.add_argument('--mode', type=str, help="demos of this game mode")
+    parser_query.add_argument('--stat', type=stat_filter, action='append', default=[], metavar='PATH=VALUE', help="demos with this value in start_json/end_json, e.g. winner=p1 (repeatable)")
+    parser_query.add_argument('--limit', type=int, default=100, help="maximum number of results (default: 100)")
+
+    if len(sys.argv)==1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    if args.command.startswith("i"):
+        db = open_db(args.database)
+        index_demos(db, args.demos, args.jobs, args.prune)
+        db.close()
+
+    elif args.command.startswith("q"):
+        if not Path(args.database).exists():
+            print(f"ERROR: {args.database} doesn't exist")
+            sys.exit(1)
+        db = open_db(args.database)
+        for r in query_demos(db, args.user_id, args.player, args.map, args.mode, args.stat, args.limit):
+            print(json.dumps(r, ensure_ascii=False))
+        db.close()
@@ -5,27 +5,41 @@ import gzip
 import json
 import pprint
 import re
-import io
+import zlib
+import os
+import struct
+import array
 import argparse
-from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PureWindowsPath
 from datetime import datetime
 
+from dbtools import zran
+from dbtools.binary import BinaryCursor, INT32
+from dbtools.sources import open_source, source_exists, is_file_source
+
 pp = pprint.PrettyPrinter(indent=4, width=10)
 
+HEADER_READ_SIZE = 1 << 16
+
+class DemoFormatError(ValueError):
+  pass
+
 class Demo:
   def parse_server_demo_header(self, f):
-    self.u1               = decodeInt(f.read(8))
+    self.u1               = f.i64()
 
-    player_count          = decodeInt(f.read(4))
+    player_count          = f.i32()
     self.players          = []
     for i in range(player_count):
-        name_len          = decodeInt(f.read(4))
-        name              = f.read(name_len).decode("utf-8")
-        user_id_len       = decodeInt(f.read(4))
-        user_id           = f.read(user_id_len).decode("utf-8")
-        p_u1              = decodeInt(f.read(4))
-        p_u2              = decodeInt(f.read(4))
-        p_u3              = decodeInt(f.read(4))
+        name_len          = f.i32()
+        name              = f.read_text(name_len)
+        user_id_len       = f.i32()
+        user_id           = f.read_text(user_id_len)
+        p_u1              = f.i32()
+        p_u2              = f.i32()
+        p_u3              = f.i32()
 
         p = {
             'name': name,
@@ -36,13 +50,13 @@ class Demo:
         }
         self.players.append(p)
 
-    reconnect_count       = decodeInt(f.read(4))
+    reconnect_count       = f.i32()
     self.reconnects       = []
     for i in range(reconnect_count):
-        user_id_len       = decodeInt(f.read(4))
-        user_id           = f.read(user_id_len).decode("utf-8")
-        r_u1              = decodeInt(f.read(4))
-        r_u2              = decodeInt(f.read(4))
+        user_id_len       = f.i32()
+        user_id           = f.read_text(user_id_len)
+        r_u1              = f.i32()
+        r_u2              = f.i32()
 
         r = {
             'user_id': user_id,
@@ -53,70 +67,357 @@ class Demo:
 
 
   def parse_client_demo_header(self, f):
-    self.created_at       = decodeEpoch(f.read(4))
-    padding               = decodeInt(f.read(16))
+    self.created_at       = datetime.fromtimestamp(f.i32())
+    padding               = f.read_int(16)
+
+  # f is a BinaryCursor over the start of the demo file
+  def parse_header(self, f):
+    self.format           = f.read_text(4)
+    self.format_version   = f.i32()
+    game_version_len      = f.i32()
+    self.game_version     = f.read_text(game_version_len)
+    mode_len              = f.i32()
+    self.mode             = f.read_text(mode_len)
+    map_len               = f.i32()
+    self.map              = f.read_text(map_len)
+
+    if self.format == 'EVGR':
+      self.parse_client_demo_header(f)
+    elif self.format == 'DBSR':
+      self.parse_server_demo_header(f)
+    else:
+      raise DemoFormatError(f"wrong header. not a demo?\n{self.format}")
+
+  # Parses the header of an open demo file with one bounded read (repeated
+  # with a bigger size only if the header doesn't fit) and leaves the file
+  # positioned at the start of the packet stream
+  def read_header(self, demo, read_size=HEADER_READ_SIZE):
+    data = demo.read(read_size)
+    while True:
+        try:
+            cursor = BinaryCursor(data)
+            self.parse_header(cursor)
+            break
+        except EOFError:
+            if len(data) < read_size:
+                raise EOFError("demo header is truncated") from None
+            read_size *= 4
+            data += demo.read(read_size - len(data))
+    demo.seek(cursor.tell())
+
+  # Reads just the uncompressed header (map, mode, version, players, ...);
+  # the packet stream is never touched
+  def parse_header_only(self, f, read_size=HEADER_READ_SIZE):
+    with open_source(f) as demo:
+        self.read_header(demo, read_size)
 
   def parse(self, f):
-    with open(f, 'rb') as f:
-        self.format           = f.read(4).decode("utf-8")
-        self.format_version   = decodeInt(f.read(4))
-        game_version_len      = decodeInt(f.read(4))
-        self.game_version     = f.read(game_version_len).decode("utf-8")
-        mode_len              = decodeInt(f.read(4))
-        self.mode             = f.read(mode_len).decode("utf-8")
-        map_len               = decodeInt(f.read(4))
-        self.map              = f.read(map_len).decode("utf-8")
-
-        if self.format == 'EVGR':
-          self.parse_client_demo_header(f)
-        elif self.format == 'DBSR':
-          self.parse_server_demo_header(f)
+    with open_source(f) as f:
+        self.parse_file(f)
+
+  # Same as parse, for an already open demo file (anything with read and seek)
+  def parse_file(self, f):
+    self.read_header(f)
+
+    # as expected, the the gzipped stuff is pretty much just a replay of network packages.
+    # the packet stream is inflated chunk by chunk and only scanned until both JSON
+    # packets were found, so the whole stream is never held in memory
+    payloads = scanJsonPackets(inflateChunks(f), {
+      'start_json': encodeHexString('FF000043 00000000'),
+      'end_json':   encodeHexString('FF00003f 00000000'),
+    })
+
+    for name, payload in payloads.items():
+      setattr(self, name, payload)
+
+  # Yields every Packet of the demo from stream offset start on, see
+  # PacketFramer. start has to be the offset of a packet (see PacketIndex).
+  # If the demo has checkpoints (<demo>.zidx), reading starts at the closest
+  # one instead of inflating everything before start.
+  def iter_packets(self, f, start=0):
+    yield from PacketFramer(self.iter_stream(f, start), start)
+
+  # Yields the inflated packet stream from offset on, in chunks
+  def iter_stream(self, f, offset=0):
+    checkpoints = loadCheckpoints(f)
+    with open_source(f) as demo:
+        self.read_header(demo)
+        if checkpoints is not None:
+            yield from checkpoints.iter_from(demo, offset)
+            return
+
+        for chunk in inflateChunks(demo):
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            yield chunk[offset:] if offset else chunk
+            offset = 0
+
+  def read_stream(self, f, offset, length):
+    parts = []
+    for chunk in self.iter_stream(f, offset):
+        parts.append(chunk[:length])
+        length -= len(parts[-1])
+        if length <= 0:
+            break
+    return b''.join(parts)
+
+  # Walks all packets once, collecting per type statistics into
+  # self.packet_stats. With index=True, a PacketIndex (<demo>.pidx) and, if
+  # libz is available, gzip checkpoints every span bytes (<demo>.zidx) are
+  # written next to the demo in the same pass, so f has to be a plain file then.
+  def scan_packets(self, f, index=False, span=zran.DEFAULT_SPAN):
+    if index and not is_file_source(f):
+        raise ValueError(f"can't write indexes for {f}, it's not a plain file")
+    with open_source(f) as demo:
+        self.read_header(demo)
+        checkpoints = None
+        if index and zran.available():
+            checkpoints = zran.GzipIndex(demo.tell(), span)
+            framer = PacketFramer(checkpoints.build(demo))
         else:
-          print("ERROR: wrong header. not a demo?")
-          print(self.format)
-          exit(1)
+            framer = PacketFramer(inflateChunks(demo))
+        packets = PacketIndex() if index else None
+        types = {}
+
+        for packet in framer:
+            t = types.get(packet.type)
+            if t is None:
+                t = types[packet.type] = {'count': 0, 'bytes': 0, 'min_length': packet.length, 'max_length': packet.length}
+            t['count'] += 1
+            t['bytes'] += packet.length
+            if packet.length < t['min_length']:
+                t['min_length'] = packet.length
+            if packet.length > t['max_length']:
+                t['max_length'] = packet.length
+            if packets is not None:
+                packets.add(packet)
+
+    self.packet_stats = {
+        'packets':       framer.count,
+        'stream_bytes':  framer.offset,
+        'resyncs':       framer.resyncs,
+        'skipped_bytes': framer.skipped,
+        'types':         {f'0x{k:02x}': types[k] for k in sorted(types)},
+    }
+
+    if packets is not None:
+        packets.save(packetIndexPath(f), f)
+    if checkpoints is not None:
+        checkpoints.save(checkpointPath(f), f)
+
+
+CHUNK_SIZE = 1 << 16
+
+# Yields the inflated data of a (possibly multi-member) gzip stream read from
+# f, at most chunk_size bytes at a time.
+def inflateChunks(f, chunk_size=CHUNK_SIZE):
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    between_members = False
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        while data:
+            if between_members:
+                # gzip files may be padded with zeros after the last member
+                data = data.lstrip(b'\0')
+                if not data:
+                    break
+                between_members = False
+            out = d.decompress(data, chunk_size)
+            if out:
+                yield out
+            if d.eof:
+                # next gzip member, if any
+                data = d.unused_data
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                between_members = True
+            else:
+                data = d.unconsumed_tail
+
+# Looks for the first occurrence of every marker in the inflated stream. A
+# marker is followed by a 4 byte length and that many bytes of JSON. Returns
+# {name: decoded JSON} for the markers that were found; like the original byte
+# search, a marker at offset 0 doesn't count. Stops reading as soon as every
+# marker was either found or ruled out.
+def scanJsonPackets(chunks, markers):
+    buf = bytearray()
+    base = 0                                    # stream offset of buf[0]
+    searching = {name: 0 for name in markers}   # name -> stream offset to search from
+    capturing = {}                              # name -> stream offset of the marker
+    found = {}
+
+    for chunk in chunks:
+        buf += chunk
+        end = base + len(buf)
+
+        for name, start in list(searching.items()):
+            marker = markers[name]
+            i = buf.find(marker, start - base)
+            if i < 0:
+                # the marker might still start in the last few bytes
+                searching[name] = max(start, end - len(marker) + 1)
+                continue
+            del searching[name]
+            if base + i > 0:
+                capturing[name] = base + i
 
+        for name, pos in list(capturing.items()):
+            header_end = pos + len(markers[name]) + 4
+            if end < header_end:
+                continue
+            length, = INT32.unpack_from(buf, header_end - 4 - base)
+            if end < header_end + length:
+                continue
+            with memoryview(buf) as mv:
+                found[name] = json.loads(str(mv[header_end - base:header_end + length - base], 'utf-8'))
+            del capturing[name]
 
-        # as expected, the the gzipped stuff is pretty much just a replay of network packages
-        f = io.BytesIO(f.read())
-        gf = gzip.GzipFile(fileobj=f)
+        if not searching and not capturing:
+            break
 
-        packets = gf.read()
-        start_packet_header = packets.find(encodeHexString('FF000043 00000000'))
-        end_packet_header   = packets.find(encodeHexString('FF00003f 00000000'))
+        # drop everything nothing is waiting for anymore
+        keep = min(list(searching.values()) + list(capturing.values()))
+        del buf[:keep - base]
+        base = keep
 
-        if start_packet_header > 0:
-            gf.seek(start_packet_header, 0)
-            start_packet_header = gf.read(8)
-            start_json_length = decodeInt(gf.read(4))
-            self.start_json = json.loads(gf.read(start_json_length).decode("utf-8"))
+    return found
 
-        if end_packet_header > 0:
-            gf.seek(end_packet_header, 0)
-            end_packet_header = gf.read(8)
-            end_json_length = decodeInt(gf.read(4))
-            self.end_json = json.loads(gf.read(end_json_length).decode("utf-8"))
 
+# One frame of the packet stream. The layout is an educated guess based on the
+# two known JSON packets: FF 00 00 <type>, an unknown u32, the u32 payload
+# length, then the payload.
+Packet = namedtuple('Packet', ['offset', 'type', 'length', 'payload', 'u1'])
+
+PACKET_MAGIC = b'\xff\x00\x00'
+PACKET_HEADER = struct.Struct('<3sBII')
+MAX_PACKET_LENGTH = 1 << 24
+
+# Splits the inflated packet stream into Packets. offset is the position in the
+# inflated stream and payload a memoryview into the framer's buffer, so nothing
+# is copied per packet; copy it (bytes(payload)) if it has to outlive the
+# iteration. Data that doesn't look like a frame is skipped up to the next
+# FF 00 00, counted in resyncs/skipped.
+class PacketFramer:
+  def __init__(self, chunks, offset=0):
+    self.chunks = chunks
+    self.count = 0
+    self.offset = offset  # stream offset of the next unread byte
+    self.resyncs = 0
+    self.skipped = 0
+
+  def __iter__(self):
+    buf = b''
+    pos = 0
+    base = self.offset    # stream offset of buf[0]
+    in_sync = True
+
+    for chunk in self.chunks:
+        buf = buf[pos:] + chunk
+        base += pos
+        pos = 0
+        view = memoryview(buf)
+        size = len(buf)
+
+        while size - pos >= PACKET_HEADER.size:
+            magic, packet_type, u1, length = PACKET_HEADER.unpack_from(buf, pos)
+
+            if magic != PACKET_MAGIC or length > MAX_PACKET_LENGTH:
+                if in_sync:
+                    self.resyncs += 1
+                    in_sync = False
+                i = buf.find(PACKET_MAGIC, pos + 1)
+                skip_to = i if i >= 0 else size - len(PACKET_MAGIC) + 1
+                self.skipped += skip_to - pos
+                pos = skip_to
+                continue
+
+            end = pos + PACKET_HEADER.size + length
+            if end > size:
+                break
+
+            in_sync = True
+            self.count += 1
+            yield Packet(base + pos, packet_type, length, view[pos + PACKET_HEADER.size:end], u1)
+            pos = end
+
+        self.offset = base + pos
+
+    # whatever is left can't be a complete packet
+    self.skipped += len(buf) - pos
+    self.offset = base + len(buf)
+
+# Offsets of all packets in the inflated stream of one demo, stored next to it
+# as <demo>.pidx so other tools can go straight to the packets they need. The
+# file starts with 'DBPI', a version, the size and mtime of the demo it belongs
+# to and the packet count, followed by the offsets (u64), types (u8) and
+# lengths (u32) of all packets.
+class PacketIndex:
+  MAGIC = b'DBPI'
+  VERSION = 1
+  HEADER = struct.Struct('<4sIQQI')
+
+  def __init__(self):
+    self.offsets = array.array('Q')
+    self.types = array.array('B')
+    self.lengths = array.array('I')
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def add(self, packet):
+    self.offsets.append(packet.offset)
+    self.types.append(packet.type)
+    self.lengths.append(packet.length)
+
+  # (offset, length) of every packet of the given type
+  def of_type(self, packet_type):
+    return [(o, l) for o, t, l in zip(self.offsets, self.types, self.lengths) if t == packet_type]
+
+  def save(self, path, demo_file):
+    st = os.stat(demo_file)
+    with open(path, 'wb') as f:
+        f.write(self.HEADER.pack(self.MAGIC, self.VERSION, st.st_size, st.st_mtime_ns, len(self)))
+        for a in (self.offsets, self.types, self.lengths):
+            a = array.array(a.typecode, a)
+            if sys.byteorder != 'little':
+                a.byteswap()
+            f.write(a.tobytes())
+
+  # returns None if there's no index or it belongs to a different version of the demo
+  @classmethod
+  def load(cls, path, demo_file):
+    try:
+        with open(path, 'rb') as f:
+            magic, version, size, mtime, count = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            st = os.stat(demo_file)
+            if magic != cls.MAGIC or version != cls.VERSION or size != st.st_size or mtime != st.st_mtime_ns:
+                return None
+            index = cls()
+            for a in (index.offsets, index.types, index.lengths):
+                a.fromfile(f, count)
+                if sys.byteorder != 'little':
+                    a.byteswap()
+            return index
+    except (OSError, EOFError, struct.error):
+        return None
+
+def packetIndexPath(demo_file):
+    return str(demo_file) + '.pidx'
+
+def checkpointPath(demo_file):
+    return str(demo_file) + '.zidx'
+
+# the demo's GzipIndex, or None if there is none (or it's outdated). Demos
+# read from packs or memory never have one.
+def loadCheckpoints(demo_file):
+    if not is_file_source(demo_file):
+        return None
+    return zran.GzipIndex.load(checkpointPath(demo_file), demo_file)
 
-def encodeInt(data, bytes):
-    return data.to_bytes(bytes, "little", signed=True)
-def encodeFloat(data):
-    return bytearray.fromhex(struct.pack('<f', data).hex())
-def encodeString(data):
-    return data.encode()
 def encodeHexString(hex_string):
     return bytes.fromhex(hex_string)
-def decodeInt(data):
-    return int.from_bytes(data, "little", signed=True)
-def decodeEpoch(data):
-    i = int.from_bytes(data, "little", signed=True)
-    return datetime.fromtimestamp(i)
-def decodeFloat(data):
-    return struct.unpack('<f', data)[0]
-def degToRad(degrees):
-    return degrees * math.pi / 180
-def radToDeg(radians):
-    return radians * 180 / math.pi
 
 class BytesEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -126,10 +427,29 @@ class BytesEncoder(json.JSONEncoder):
             return obj.isoformat()
         return json.JSONEncoder.default(self, obj)
 
+def demoFile(path):
+    if not source_exists(path):
+        raise argparse.ArgumentTypeError(f"can't open '{path}'")
+    return path
+
+# one NDJSON line for --header-only, runs in a thread pool
+def headerLine(path):
+    d = Demo()
+    try:
+        d.parse_header_only(path)
+    except (OSError, ValueError, EOFError) as e:
+        return json.dumps({'file': path, 'error': str(e)}, ensure_ascii=False)
+    return json.dumps({'file': path, **d.__dict__}, ensure_ascii=False, cls=BytesEncoder)
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(prog='demo-parser.py', description="demo file parser for Diabotical")
-  parser.add_argument('demo_file', nargs='+', default=[], type=argparse.FileType('r'), help="the demo file")
+  parser.add_argument('demo_file', nargs='+', default=[], type=demoFile, help="the demo file, or an entry of a .dbp pack as PACK.dbp::demos/NAME.rec")
   parser.add_argument('--json', action="store_true", help="export to JSON file in current working directory")
+  parser.add_argument('--header-only', action="store_true", help="only read the headers and print one JSON line per demo (NDJSON), without touching the packet stream")
+  parser.add_argument('--jobs', type=int, default=None, help="with --header-only, number of threads reading headers")
+  parser.add_argument('--packets', action="store_true", help="frame the whole packet stream and add per packet type statistics (packet_stats)")
+  parser.add_argument('--index', action="store_true", help="with --packets, also write a packet offset index (<demo>.pidx) and gzip checkpoints for random access (<demo>.zidx) next to each demo")
+  parser.add_argument('--span', type=float, default=1, help="MiB of packet stream between two gzip checkpoints (default: 1)")
 
   if len(sys.argv)==1:
       parser.print_help(sys.stderr)
@@ -137,11 +457,23 @@ if __name__ == '__main__':
 
   args = parser.parse_args()
 
+  if args.header_only:
+      with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+          for line in pool.map(headerLine, args.demo_file):
+              print(line)
+      sys.exit(0)
+
   for item in args.demo_file:
       d = Demo()
-      d.parse(item.name)
+      try:
+          d.parse(item)
+      except DemoFormatError as e:
+          print(f"ERROR: {e}")
+          exit(1)
+      if args.packets:
+          d.scan_packets(item, args.index, int(args.span * (1 << 20)))
 
-      out_name = Path(item.name).stem + '.json'
+      out_name = Path(PureWindowsPath(item)).stem + '.json'
 
       if args.json:
           print(f"creating {out_name}")
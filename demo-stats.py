@@ -0,0 +1,621 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from dbtools import load_script
+
+demo_parser = load_script('demo-parser')
+demo_indexer = load_script('demo-indexer')
+
+STORE_VERSION = 1
+
+# demos parsed between two writes of the column files
+BATCH_SIZE = 1000
+
+EPOCH = datetime(1970, 1, 1)
+
+################
+# COLUMN STORE #
+################
+
+# A table is a directory with one file per column, each holding the values of
+# all rows back to back (little-endian, no header), so appending rows only
+# appends to the end of every file and a column is loaded with one read:
+#
+#   num    float64 (.f8), NaN where a row has no value
+#   str    int32 codes (.i4), -1 where a row has no value; the strings are in
+#          <file>.dict, one JSON string per line, code = line number
+#   row    int64 (.i8), row numbers into another table
+#   flag   uint8 (.u1)
+#
+# The number of rows and the byte length of every .dict file are only updated
+# in meta.json after the column files were written, anything past them is
+# left over from an interrupted run and cut off before the next append.
+
+KINDS = {
+    'num':  ('<f8', '.f8', np.nan),
+    'str':  ('<i4', '.i4', -1),
+    'row':  ('<i8', '.i8', -1),
+    'flag': ('u1',  '.u1', 0),
+}
+
+def value_kind(value):
+    if isinstance(value, str):
+        return 'str'
+    if isinstance(value, (bool, int, float)):
+        return 'num'
+    return None
+
+class Column:
+    def __init__(self, table, name, kind, file, dict_bytes=0):
+        self.table = table
+        self.name = name
+        self.kind = kind
+        self.file = file
+        self.dict_bytes = dict_bytes
+        self.dtype = np.dtype(KINDS[kind][0])
+        self.missing = KINDS[kind][2]
+        self._strings = None
+        self._codes = None
+
+    @property
+    def path(self):
+        return self.table.path / self.file
+
+    @property
+    def dict_path(self):
+        return self.table.path / (self.file + '.dict')
+
+    def meta(self):
+        meta = {'name': self.name, 'kind': self.kind, 'file': self.file}
+        if self.kind == 'str':
+            meta['dict_bytes'] = self.dict_bytes
+        return meta
+
+    # the string of every code, in code order
+    @property
+    def strings(self):
+        if self._strings is None:
+            self._strings = []
+            if self.dict_bytes:
+                with open(self.dict_path, 'rb') as f:
+                    data = f.read(self.dict_bytes)
+                self._strings = [json.loads(line) for line in data.splitlines()]
+        return self._strings
+
+    def code(self, value):
+        if self._codes is None:
+            self._codes = {s: i for i, s in enumerate(self.strings)}
+        return self._codes.get(value, -1)
+
+    def encode(self, values):
+        if self.kind == 'num':
+            return np.array([v if isinstance(v, (bool, int, float)) else np.nan for v in values], dtype=self.dtype)
+        if self.kind == 'str':
+            if self._codes is None:
+                self._codes = {s: i for i, s in enumerate(self.strings)}
+            codes = np.empty(len(values), dtype=self.dtype)
+            added = []
+            for i, v in enumerate(values):
+                if not isinstance(v, str):
+                    codes[i] = -1
+                    continue
+                c = self._codes.get(v)
+                if c is None:
+                    c = self._codes[v] = len(self._strings)
+                    self._strings.append(v)
+                    added.append(v)
+                codes[i] = c
+            if added:
+                data = ''.join(json.dumps(s, ensure_ascii=False) + '\n' for s in added).encode('utf-8')
+                with open(self.dict_path, 'r+b' if self.dict_path.exists() else 'wb') as f:
+                    f.truncate(self.dict_bytes)
+                    f.seek(self.dict_bytes)
+                    f.write(data)
+                self.dict_bytes += len(data)
+            return codes
+        return np.array([self.missing if v is None else v for v in values], dtype=self.dtype)
+
+    def write(self, start, values):
+        with open(self.path, 'r+b' if self.path.exists() else 'wb') as f:
+            f.truncate(start * self.dtype.itemsize)
+            f.seek(start * self.dtype.itemsize)
+            np.asarray(values, dtype=self.dtype).tofile(f)
+
+    def read(self, rows):
+        if not rows:
+            return np.empty(0, dtype=self.dtype)
+        return np.fromfile(self.path, dtype=self.dtype, count=rows)
+
+class Table:
+    def __init__(self, path, meta=None):
+        self.path = Path(path)
+        meta = meta or {'rows': 0, 'columns': []}
+        self.rows = meta['rows']
+        self.columns = {}
+        for c in meta['columns']:
+            self.columns[c['name']] = Column(self, c['name'], c['kind'], c['file'], c.get('dict_bytes', 0))
+        self._cache = {}
+
+    def meta(self):
+        return {'rows': self.rows, 'columns': [c.meta() for c in self.columns.values()]}
+
+    def add_column(self, name, kind):
+        file = f'{len(self.columns):05d}{KINDS[kind][1]}'
+        column = self.columns[name] = Column(self, name, kind, file)
+        os.makedirs(self.path, exist_ok=True)
+        # rows appended before the column existed don't have a value
+        column.write(0, np.full(self.rows, column.missing, dtype=column.dtype))
+        return column
+
+    # Appends rows (dicts of column name to value). A column is created by
+    # the first value it gets, and its kind is fixed from then on: values of
+    # the other kind are stored as missing. kinds forces the kind of columns
+    # that don't exist yet.
+    def append(self, rows, kinds=None):
+        if not rows:
+            return
+        kinds = kinds or {}
+        names = {}
+        for row in rows:
+            for name, value in row.items():
+                if name not in names and value is not None:
+                    kind = kinds.get(name) or value_kind(value)
+                    if kind is not None:
+                        names[name] = kind
+        for name, kind in names.items():
+            if name not in self.columns:
+                self.add_column(name, kind)
+
+        for column in self.columns.values():
+            column.write(self.rows, column.encode([row.get(column.name) for row in rows]))
+        self.rows += len(rows)
+        self._cache.clear()
+
+    # flips one value in place, for flag columns
+    def set(self, name, row, value):
+        column = self.columns[name]
+        with open(column.path, 'r+b') as f:
+            f.seek(row * column.dtype.itemsize)
+            f.write(np.asarray(value, dtype=column.dtype).tobytes())
+        self._cache.pop(name, None)
+
+    def column(self, name):
+        values = self._cache.get(name)
+        if values is None:
+            values = self._cache[name] = self.columns[name].read(self.rows)
+        return values
+
+#############
+# DEMO ROWS #
+#############
+
+# Scalar leaves of a JSON document outside of lists, e.g. ('teams_won', 1) or
+# ('settings.time_limit', 10). Lists are left out: they're either players
+# (see player_lists) or per-round/per-team arrays that don't make columns.
+def leaves(value, path=''):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            yield from leaves(v, f'{path}.{k}' if path else str(k))
+    elif not isinstance(value, list) and path:
+        yield path, value
+
+# (team, players) for every 'players' list of dicts in a JSON document. team
+# is the index in the enclosing 'teams' list, if there is one.
+def player_lists(value, team=None, key=None):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if k == 'players' and isinstance(v, list):
+                yield team, [p for p in v if isinstance(p, dict)]
+            else:
+                yield from player_lists(v, team, k)
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            yield from player_lists(v, i if key == 'teams' else team, None)
+
+def player_key(player):
+    for k in ('user_id', 'name', 'id'):
+        if player.get(k) not in (None, ''):
+            return str(player[k])
+    return None
+
+# One row per player: the players of the header (server demos only),
+# start_json and end_json, merged by user_id or, where one side doesn't have
+# it, by name. player is the user_id if any of them had one, else the name.
+def player_rows(demo):
+    rows = []
+    by_user_id = {}
+    by_name = {}
+
+    def merge(p, team=None):
+        row = by_user_id.get(p.get('user_id')) or by_name.get(p.get('name'))
+        if row is None:
+            row = {}
+            rows.append(row)
+        if team is not None:
+            row['team'] = team
+        row.update(leaves(p))
+        if row.get('user_id') is not None:
+            by_user_id[row['user_id']] = row
+        if row.get('name') is not None:
+            by_name[row['name']] = row
+
+    for p in getattr(demo, 'players', []):
+        merge({'name': p['name'], 'user_id': p['user_id']})
+    for source in ('start_json', 'end_json'):
+        for team, players in player_lists(getattr(demo, source, None)):
+            for p in players:
+                merge(p, team)
+
+    result = []
+    for row in rows:
+        key = player_key(row)
+        if key is not None:
+            result.append({'player': key, **row})
+    return result
+
+def match_row(path, demo):
+    row = {'path': path, '_live': 1}
+    for key in ('format', 'format_version', 'game_version', 'mode', 'map'):
+        row[key] = getattr(demo, key, None)
+    created_at = getattr(demo, 'created_at', None)
+    row['created_at'] = (created_at - EPOCH).total_seconds() if created_at else None
+    for source in ('start_json', 'end_json'):
+        payload = getattr(demo, source, None)
+        row.update((f'{source[:-5]}.{p}', v) for p, v in leaves(payload))
+    return row
+
+# runs in a pool process
+def parse_demo(job):
+    path, size, mtime_ns = job
+    d = demo_parser.Demo()
+    sha1, error = demo_indexer.parse_hashed(d, path)
+    if error:
+        return path, size, mtime_ns, sha1, error, None, []
+    return path, size, mtime_ns, sha1, None, match_row(path, d), player_rows(d)
+
+# columns whose kind doesn't depend on the first value they get
+MATCH_KINDS = {'path': 'str', 'format': 'str', 'game_version': 'str', 'mode': 'str', 'map': 'str', '_live': 'flag'}
+PLAYER_KINDS = {'_match': 'row', 'player': 'str', 'name': 'str', 'user_id': 'str'}
+
+###############
+# STATS STORE #
+###############
+
+# Per-match and per-player columns of a demo archive, in <store>/matches and
+# <store>/players. meta.json has the row counts and columns of both tables
+# and the (size, mtime_ns, sha1, match row) of every demo that was added.
+class StatsStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.meta_file = self.path / 'meta.json'
+        meta = {}
+        if self.meta_file.exists():
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != STORE_VERSION:
+                print(f"ERROR: {path} was created by a different version of demo-stats")
+                sys.exit(1)
+        self.demos = meta.get('demos', {})
+        self.matches = Table(self.path / 'matches', meta.get('matches'))
+        self.players = Table(self.path / 'players', meta.get('players'))
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.meta_file.with_name(self.meta_file.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': STORE_VERSION, 'matches': self.matches.meta(), 'players': self.players.meta(), 'demos': self.demos}, f)
+        os.replace(tmp, self.meta_file)
+
+    # rows of replaced demos stay in the files and are only flagged as dead
+    def drop(self, path):
+        entry = self.demos.pop(path, None)
+        if entry and entry[3] >= 0:
+            self.matches.set('_live', entry[3], 0)
+
+    def append(self, parsed):
+        matches = []
+        players = []
+        for path, size, mtime_ns, sha1, error, match, rows in parsed:
+            self.drop(path)
+            if error:
+                self.demos[path] = [size, mtime_ns, sha1, -1, error]
+                continue
+            row = self.matches.rows + len(matches)
+            matches.append(match)
+            players.extend({'_match': row, **p} for p in rows)
+            self.demos[path] = [size, mtime_ns, sha1, row, None]
+        self.matches.append(matches, MATCH_KINDS)
+        self.players.append(players, PLAYER_KINDS)
+        self.save()
+
+    # Adds new and changed demos, like demo-indexer: a demo whose size and
+    # mtime didn't change isn't read, one whose content hash didn't change only
+    # gets its mtime updated. Demos are appended in batches as they're parsed.
+    def update(self, paths, jobs=None, prune=False):
+        seen = set()
+        todo = []
+        touched = 0
+        for path in demo_indexer.find_demos(paths):
+            path = os.path.abspath(path)
+            seen.add(path)
+            st = os.stat(path)
+            entry = self.demos.get(path)
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                continue
+            if entry and entry[0] == st.st_size and demo_indexer.file_hash(path) == entry[2]:
+                entry[1] = st.st_mtime_ns
+                touched += 1
+                continue
+            todo.append((path, st.st_size, st.st_mtime_ns))
+
+        errors = 0
+        batch = []
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for i, parsed in enumerate(pool.map(parse_demo, todo, chunksize=4), 1):
+                batch.append(parsed)
+                if parsed[4]:
+                    errors += 1
+                    print(f"WARNING: {parsed[0]}: {parsed[4]}", file=sys.stderr)
+                if len(batch) == BATCH_SIZE:
+                    self.append(batch)
+                    batch = []
+                    print(f"{i}/{len(todo)} demos added")
+        self.append(batch)
+
+        pruned = 0
+        if prune:
+            for path in [p for p in self.demos if p not in seen]:
+                self.drop(path)
+                pruned += 1
+
+        self.save()
+        print(f"{len(todo)} added ({errors} failed), {touched} touched, {len(seen) - len(todo) - touched} unchanged, {pruned} removed")
+
+    def table(self, name):
+        if name not in ('matches', 'players'):
+            raise ValueError(f"unknown table '{name}'")
+        return getattr(self, name)
+
+    # Column name -> (Column, values) of the live rows of a table. Columns of
+    # the players table can also be match columns (map, mode, ...), which are
+    # looked up through each player's match.
+    def resolver(self, table):
+        live = self.matches.column('_live') == 1 if self.matches.rows else np.zeros(0, dtype=bool)
+        if table == 'players':
+            match = self.players.column('_match')
+            rows = np.flatnonzero(live[match]) if self.players.rows else np.zeros(0, dtype=np.int64)
+            match = match[rows]
+        else:
+            rows = np.flatnonzero(live)
+            match = None
+
+        def resolve(name):
+            t = self.table(table)
+            if name in t.columns:
+                return t.columns[name], t.column(name)[rows]
+            if match is not None and name in self.matches.columns:
+                return self.matches.columns[name], self.matches.column(name)[match]
+            raise KeyError(name)
+
+        return len(rows), resolve
+
+    # Grouped aggregates over the live rows of a table. by and values are
+    # column names, where filters rows by (column, value) pairs. Returns one
+    # dict per group with the group's key columns, its row count and
+    # '<value>.<agg>' for every value column and aggregate.
+    def aggregate(self, table='players', by=('player',), values=(), aggs=('sum', 'mean'), where=()):
+        n, resolve = self.resolver(table)
+        mask = np.ones(n, dtype=bool)
+        for name, value in where:
+            column, data = resolve(name)
+            if column.kind == 'str':
+                # -1 is also the code of missing values, so a string that
+                # isn't in the dictionary must not match those
+                code = column.code(str(value))
+                if code < 0:
+                    mask[:] = False
+                else:
+                    mask &= data == code
+            else:
+                mask &= data == float(value)
+
+        # every key column is turned into codes first, so missing (NaN)
+        # values end up in one group instead of one group per row
+        keys = []
+        codes = []
+        for name in by:
+            column, data = resolve(name)
+            uniq, inverse = key_codes(column, data[mask])
+            keys.append((column, uniq))
+            codes.append(inverse)
+        n = int(mask.sum())
+
+        if codes:
+            # one int64 per row from all key codes, then one 1-D unique
+            combined = np.ravel_multi_index(codes, [max(len(uniq), 1) for _, uniq in keys])
+            combos, group = np.unique(combined, return_inverse=True)
+            group = group.reshape(-1)
+            combos = np.unravel_index(combos, [max(len(uniq), 1) for _, uniq in keys])
+            groups = len(combos[0])
+        else:
+            group = np.zeros(n, dtype=np.intp)
+            groups = 1 if n else 0
+
+        # built column by column, the rows are only put together at the end
+        names = list(by) + ['count']
+        columns = [decode(column, uniq[combos[i]]) for i, (column, uniq) in enumerate(keys)]
+        columns.append(np.bincount(group, minlength=groups).tolist())
+
+        # rows sorted by group, shared by the min/max of all value columns
+        order = np.argsort(group, kind='stable') if 'min' in aggs or 'max' in aggs else None
+        for name in values:
+            column, data = resolve(name)
+            if column.kind != 'num':
+                raise ValueError(f"{name} is not a numeric column")
+            for agg, result in zip(aggs, aggregate_column(data[mask], group, groups, aggs, order)):
+                names.append(f'{name}.{agg}')
+                columns.append([None if v != v else v for v in result.tolist()])
+
+        return [dict(zip(names, row)) for row in zip(*columns)]
+
+    # Column name, kind and number of live rows that have a value
+    def describe(self, table):
+        n, resolve = self.resolver(table)
+        result = []
+        for name, column in self.table(table).columns.items():
+            if name.startswith('_'):
+                continue
+            _, data = resolve(name)
+            filled = int((~np.isnan(data)).sum()) if column.kind == 'num' else int((data != column.missing).sum())
+            result.append({'column': name, 'kind': column.kind, 'rows': n, 'filled': filled})
+        return result
+
+# (distinct values, index into them for every row) of a key column. String
+# codes are small and dense, so they're counted instead of sorted.
+def key_codes(column, data):
+    if column.kind == 'str':
+        counts = np.bincount(data + 1, minlength=len(column.strings) + 1)
+        present = counts > 0
+        uniq = np.flatnonzero(present) - 1
+        remap = np.cumsum(present) - 1
+        return uniq.astype(data.dtype), remap[data + 1]
+    uniq, inverse = np.unique(data, return_inverse=True)
+    return uniq, inverse.reshape(-1)
+
+# Python values of an array of a column, None where they're missing
+def decode(column, values):
+    if column.kind == 'str':
+        strings = column.strings
+        return [strings[c] if c >= 0 else None for c in values.tolist()]
+    if column.kind == 'num':
+        return [None if v != v else v for v in values.tolist()]
+    return values.tolist()
+
+AGGREGATES = ('count', 'sum', 'mean', 'min', 'max')
+
+# Per group aggregates of x, where group holds the group of every value and
+# order sorts the rows by group (only needed for min/max). Missing values
+# (NaN) are left out.
+def aggregate_column(x, group, groups, aggs, order=None):
+    ok = ~np.isnan(x)
+    count = np.bincount(group[ok], minlength=groups).astype(np.float64)
+    total = np.bincount(group[ok], weights=x[ok], minlength=groups)
+    lo = hi = None
+    if order is not None:
+        lo = np.full(groups, np.nan)
+        hi = np.full(groups, np.nan)
+        xs = x[order]
+        keep = ~np.isnan(xs)
+        g = group[order][keep]
+        xs = xs[keep]
+        if len(xs):
+            starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+            lo[g[starts]] = np.minimum.reduceat(xs, starts)
+            hi[g[starts]] = np.maximum.reduceat(xs, starts)
+
+    out = []
+    for agg in aggs:
+        if agg == 'count':
+            out.append(count)
+        elif agg == 'sum':
+            out.append(total)
+        elif agg == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out.append(np.where(count > 0, total / np.maximum(count, 1), np.nan))
+        elif agg == 'min':
+            out.append(lo)
+        elif agg == 'max':
+            out.append(hi)
+    return out
+
+def print_table(results):
+    if not results:
+        return
+    cols = list(results[0])
+    print('\t'.join(cols))
+    for r in results:
+        row = []
+        for c in cols:
+            v = r.get(c)
+            if isinstance(v, float):
+                v = f'{v:.0f}' if v == int(v) else f'{v:.3f}'
+            row.append('' if v is None else str(v))
+        print('\t'.join(row))
+
+# 'map=a_bounce' -> ('map', 'a_bounce')
+def where_filter(s):
+    name, sep, value = s.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected COLUMN=VALUE, got '{s}'")
+    return name, value
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='demo-stats.py', description="columnar match and player stats of Diabotical demo archives")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_update = subparsers.add_parser('update', aliases=['u'], help='add new and changed demos to the store')
+    parser_update.add_argument('store', type=str, help="store directory, created if it doesn't exist")
+    parser_update.add_argument('demos', nargs='+', help="demo files or directories to search for demos")
+    parser_update.add_argument('--jobs', type=int, default=None, help="number of parser processes (default: number of CPUs)")
+    parser_update.add_argument('--prune', action='store_true', help="drop demos from the store that weren't found this time")
+
+    parser_query = subparsers.add_parser('query', aliases=['q'], help='grouped aggregates, e.g. a leaderboard')
+    parser_query.add_argument('store', type=str, help="store directory")
+    parser_query.add_argument('--table', choices=['players', 'matches'], default='players', help="rows to aggregate: one per player and match, or one per match (default: players)")
+    parser_query.add_argument('--by', nargs='*', default=None, help="columns to group by, e.g. player map mode game_version (default: player, or nothing for matches)")
+    parser_query.add_argument('--stat', nargs='+', default=[], help="numeric columns to aggregate")
+    parser_query.add_argument('--agg', nargs='+', choices=AGGREGATES, default=['sum', 'mean'], help="aggregates of every --stat (default: sum mean)")
+    parser_query.add_argument('--where', type=where_filter, action='append', default=[], metavar='COLUMN=VALUE', help="only rows with this value, e.g. map=a_bounce (repeatable)")
+    parser_query.add_argument('--sort', type=str, help="output column to sort by, descending, e.g. kills.sum (default: count)")
+    parser_query.add_argument('--limit', type=int, default=100, help="maximum number of groups (default: 100)")
+    parser_query.add_argument('--json', action='store_true', help="print one JSON object per group instead of a table")
+
+    parser_columns = subparsers.add_parser('columns', aliases=['c'], help='list the columns of a table')
+    parser_columns.add_argument('store', type=str, help="store directory")
+    parser_columns.add_argument('--table', choices=['players', 'matches'], default='players', help="(default: players)")
+
+    if len(sys.argv)==1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    if not args.command.startswith("u") and not (Path(args.store) / 'meta.json').exists():
+        print(f"ERROR: {args.store} isn't a demo-stats store")
+        sys.exit(1)
+
+    store = StatsStore(args.store)
+
+    if args.command.startswith("u"):
+        store.update(args.demos, args.jobs, args.prune)
+
+    elif args.command.startswith("q"):
+        by = args.by if args.by is not None else (['player'] if args.table == 'players' else [])
+        try:
+            results = store.aggregate(args.table, by, args.stat, args.agg, args.where)
+        except KeyError as e:
+            print(f"ERROR: no column {e} in {args.table}, see `demo-stats.py columns`")
+            sys.exit(1)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+        sort = args.sort or 'count'
+        results.sort(key=lambda r: (r.get(sort) is not None, r.get(sort) if r.get(sort) is not None else 0), reverse=True)
+        results = results[:args.limit]
+        if args.json:
+            for r in results:
+                print(json.dumps(r, ensure_ascii=False))
+        else:
+            print_table(results)
+
+    elif args.command.startswith("c"):
+        print_table(store.describe(args.table))
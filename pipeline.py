@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import io
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from pathlib import Path, PureWindowsPath
+
+from dbtools import load_script
+
+dbp_packer = load_script('dbp-packer')
+assets_parser = load_script('assets-parser')
+rbe_parser = load_script('rbe-parser')
+demo_indexer = load_script('demo-indexer')
+
+# bump when a step produces different output for the same input, so
+# everything is redone once
+PIPELINE_VERSION = 1
+
+STEPS = ['unpack', 'assets', 'maps', 'demos']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path            TEXT PRIMARY KEY,
+    size            INTEGER NOT NULL,
+    mtime_ns        INTEGER NOT NULL,
+    sha1            TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    name            TEXT PRIMARY KEY,
+    signature       TEXT NOT NULL,
+    outputs         TEXT NOT NULL,
+    seconds         REAL,
+    finished_at     TEXT
+);
+'''
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+###############
+# STATE DB    #
+###############
+
+# Content hashes of every input and output the pipeline has seen (reused as
+# long as size and mtime don't change) and the input signature each task was
+# last run with.
+class State:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+        self.files = {path: (size, mtime_ns, sha1) for path, size, mtime_ns, sha1 in self.db.execute('SELECT * FROM files')}
+        self.tasks = {name: (signature, json.loads(outputs)) for name, signature, outputs in self.db.execute('SELECT name, signature, outputs FROM tasks')}
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def hash(self, path):
+        path = str(path)
+        st = os.stat(path)
+        entry = self.files.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        sha1 = file_hash(path)
+        self.record(path, sha1, st.st_size, st.st_mtime_ns)
+        return sha1
+
+    def record(self, path, sha1, size, mtime_ns):
+        self.files[path] = (size, mtime_ns, sha1)
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, size, mtime_ns, sha1))
+
+    # None if an input is missing (the task has to run and will fail)
+    def signature(self, task, inputs):
+        h = hashlib.sha1(f'{PIPELINE_VERSION}\0{task.name}\0{json.dumps(task.params, sort_keys=True)}'.encode())
+        for path in sorted(str(p) for p in inputs):
+            try:
+                h.update(f'\0{path}\0{self.hash(path)}'.encode())
+            except FileNotFoundError:
+                return None
+        return h.hexdigest()
+
+    def fresh(self, name, signature):
+        entry = self.tasks.get(name)
+        return signature is not None and entry is not None and entry[0] == signature and all(os.path.exists(p) for p in entry[1])
+
+    def done(self, name, signature, outputs, seconds):
+        self.tasks[name] = (signature, outputs)
+        self.db.execute('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)',
+                        (name, signature, json.dumps(outputs), seconds, datetime.now().isoformat(timespec='seconds')))
+        self.db.commit()
+
+###############
+# TASK GRAPH  #
+###############
+
+# One step of the pipeline. fn(*args) runs in a pool process and returns
+# (outputs, hashes): the files it produced and (path, sha1, size, mtime_ns)
+# for any of them it already hashed. inputs is a list of files or, for inputs
+# that only exist once the dependencies ran, a callable returning one. A task
+# without inputs runs every time (for steps that are incremental themselves).
+class Task:
+    def __init__(self, name, step, fn, args=(), inputs=None, deps=(), params=None):
+        self.name = name
+        self.step = step
+        self.fn = fn
+        self.args = args
+        self.inputs = inputs
+        self.deps = list(deps)
+        self.params = params or {}
+
+    def resolve_inputs(self):
+        return self.inputs() if callable(self.inputs) else self.inputs
+
+def unpacked_path(unpacked, entry_name):
+    return Path(unpacked) / Path(PureWindowsPath(entry_name))
+
+def read_pack_index(pack):
+    with open(pack, 'rb') as f:
+        return [df.name for df in dbp_packer.DBPReader.read(f).index]
+
+# The graph for one run: an unpack task per pack, then the assets export, one
+# task per map and the demo index, each depending on the packs its inputs
+# come from. Packs are read in name order and, like unpack_all.sh, a later
+# pack wins when several contain the same entry.
+def build_graph(state, packs_dir, unpacked, out, demos=None, jobs=None):
+    tasks = []
+    packs = sorted(Path(packs_dir).glob('*.dbp'))
+
+    owner = {}
+    for pack in packs:
+        for name in read_pack_index(pack):
+            owner[str(unpacked_path(unpacked, name))] = pack
+
+    for pack in packs:
+        entries = sorted(path for path, p in owner.items() if p == pack)
+        known = {path: state.files.get(path) for path in entries}
+        tasks.append(Task(f'unpack:{pack.name}', 'unpack', unpack_pack, (str(pack), str(unpacked), known),
+                          inputs=[pack]))
+
+    def deps_of(paths):
+        return sorted({f'unpack:{owner[p].name}' for p in paths if p in owner})
+
+    assets = sorted(p for p in owner if p.endswith('.assets'))
+    if assets:
+        tasks.append(Task('assets', 'assets', export_assets, (os.path.relpath(unpacked), str(out), jobs),
+                          inputs=lambda: sorted(str(p) for p in Path(unpacked).glob('**/*.assets')),
+                          deps=deps_of(assets)))
+
+    maps = sorted(p for p in owner if p.endswith('.rbe') and Path(p).parent.name == 'maps')
+    for path in maps:
+        tasks.append(Task(f'map:{Path(path).name}', 'maps', process_map, (path, str(out)),
+                          inputs=[path], deps=deps_of([path])))
+
+    if demos:
+        tasks.append(Task('demos', 'demos', index_demos, (str(demos), str(Path(out) / 'demos.sqlite'), jobs)))
+
+    return tasks
+
+# Runs every task once its dependencies are done, as many at a time as the
+# pool has workers. Tasks whose input signature matches the last run (and
+# whose outputs still exist) are skipped; a task whose dependency failed isn't
+# run at all. Returns (ran, skipped, failed) task names.
+def run_graph(tasks, state, jobs=None, force=False, verbose=True):
+    pending = {t.name: t for t in tasks}
+    names = set(pending)
+    done = set()
+    failed = set()
+    ran = []
+    skipped = []
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            ready = [t for t in pending.values() if all(d in done or d in failed or d not in names for d in t.deps)]
+            for task in ready:
+                del pending[task.name]
+                if any(d in failed for d in task.deps):
+                    failed.add(task.name)
+                    print(f"ERROR: {task.name}: not run, a dependency failed")
+                    continue
+                inputs = task.resolve_inputs()
+                signature = state.signature(task, inputs) if inputs is not None else None
+                if not force and state.fresh(task.name, signature):
+                    skipped.append(task.name)
+                    done.add(task.name)
+                    continue
+                running[pool.submit(task.fn, *task.args)] = (task, time.perf_counter())
+
+            if not running:
+                # skipped or failed tasks can make others ready without
+                # anything running, so only give up once nothing moved
+                if ready:
+                    continue
+                if pending:
+                    raise ValueError(f"dependency cycle or unknown dependency in {sorted(pending)}")
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                task, t0 = running.pop(fut)
+                seconds = time.perf_counter() - t0
+                try:
+                    outputs, hashes = fut.result()
+                except (Exception, SystemExit) as e:
+                    failed.add(task.name)
+                    print(f"ERROR: {task.name}: {type(e).__name__}: {e}")
+                    continue
+                for h in hashes:
+                    state.record(*h)
+                # the signature is taken after the task ran, so inputs it
+                # rewrote itself don't make the next run redo it
+                inputs = task.resolve_inputs()
+                signature = state.signature(task, inputs) if inputs is not None else None
+                if signature is not None:
+                    state.done(task.name, signature, outputs, seconds)
+                ran.append(task.name)
+                done.add(task.name)
+                if verbose:
+                    print(f"{task.name}\t{seconds:.2f}s")
+
+    return ran, skipped, sorted(failed)
+
+###########
+# STEPS   #
+###########
+
+# Writes the entries of a pack that are missing or whose content changed and
+# leaves everything else untouched, so the mtimes (and with them the cached
+# hashes) of unchanged entries survive. known maps the unpacked paths this
+# pack owns to their (size, mtime_ns, sha1) from the last run, or None.
+def unpack_pack(pack, unpacked, known):
+    outputs = []
+    hashes = []
+    with open(pack, 'rb') as f:
+        d = dbp_packer.DBPReader.read(f)
+        for df in d.index:
+            path = str(unpacked_path(unpacked, df.name))
+            if path not in known:
+                continue
+            data = d.read_file(df)
+            sha1 = hashlib.sha1(data).hexdigest()
+            try:
+                st = os.stat(path)
+                unchanged = known[path] == (st.st_size, st.st_mtime_ns, sha1)
+            except FileNotFoundError:
+                unchanged = False
+            if not unchanged:
+                os.makedirs(os.path.dirname(path), 0o766, True)
+                with open(path, 'wb') as out:
+                    out.write(data)
+                st = os.stat(path)
+            outputs.append(path)
+            hashes.append((path, sha1, st.st_size, st.st_mtime_ns))
+    return outputs, hashes
+
+# assets-parser exits on a syntax error after printing what's wrong; that
+# becomes an ordinary error with the parser's output as the message
+def export_assets(src, out, jobs):
+    os.makedirs(out, exist_ok=True)
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            assets_parser.create_asset_json(src, out, jobs=jobs)
+    except SystemExit as e:
+        raise RuntimeError(log.getvalue().strip() or f"assets-parser exited with {e.code}") from None
+    return [str(p) for p in assets_parser.AssetJsonWriter.output_files(out, False, False)], []
+
+# The minimap (if the map has one) and a small JSON summary for map pages
+def process_map(path, out):
+    m = rbe_parser.MapObject()
+    with contextlib.redirect_stdout(io.StringIO()):
+        m.Load(path)
+
+    stem = Path(path).stem
+    outputs = []
+
+    if m.minimap_layers:
+        minimap = Path(out) / 'minimaps' / stem
+        os.makedirs(minimap.parent, exist_ok=True)
+        m.DrawMinimap(str(minimap))
+        outputs.append(str(minimap) + '.png')
+
+    info = {'file': Path(path).name, **m.Summary()}
+    info_path = Path(out) / 'maps' / (stem + '.json')
+    os.makedirs(info_path.parent, exist_ok=True)
+    with open(info_path, 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=4, cls=rbe_parser.BytesEncoder)
+    outputs.append(str(info_path))
+
+    return outputs, []
+
+def index_demos(demos, database, jobs):
+    db = demo_indexer.open_db(database)
+    with contextlib.redirect_stdout(io.StringIO()):
+        demo_indexer.index_demos(db, [demos], jobs)
+    db.close()
+    return [database], []
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='pipeline.py', description="incremental unpack/export pipeline for the Diabotical game files")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_run = subparsers.add_parser('run', aliases=['r'], help='unpack the packs and rebuild every output whose inputs changed')
+    parser_run.add_argument('--packs', type=str, default='_packs', help="directory with the .dbp files (default: _packs)")
+    parser_run.add_argument('--unpacked', type=str, default='_unpacked', help="directory the packs are unpacked to (default: _unpacked)")
+    parser_run.add_argument('--out', type=str, default='.', help="directory for assets.json, minimaps/, maps/ and demos.sqlite (default: .)")
+    parser_run.add_argument('--demos', type=str, help="also index the demos in this directory into <out>/demos.sqlite")
+    parser_run.add_argument('--only', nargs='+', choices=STEPS, help="run only these steps")
+    parser_run.add_argument('--jobs', type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser_run.add_argument('--force', action='store_true', help="run every task, even if its inputs are unchanged")
+    parser_run.add_argument('--state', type=str, help="state database (default: <out>/.pipeline-state.sqlite)")
+
+    parser_status = subparsers.add_parser('status', aliases=['s'], help='list the tasks of the last runs')
+    parser_status.add_argument('--out', type=str, default='.', help="output directory of the runs (default: .)")
+    parser_status.add_argument('--state', type=str, help="state database (default: <out>/.pipeline-state.sqlite)")
+
+    if len(sys.argv)==1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    state_path = args.state or str(Path(args.out) / '.pipeline-state.sqlite')
+
+    if args.command.startswith("r"):
+        t0 = time.perf_counter()
+        os.makedirs(args.out, exist_ok=True)
+        state = State(state_path)
+        tasks = build_graph(state, args.packs, args.unpacked, args.out, args.demos, args.jobs)
+        if args.only:
+            tasks = [t for t in tasks if t.step in args.only]
+        ran, skipped, failed = run_graph(tasks, state, args.jobs, args.force)
+        state.close()
+        print(f"{len(ran)} run, {len(skipped)} unchanged, {len(failed)} failed in {time.perf_counter() - t0:.1f}s")
+        if failed:
+            sys.exit(1)
+
+    elif args.command.startswith("s"):
+        if not Path(state_path).exists():
+            print(f"ERROR: {state_path} doesn't exist")
+            sys.exit(1)
+        db = sqlite3.connect(state_path)
+        for name, seconds, finished_at, outputs in db.execute('SELECT name, seconds, finished_at, outputs FROM tasks ORDER BY name'):
+            print(f"{name}\t{finished_at}\t{seconds:.2f}s\t{len(json.loads(outputs))} outputs")
+        db.close()
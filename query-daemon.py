@@ -0,0 +1,438 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import io
+import json
+import time
+import types
+import asyncio
+import argparse
+import contextlib
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from pathlib import Path
+
+import numpy as np
+
+from dbtools import load_script
+
+rbe_parser = load_script('rbe-parser')
+assets_parser = load_script('assets-parser')
+demo_parser = load_script('demo-parser')
+
+# latencies kept per endpoint for the percentiles in /metrics
+LATENCY_SAMPLES = 10000
+
+MAX_REQUEST_LINE = 8192
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+##############
+# LRU CACHES #
+##############
+
+# Size-bounded LRU cache of objects derived from a file. Every entry remembers
+# the (size, mtime) of its file and is dropped on access once they changed.
+# The weight of an entry is an estimate of the memory its object takes (see
+# memory_size()). get() returns MISSING if there's no valid entry, so None
+# can be cached like any other value.
+MISSING = object()
+
+class LRUCache:
+    def __init__(self, name, max_bytes, on_evict=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.entries = OrderedDict()    # key -> (stamp, value, weight)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.refused = 0
+
+    def get(self, key, stamp):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        if entry[0] != stamp:
+            self.invalidations += 1
+            self.misses += 1
+            self.remove(key)
+            return MISSING
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, stamp, value, weight):
+        if key in self.entries:
+            self.remove(key)
+        if weight > self.max_bytes:
+            # not kept; the caller is still using it, so on_evict isn't called
+            # (values that need closing have to close themselves once they are
+            # dropped, like AssetIndex)
+            self.refused += 1
+            return
+        self.entries[key] = (stamp, value, weight)
+        self.bytes += weight
+        while self.bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        stamp, value, weight = self.entries.pop(key)
+        self.bytes -= weight
+        if self.on_evict is not None:
+            self.on_evict(value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'refused': self.refused,
+        }
+
+# Approximate memory taken by a parsed object: everything reachable through
+# containers and object attributes, by sys.getsizeof. numpy arrays count the
+# buffer they own or view once. Shared objects (interned strings, views of one
+# array) are counted once.
+def memory_size(obj):
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, np.ndarray):
+            if o.base is not None:
+                stack.append(o.base)
+        elif isinstance(o, memoryview):
+            stack.append(o.obj)
+        elif isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, '__dict__') and not isinstance(o, (type, types.ModuleType)) and not callable(o):
+            stack.append(o.__dict__)
+    return total
+
+def file_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+def load_weighed(path, load, weight):
+    value = load(path)
+    return value, weight(value)
+
+###########
+# METRICS #
+###########
+
+class EndpointMetrics:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_s = 0.0
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+
+    def add(self, seconds, error):
+        self.count += 1
+        self.errors += error
+        self.total_s += seconds
+        self.samples.append(seconds)
+
+    def stats(self):
+        samples = sorted(self.samples)
+
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000 if samples else None
+
+        return {
+            'requests': self.count,
+            'errors': self.errors,
+            'mean_ms': self.total_s / self.count * 1000 if self.count else None,
+            'p50_ms': percentile(0.50),
+            'p90_ms': percentile(0.90),
+            'p99_ms': percentile(0.99),
+            'max_ms': samples[-1] * 1000 if samples else None,
+        }
+
+##########
+# DAEMON #
+##########
+
+# Serves queries on parsed maps, assets and demos over HTTP. Parsing runs in a
+# thread pool; concurrent requests for the same file share one parse.
+class QueryDaemon:
+    def __init__(self, root, cache_bytes, minimap_cache_bytes, workers=4):
+        self.root = Path(root).resolve()
+        self.maps = LRUCache('maps', cache_bytes)
+        self.minimaps = LRUCache('minimaps', minimap_cache_bytes)
+        self.assets = LRUCache('assets', cache_bytes)
+        self.asset_indexes = LRUCache('asset_indexes', cache_bytes, on_evict=lambda idx: idx.close())
+        self.demos = LRUCache('demos', cache_bytes)
+        self.caches = [self.maps, self.minimaps, self.assets, self.asset_indexes, self.demos]
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.loading = {}
+        self.metrics = {}
+        self.started = time.time()
+
+        self.routes = {
+            '/map/summary':     self.map_summary,
+            '/map/entities':    self.map_entities,
+            '/map/minimap.png': self.map_minimap,
+            '/assets/file':     self.assets_file,
+            '/assets/find':     self.assets_find,
+            '/assets/where':    self.assets_where,
+            '/assets/rules':    self.assets_rules,
+            '/demo':            self.demo,
+            '/metrics':         self.metrics_endpoint,
+        }
+
+    # files outside the root directory are never read
+    def resolve(self, path):
+        p = (self.root / path).resolve()
+        if p != self.root and self.root not in p.parents:
+            raise RequestError(HTTPStatus.FORBIDDEN, f"{path} is outside of the served directory")
+        if not p.is_file():
+            raise RequestError(HTTPStatus.NOT_FOUND, f"{path} doesn't exist")
+        return p
+
+    # The cached value for path (under key, if several values are derived from
+    # one file), loading it with load(path) in the thread pool if it isn't
+    # cached or the file changed. weight(value) is its size in the cache,
+    # memory_size() unless given; it is worked out in the pool as well.
+    async def cached(self, cache, path, load, weight=None, key=None):
+        key = path if key is None else key
+        stamp = file_stamp(path)
+        value = cache.get(key, stamp)
+        if value is not MISSING:
+            return value
+
+        loading = (cache.name, key, stamp)
+        task = self.loading.get(loading)
+        if task is None:
+            loop = asyncio.get_running_loop()
+            task = asyncio.ensure_future(loop.run_in_executor(self.executor, load_weighed, path, load, weight or memory_size))
+            self.loading[loading] = task
+            try:
+                value, size = await task
+            finally:
+                del self.loading[loading]
+            cache.put(key, stamp, value, size)
+            return value
+        value, _ = await asyncio.shield(task)
+        return value
+
+    async def load_map(self, path):
+        def load(path):
+            m = rbe_parser.MapObject()
+            m.Load(str(path))
+            return m
+        return await self.cached(self.maps, path, load)
+
+    async def map_summary(self, query):
+        path = self.resolve(param(query, 'path'))
+        m = await self.load_map(path)
+        return json_response({'file': path.name, **m.Summary()}, rbe_parser.BytesEncoder)
+
+    async def map_entities(self, query):
+        path = self.resolve(param(query, 'path'))
+        m = await self.load_map(path)
+        name = param(query, 'name', None)
+        entities = m.FindEntities(name) if name else m.entities
+        return json_response(entities, rbe_parser.BytesEncoder)
+
+    async def map_minimap(self, query):
+        path = self.resolve(param(query, 'path'))
+        m = await self.load_map(path)
+
+        # rendered from the cached map, but cached on its own since the
+        # image is small compared to the map
+        def render(path):
+            img = m.MinimapImage()
+            if img is None:
+                return b''
+            buf = io.BytesIO()
+            img.save(buf, 'PNG')
+            return buf.getvalue()
+
+        png = await self.cached(self.minimaps, path, render, weight=len)
+        if not png:
+            raise RequestError(HTTPStatus.NOT_FOUND, f"{path.name} has no minimap")
+        return HTTPStatus.OK, 'image/png', png
+
+    async def assets_file(self, query):
+        path = self.resolve(param(query, 'path'))
+
+        # parse_assets() exits on malformed files
+        def load(path):
+            try:
+                return assets_parser.parse_assets(str(path))
+            except SystemExit:
+                raise ValueError(f"{path.name} can't be parsed") from None
+
+        return json_response(await self.cached(self.assets, path, load))
+
+    async def load_asset_index(self, query):
+        path = self.resolve(param(query, 'index'))
+        # the index is read through a memory map of the whole file
+        return await self.cached(self.asset_indexes, path, assets_parser.AssetIndex, weight=lambda idx: len(idx.mm))
+
+    async def assets_find(self, query):
+        idx = await self.load_asset_index(query)
+        return json_response(idx.find(param(query, 'name')))
+
+    async def assets_where(self, query):
+        idx = await self.load_asset_index(query)
+        return json_response(idx.where(param(query, 'key'), param(query, 'value')))
+
+    async def assets_rules(self, query):
+        idx = await self.load_asset_index(query)
+        return json_response(idx.rules_with(param(query, 'name'), param(query, 'kind', None)))
+
+    async def demo(self, query):
+        path = self.resolve(param(query, 'path'))
+        header_only = param(query, 'header', '0') not in ('0', 'false', '')
+
+        def load(path):
+            d = demo_parser.Demo()
+            if header_only:
+                d.parse_header_only(str(path))
+            else:
+                d.parse(str(path))
+            return d
+
+        d = await self.cached(self.demos, path, load, key=(path, header_only))
+        return json_response({'file': path.name, **d.__dict__}, demo_parser.BytesEncoder)
+
+    async def metrics_endpoint(self, query):
+        return json_response({
+            'uptime_s': time.time() - self.started,
+            'caches': {c.name: c.stats() for c in self.caches},
+            'endpoints': {route: m.stats() for route, m in sorted(self.metrics.items())},
+        })
+
+    async def dispatch(self, method, target):
+        url = urllib.parse.urlsplit(target)
+        route = url.path
+        handler = self.routes.get(route)
+        t0 = time.perf_counter()
+        error = False
+        try:
+            if handler is None:
+                raise RequestError(HTTPStatus.NOT_FOUND, f"unknown endpoint {route}")
+            if method != 'GET':
+                raise RequestError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} not supported")
+            return await handler(urllib.parse.parse_qs(url.query))
+        except RequestError as e:
+            error = True
+            return json_response({'error': str(e)}, status=e.status)
+        except (ValueError, EOFError, OSError) as e:
+            error = True
+            return json_response({'error': f"{type(e).__name__}: {e}"}, status=HTTPStatus.UNPROCESSABLE_ENTITY)
+        except Exception as e:
+            error = True
+            print(f"ERROR: {target}: {type(e).__name__}: {e}", file=sys.stderr)
+            return json_response({'error': f"{type(e).__name__}: {e}"}, status=HTTPStatus.INTERNAL_SERVER_ERROR)
+        finally:
+            if handler is not None:
+                self.metrics.setdefault(route, EndpointMetrics()).add(time.perf_counter() - t0, error)
+
+    # HTTP/1.1 with keep-alive, GET only
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if len(line) > MAX_REQUEST_LINE:
+                    break
+                parts = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b'\r\n', b'\n', b''):
+                        break
+                    k, _, v = h.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+
+                if len(parts) != 3:
+                    status, content_type, body = json_response({'error': 'bad request'}, status=HTTPStatus.BAD_REQUEST)
+                    keep_alive = False
+                else:
+                    method, target, version = parts
+                    status, content_type, body = await self.dispatch(method, target)
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+
+                writer.write((f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                              f'Content-Type: {content_type}\r\n'
+                              f'Content-Length: {len(body)}\r\n'
+                              f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=None, port=None, unix=None):
+        if unix:
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+            print(f"listening on {unix}", file=sys.stderr)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print(f"listening on http://{host}:{port}", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+def param(query, name, default=RequestError):
+    values = query.get(name)
+    if not values:
+        if default is RequestError:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"missing parameter '{name}'")
+        return default
+    return values[0]
+
+def json_response(obj, cls=None, status=HTTPStatus.OK):
+    return status, 'application/json; charset=utf-8', json.dumps(obj, ensure_ascii=False, cls=cls).encode('utf-8')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='query-daemon.py', description="long-running server for map, asset and demo queries")
+    parser.add_argument('--root', type=str, default='.', help="directory the served files are in, paths in queries are relative to it (default: .)")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument('--unix', type=str, help="listen on this Unix socket instead of TCP")
+    parser.add_argument('--cache-mb', type=int, default=512, help="size limit of each parsed object cache, in MB of estimated memory (default: 512)")
+    parser.add_argument('--minimap-cache-mb', type=int, default=64, help="size limit of the rendered minimap cache in MB (default: 64)")
+    parser.add_argument('--workers', type=int, default=4, help="number of parser threads (default: 4)")
+
+    args = parser.parse_args()
+
+    daemon = QueryDaemon(args.root, args.cache_mb << 20, args.minimap_cache_mb << 20, args.workers)
+    # the parsers report progress on stdout, which nobody reads here
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            asyncio.run(daemon.serve(args.host, args.port, args.unix))
+        except KeyboardInterrupt:
+            pass
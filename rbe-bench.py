@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+import sys
+import io
+import gzip
+import os
+import json
+import math
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+from pathlib import Path
+
+import numpy as np
+
+from dbtools import load_script
+
+rbe = load_script('rbe-parser')
+
+VERSIONS = [21, 22, 23, 24, 25, 26]
+ENTITY_NAMES = ['spawn', 'item_health', 'item_armor', 'weapon_rl', 'trigger', 'door', 'jumppad', 'teleporter']
+
+###################
+# SYNTHETIC MAPS  #
+###################
+
+# Everything is derived from the seed, so the same (version, size, seed) always
+# produces the same map and therefore the same bytes.
+def generate_map(ver, block_count, seed=0):
+    rng = random.Random(seed)
+
+    m = rbe.MapObject()
+    m.EmptyMap()
+    m.rebm = 'REBM'
+    m.ver = ver
+    m.u1 = 0
+    m.padding1 = 0
+    m.author_name = 'rbe-bench'
+    m.author_length = len(m.author_name)
+    m.padding2 = 0
+    m.u2 = 0
+    m.gzip_mtime = 0
+
+    m.materials = [{'name_len': len(n), 'name': n} for n in ('rock', 'grass', 'metal', 'glass')]
+    m.material_count = len(m.materials) + 1
+
+    # blocks fill a roughly cubic region in x/z, stacked upwards in y
+    side = max(1, math.ceil(math.sqrt(block_count / 8)))
+    i = np.arange(block_count)
+    coords = np.stack((i % side - side // 2, i // (side * side), (i // side) % side - side // 2), axis=1)
+    block_rng = np.random.default_rng(seed)
+    m.AddBlocks(coords,
+                block_type=block_rng.integers(1, 4, block_count),
+                mats=block_rng.integers(1, m.material_count, (block_count, 6)),
+                orient=block_rng.integers(0, 6, block_count))
+
+    for i in range(max(1, block_count // 100)):
+        name = rng.choice(ENTITY_NAMES)
+        properties = [
+            {'name_len': 6, 'name': 'target', 'val_len': 8, 'val': f'tgt{i:05d}'},
+            {'name_len': 4, 'name': 'team', 'val_len': 1, 'val': str(rng.randint(0, 1))},
+        ]
+        m.AddEntity(name,
+                    rng.uniform(-side, side), rng.uniform(0, 16), rng.uniform(-side, side),
+                    0.0, rng.choice([0.0, 90.0, 180.0, -90.0]), 0.0,
+                    properties=properties)
+
+    m.slices = []
+    for i in range(max(1, block_count // 50)):
+        m.slices.append({'sx': i % side, 'sy': i // side, 'sroom': rng.randint(0, 8), 'camera_hint': ''})
+    m.slice_count = len(m.slices)
+
+    m.audio_raw = []
+    for i in range(max(1, block_count // 200)):
+        children = [rng.randbytes(12) for _ in range(rng.randint(0, 4))]
+        m.audio_raw.append({'audio_raw': rng.randbytes(12), 'child_count': len(children), 'children': children})
+    m.audio_count = len(m.audio_raw)
+
+    # one minimap layer per 8 blocks of height, covering the block footprint
+    layer_count = max(1, min(8, block_count // (side * side * 8) + 1))
+    m.minimap_layers = []
+    for h in range(layer_count):
+        points = [(x - side // 2, z - side // 2)
+                  for x in range(side) for z in range(side) if rng.random() < 0.5]
+        points = np.array(points, dtype=np.int32).reshape(-1, 2)
+        m.minimap_layers.append({'height': h * 8, 'point_count': len(points), 'points': points})
+    m.minimap_layer_count = len(m.minimap_layers)
+    m.UpdateMinimapBounds()
+
+    m.level_hulls = [synthetic_plane_set(rng, i, '') for i in range(max(1, block_count // 200))]
+    m.level_hull_count = len(m.level_hulls)
+
+    m.moving_hull_groups = []
+    for i in range(max(1, block_count // 2000)):
+        name = f'mover{i}'
+        hulls = [synthetic_plane_set(rng, 100000 + i * 8 + j, name) for j in range(rng.randint(1, 4))]
+        m.moving_hull_groups.append({'name': name, 'hulls': hulls})
+    m.moving_hull_group_count = len(m.moving_hull_groups)
+
+    return m
+
+def synthetic_plane_set(rng, id, name):
+    origin = [rng.uniform(-512, 512) for _ in range(3)]
+    planes = []
+    for axis in range(3):
+        for sign in (1.0, -1.0):
+            normal = [0.0, 0.0, 0.0]
+            normal[axis] = sign
+            planes.append({'distance': rng.uniform(0, 64), 'normal': normal})
+    return {
+        'id':             id,
+        'max_radius':     rng.uniform(1, 128),
+        'origin':         origin,
+        'origin_orig':    list(origin),
+        'aabb_min':       [v - 16 for v in origin],
+        'block_pass':     rng.randint(0, 1),
+        'block_fire':     rng.randint(0, 1),
+        'aabb_extra':     [v + 16 for v in origin] + [rng.uniform(0, 32) for _ in range(3)],
+        'clip':           rng.randint(0, 3),
+        'collision_mask': rng.randint(0, 255),
+        'name':           name,
+        'slide_type':     0,
+        'is_stairs':      0,
+        'stairs_yaw':     0.0,
+        'has_target':     1 if name else 0,
+        'planes':         planes,
+    }
+
+def corpus_name(ver, block_count):
+    return f'synthetic_v{ver}_{block_count}.rbe'
+
+def generate_corpus(dst, versions, sizes, seed):
+    dst = Path(dst)
+    os.makedirs(dst, exist_ok=True)
+    files = []
+    for ver in versions:
+        for size in sizes:
+            path = dst / corpus_name(ver, size)
+            generate_map(ver, size, seed).Save(path)
+            print(f"{path}\t{path.stat().st_size}")
+            files.append(path)
+    return files
+
+#############
+# BENCHMARK #
+#############
+
+def timed(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        t = time.perf_counter() - t0
+        best = t if best is None or t < best else best
+    return best, result
+
+# The header followed by the inflated body. Official maps were compressed by the
+# game with different zlib settings, so only the decoded bytes can match.
+def map_bytes(path):
+    data = Path(path).read_bytes()
+    ver = int.from_bytes(data[4:8], 'little', signed=True)
+    if ver <= 21:
+        return data
+    header_end = 20 + int.from_bytes(data[16:20], 'little', signed=True) + 8
+    return data[:header_end] + gzip.decompress(data[header_end:])
+
+def bench_file(path, repeat, tmp_dir):
+    path = Path(path)
+    size = path.stat().st_size
+    quiet = io.StringIO()
+
+    def load():
+        m = rbe.MapObject()
+        with contextlib.redirect_stdout(quiet):
+            m.Load(path)
+        return m
+
+    load_s, m = timed(load, repeat)
+
+    out = Path(tmp_dir) / path.name
+    save_s, _ = timed(lambda: m.Save(out), repeat)
+    roundtrip = map_bytes(out) == map_bytes(path)
+
+    json_s, dumped = timed(lambda: json.dumps(m.JsonFields(), ensure_ascii=False, cls=rbe.BytesEncoder), repeat)
+
+    try:
+        import PIL
+        minimap_s, _ = timed(lambda: m.DrawMinimap(str(Path(tmp_dir) / path.stem)), repeat)
+    except ImportError:
+        minimap_s = None
+
+    return {
+        'file': path.name,
+        'version': m.ver,
+        'bytes': size,
+        'blocks': m.block_count,
+        'entities': m.entity_count,
+        'hulls': m.level_hull_count + sum(len(g['hulls']) for g in m.moving_hull_groups),
+        'minimap_points': sum(ly['point_count'] for ly in m.minimap_layers),
+        'load_s': load_s,
+        'save_s': save_s,
+        'json_s': json_s,
+        'minimap_s': minimap_s,
+        'load_blocks_per_s': m.block_count / load_s if load_s else None,
+        'save_blocks_per_s': m.block_count / save_s if save_s else None,
+        'json_mb_per_s': len(dumped) / json_s / 1e6 if json_s else None,
+        'roundtrip_equal': roundtrip,
+    }
+
+def print_table(results):
+    cols = ['file', 'blocks', 'load_s', 'save_s', 'json_s', 'minimap_s', 'load_blocks_per_s', 'roundtrip_equal']
+    print('\t'.join(cols))
+    for r in results:
+        row = []
+        for c in cols:
+            v = r[c]
+            if isinstance(v, float):
+                v = f'{v:.4f}' if v < 1000 else f'{v:.0f}'
+            row.append(str(v))
+        print('\t'.join(row))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='rbe-bench.py', description="synthetic .rbe map generator and rbe-parser benchmark")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_gen = subparsers.add_parser('generate', aliases=['g'], help='write a synthetic map corpus')
+    parser_gen.add_argument('destination', type=str, help="destination directory")
+
+    parser_run = subparsers.add_parser('run', aliases=['r'], help='benchmark rbe-parser on synthetic maps')
+    parser_run.add_argument('maps', nargs='*', default=[], help="existing .rbe files to benchmark instead of a generated corpus")
+    parser_run.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best one is reported (default: 3)")
+    parser_run.add_argument('--json', type=str, help="also write the results to this JSON file")
+
+    for p in (parser_gen, parser_run):
+        p.add_argument('--versions', type=int, nargs='+', default=VERSIONS, help="map format versions (default: 21-26)")
+        p.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help="block counts per map (default: 1000 10000 50000)")
+        p.add_argument('--seed', type=int, default=0, help="random seed")
+
+    if len(sys.argv)==1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    if args.command.startswith("g"):
+        generate_corpus(args.destination, args.versions, args.sizes, args.seed)
+        print("DONE")
+
+    elif args.command.startswith("r"):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            maps = args.maps
+            if not maps:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    maps = generate_corpus(Path(tmp_dir) / 'corpus', args.versions, args.sizes, args.seed)
+
+            results = [bench_file(path, args.repeat, tmp_dir) for path in maps]
+
+        print_table(results)
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=4)
+
+        if not all(r['roundtrip_equal'] for r in results):
+            print("ERROR: round trip changed at least one map")
+            sys.exit(1)
@@ -26,62 +26,194 @@ import colorsys
 import gzip
 import json
 import argparse
+import contextlib
+import functools
+import time
+import tracemalloc
 from io import BytesIO
 from pathlib import Path, PureWindowsPath
 
+import numpy as np
+
+from dbtools.binary import BinaryCursor, BinaryWriter
+from dbtools.sources import read_source, source_arg
+
 class MapObject:
 
     # TODO before organizing the architecture/porting:
     ############
-    # AddBlocks(xyz, xyz) ----- Array or box
     # addTeleporter(xyz entrance, w, h, xyz exit, dir)
     # Set target
     # Set action
     # Clear properties
-    # Delete blocks
     # Delete entity
     # https://liquipedia.net/arenafps/Diabotical_map_editing
 
+    # Blocks are kept in one numpy structured array (BLOCK_DTYPE), so the bulk
+    # operations below work on whole coordinate arrays at once. AddBlock() has
+    # to copy the array for every call; use AddBlocks()/FillBox() for anything
+    # bigger than a handful of blocks.
+
     ##############
     # ADD: BLOCK #
     ##############
     def AddBlock(self, x, y, z, block_type=1, mats=None, mat_offs=None, orient=2):
-        self.block_count += 1
-
-        if mats == None:
-            mats = {
-                'front': 1,
-                'left': 1,
-                'back': 1,
-                'right': 1,
-                'top': 1,
-                'bottom': 1
-            }
-
-        if mat_offs == None:
-            mat_offs = {
-                'front': {'x': 0, 'y': 0},
-                'left': {'x': 0, 'y': 0},
-                'back': {'x': 0, 'y': 0},
-                'right': {'x': 0, 'y': 0},
-                'top': {'x': 0, 'y': 0},
-                'bottom': {'x': 0, 'y': 0}
-            }
-
-        newBlock = {
-            'x': x,
-            'y': y,
-            'z': z,
-            'type': block_type,
-            'u1': 0,
-            'mats': mats,
-            'u2': 0,
-            'mat_offs': mat_offs,
-            'orient': orient,
-            'u3': 0,
-            'u4': 0
-        }
-        self.blocks.append(newBlock)
+        if mats != None:
+            mats = [mats[face] for face in FACES]
+        if mat_offs != None:
+            mat_offs = [[mat_offs[face]['x'], mat_offs[face]['y']] for face in FACES]
+        self.AddBlocks([(x, y, z)], block_type, mats, mat_offs, orient)
+
+    ###############
+    # ADD: BLOCKS #
+    ###############
+    # coords is an (n, 3) array of x, y, z. Every other argument is either one
+    # value for all blocks or one value per block: mats is (6,) or (n, 6) in
+    # FACES order, mat_offs is (6, 2) or (n, 6, 2). Existing blocks at the same
+    # coordinates are replaced, like placing a block in the editor would.
+    def AddBlocks(self, coords, block_type=1, mats=None, mat_offs=None, orient=2):
+        coords = np.asarray(coords, dtype=np.int32).reshape(-1, 3)
+
+        new = np.zeros(len(coords), dtype=BLOCK_DTYPE)
+        new['x'] = coords[:, 0]
+        new['y'] = coords[:, 1]
+        new['z'] = coords[:, 2]
+        new['type'] = block_type
+        new['mats'] = 1 if mats is None else mats
+        new['mat_offs'] = 0 if mat_offs is None else mat_offs
+        new['orient'] = orient
+
+        # the last of several new blocks on the same cell wins
+        keys = packCoords(new)
+        _, last = np.unique(keys[::-1], return_index=True)
+        keep = np.sort(len(new) - 1 - last)
+        new = new[keep]
+
+        existing = np.isin(packCoords(self.blocks), keys[keep])
+        self.blocks = np.concatenate((self.blocks[~existing], new))
+        self.UpdateBounds()
+        return len(new)
+
+    ############
+    # FILL BOX #
+    ############
+    # Fills every cell from min_xyz to max_xyz (both inclusive). Extra keyword
+    # arguments are passed on to AddBlocks().
+    def FillBox(self, min_xyz, max_xyz, **kwargs):
+        return self.AddBlocks(boxCoords(min_xyz, max_xyz), **kwargs)
+
+    ##############
+    # HOLLOW BOX #
+    ##############
+    # Only the walls, floor and ceiling of the box, `thickness` cells deep.
+    def HollowBox(self, min_xyz, max_xyz, thickness=1, **kwargs):
+        coords = boxCoords(min_xyz, max_xyz)
+        lo = np.minimum(min_xyz, max_xyz) + thickness
+        hi = np.maximum(min_xyz, max_xyz) - thickness
+        inside = np.all((coords >= lo) & (coords <= hi), axis=1)
+        return self.AddBlocks(coords[~inside], **kwargs)
+
+    ##############
+    # DELETE BOX #
+    ##############
+    def DeleteBox(self, min_xyz, max_xyz):
+        return self.DeleteBlocks(self.SelectBox(min_xyz, max_xyz))
+
+    def DeleteBlocks(self, where):
+        mask = self.SelectionMask(where)
+        self.blocks = self.blocks[~mask]
+        self.UpdateBounds()
+        return int(mask.sum())
+
+    ##############
+    # SELECTIONS #
+    ##############
+    # A selection ("where") is None for all blocks, a boolean mask or index
+    # array over self.blocks, or a (min_xyz, max_xyz) box. Boxes have to be a
+    # tuple; anything else that isn't one-dimensional is rejected rather than
+    # guessed at, so a box given as a list can't delete blocks by index.
+    def SelectBox(self, min_xyz, max_xyz):
+        lo = np.minimum(min_xyz, max_xyz)
+        hi = np.maximum(min_xyz, max_xyz)
+        b = self.blocks
+        return ((b['x'] >= lo[0]) & (b['x'] <= hi[0]) &
+                (b['y'] >= lo[1]) & (b['y'] <= hi[1]) &
+                (b['z'] >= lo[2]) & (b['z'] <= hi[2]))
+
+    def SelectionMask(self, where):
+        if where is None:
+            return np.ones(len(self.blocks), dtype=bool)
+        if isinstance(where, tuple) and len(where) == 2 and np.shape(where[0]) == (3,):
+            return self.SelectBox(*where)
+        where = np.asarray(where)
+        if where.ndim != 1:
+            raise ValueError(f"selection of shape {where.shape}: expected a mask or index array, "
+                             "or a box as a (min_xyz, max_xyz) tuple")
+        if where.dtype == bool:
+            if len(where) != len(self.blocks):
+                raise ValueError(f"mask of length {len(where)} for {len(self.blocks)} blocks")
+            return where
+        mask = np.zeros(len(self.blocks), dtype=bool)
+        mask[where] = True
+        return mask
+
+    ####################
+    # REPLACE MATERIAL #
+    ####################
+    # Sets material `new` on the given face(s) (a name from FACES, a list of
+    # them, or None for all six) of the selected blocks. With `old`, only faces
+    # that currently use material `old` are changed.
+    def ReplaceMaterial(self, where, face, new, old=None):
+        faces = FACES if face is None else [face] if isinstance(face, str) else face
+        cols = [FACES.index(fc) for fc in faces]
+        cells = np.ix_(np.flatnonzero(self.SelectionMask(where)), cols)
+
+        mats = self.blocks['mats'][cells]
+        hit = np.ones(mats.shape, dtype=bool) if old is None else mats == old
+        mats[hit] = new
+        self.blocks['mats'][cells] = mats
+        return int(hit.sum())
+
+    ######################
+    # TRANSLATE / ROTATE #
+    ######################
+    def TranslateBlocks(self, offset, where=None):
+        mask = self.SelectionMask(where)
+        moved = self.blocks[mask]
+        for axis, d in zip('xyz', offset):
+            moved[axis] += d
+        return self._placeMoved(mask, moved)
+
+    # Rotates the selection by `turns` quarter turns around the vertical (y)
+    # axis through `origin`; each turn maps +x onto +z. The side faces are stored in rotation order
+    # (front, left, back, right), so their materials and offsets are cycled
+    # along with the coordinates.
+    def RotateBlocks(self, turns, origin=(0, 0, 0), where=None):
+        turns %= 4
+        mask = self.SelectionMask(where)
+        moved = self.blocks[mask]
+        x = moved['x'] - origin[0]
+        z = moved['z'] - origin[2]
+        for _ in range(turns):
+            x, z = -z, x
+        moved['x'] = x + origin[0]
+        moved['z'] = z + origin[2]
+        order = [(i - turns) % 4 for i in range(4)] + [4, 5]
+        moved['mats'] = moved['mats'][:, order]
+        moved['mat_offs'] = moved['mat_offs'][:, order]
+        return self._placeMoved(mask, moved)
+
+    # moved blocks overwrite whatever stayed behind at their new position
+    def _placeMoved(self, mask, moved):
+        rest = self.blocks[~mask]
+        rest = rest[~np.isin(packCoords(rest), packCoords(moved))]
+        self.blocks = np.concatenate((rest, moved))
+        self.UpdateBounds()
+        return len(moved)
+
+    def UpdateBounds(self):
+        self.block_count = len(self.blocks)
+        self.bounds = blockBounds(self.blocks)
 
     ###############
     # ADD: ENTITY #
@@ -105,6 +237,24 @@ class MapObject:
         }
         self.entities.append(newEnt)
 
+    #####################
+    # ENTITY TRANSFORMS #
+    #####################
+    # The transforms of all entities as an (n, 9) float32 array of x, y, z,
+    # xrot, yrot, zrot, xscale, yscale, zscale, with the rotations in radians
+    # like in the file, for vectorised queries over positions and rotations.
+    # Load() decodes it along with the entities and it is rebuilt when entities
+    # were added or removed; after editing transforms in the entity dicts, pass
+    # refresh=True.
+    def EntityTransforms(self, refresh=False):
+        t = getattr(self, 'entity_transforms', None)
+        if refresh or t is None or len(t) != len(self.entities):
+            t = np.array([[e['x'], e['y'], e['z'], e['xrot'], e['yrot'], e['zrot'], e['xscale'], e['yscale'], e['zscale']]
+                          for e in self.entities], dtype=np.float64).reshape(-1, 9)
+            t[:, 3:6] = degToRad(t[:, 3:6])
+            t = self.entity_transforms = t.astype(np.float32)
+        return t
+
     ##################
     # FIND: ENTITIES #
     ##################
@@ -118,237 +268,172 @@ class MapObject:
     ###########################
     # LOAD & PARSE A MAP FILE #
     ###########################
-    def Load(self, f):
+    def Load(self, f, profiler=None):
+        prof = profiler if profiler is not None else NullProfiler()
+
+        # f is a path, a pack entry ('pack.dbp::maps\name.rbe') or the file's bytes
+        f = BinaryCursor(read_source(f))
 
-        with open(f, 'rb') as f:
-            self.rebm               = f.read(4).decode("utf-8")
-            self.ver                = decodeInt(f.read(4))
-            self.u1                 = decodeInt(f.read(4))
+        with prof.section('load', 'header', f) as sec:
+            self.rebm               = f.read_text(4)
+            self.ver                = f.i32()
+            self.u1                 = f.i32()
 
             print(f"Map Format Version: {self.ver}")
 
-            self.padding1         = decodeInt(f.read(4))
+            self.padding1         = f.i32()
 
             if self.ver > 21:
-              self.author_length    = decodeInt(f.read(4))
-              self.author_name      = f.read(self.author_length).decode("utf-8")
-              self.padding2         = decodeInt(f.read(8))
-
-              f = gzip.GzipFile(fileobj=f)
-
-            self.material_count     = decodeInt(f.read(1))
+              self.author_length    = f.i32()
+              self.author_name      = f.read_text(self.author_length)
+              self.padding2         = f.i64()
+
+        if self.ver > 21:
+            # inflate the whole body up front so decompression is accounted
+            # for on its own rather than spread over every section below
+            with prof.section('load', 'decompress', f) as sec:
+                gz = gzip.GzipFile(fileobj=BytesIO(f.read_rest()))
+                body = gz.read()
+                sec['bytes_out'] = len(body)
+            # kept so Save() can reproduce the gzip header byte for byte
+            self.gzip_mtime = gz.mtime
+            f = BinaryCursor(body)
+
+        with prof.section('load', 'materials', f) as sec:
+            self.material_count     = f.i8()
             self.materials          = []
             for i in range(self.material_count - 1):
-                c = decodeInt(f.read(4))
+                c = f.i32()
                 m = {
                     'name_len': c,
-                    'name':     f.read(c).decode("utf-8")
+                    'name':     f.read_text(c)
                     }
                 self.materials.append(m)
 
-            self.u2                 = decodeInt(f.read(4))
-
-            self.bounds = {'minx': 0.0, 'maxx': 0.0, 'miny': 0.0, 'maxy': 0.0,  'minz': 0.0, 'maxz': 0.0}
-
-            print(f"block_count offset: 0x{f.tell():08x}")
-            self.block_count        = decodeInt(f.read(4))
-
-            self.blocks             = []
-            for i in range(self.block_count): # 53 bytes per block
-                b = {
-                    'x':        decodeInt(f.read(4)),
-                    'y':        decodeInt(f.read(4)),
-                    'z':        decodeInt(f.read(4)),
-                    'type':     decodeInt(f.read(1)),
-                    'u1':       decodeInt(f.read(12)),
-                    'mats':     {
-                        'front': decodeInt(f.read(1)),
-                        'left': decodeInt(f.read(1)),
-                        'back': decodeInt(f.read(1)),
-                        'right': decodeInt(f.read(1)),
-                        'top': decodeInt(f.read(1)),
-                        'bottom': decodeInt(f.read(1)),
-                    },
-                    'u2':       decodeInt(f.read(1)),
-                    'mat_offs': { # like a position on a sprite sheet
-                        'front': {
-                            'x': decodeInt(f.read(1)),
-                            'y': decodeInt(f.read(1))
-                        },
-                        'left': {
-                            'x': decodeInt(f.read(1)),
-                            'y': decodeInt(f.read(1))
-                        },
-                        'back': {
-                            'x': decodeInt(f.read(1)),
-                            'y': decodeInt(f.read(1))
-                        },
-                        'right': {
-                            'x': decodeInt(f.read(1)),
-                            'y': decodeInt(f.read(1))
-                        },
-                        'top': {
-                            'x': decodeInt(f.read(1)),
-                            'y': decodeInt(f.read(1))
-                        },
-                        'bottom': {
-                            'x': decodeInt(f.read(1)),
-                            'y': decodeInt(f.read(1))
-                        },
-                    },
-                }
+            self.u2                 = f.i32()
+            sec['records'] = len(self.materials)
 
-                if self.ver > 24:
-                  b['u3'] = decodeInt(f.read(6))
-                  b['orient'] = decodeInt(f.read(1))
-                  b['u4'] = decodeInt(f.read(2))
-                else:
-                  b['orient'] = decodeInt(f.read(1))
-                  b['u3'] = decodeInt(f.read(1))
-
-                self.blocks.append(b)
-                self.bounds['minx'] = b['x'] if b['x'] < self.bounds['minx'] or self.bounds['minx'] == 0 else self.bounds['minx']
-                self.bounds['maxx'] = b['x'] if b['x'] > self.bounds['maxx'] or self.bounds['maxx'] == 0 else self.bounds['maxx']
-                self.bounds['miny'] = b['y'] if b['y'] < self.bounds['miny'] or self.bounds['miny'] == 0 else self.bounds['miny']
-                self.bounds['maxy'] = b['y'] if b['y'] > self.bounds['maxy'] or self.bounds['maxy'] == 0 else self.bounds['maxy']
-                self.bounds['minz'] = b['z'] if b['z'] < self.bounds['minz'] or self.bounds['minz'] == 0 else self.bounds['minz']
-                self.bounds['maxz'] = b['z'] if b['z'] > self.bounds['maxz'] or self.bounds['maxz'] == 0 else self.bounds['maxz']
-
-            # 2D slices (BlockInfo2d): per-cell room id + optional camera hint
-            print(f"slice_count offset: 0x{f.tell():08x}")
-            self.slice_count        = decodeInt(f.read(4))
+        print(f"block_count offset: 0x{f.tell():08x}")
+        with prof.section('load', 'blocks', f) as sec:
+            self.block_count        = f.i32()
+            self.blocks             = readBlocks(f, self.ver, self.block_count)
+            self.UpdateBounds()
+            sec['records'] = self.block_count
+
+        # 2D slices (BlockInfo2d): per-cell room id + optional camera hint
+        print(f"slice_count offset: 0x{f.tell():08x}")
+        with prof.section('load', 'slices', f) as sec:
+            self.slice_count        = f.i32()
             self.slices             = []
             for i in range(self.slice_count):
                 s = {
-                    'sx':    decodeInt(f.read(4)),
-                    'sy':    decodeInt(f.read(4)),
-                    'sroom': decodeInt(f.read(4)),
+                    'sx':    f.i32(),
+                    'sy':    f.i32(),
+                    'sroom': f.i32(),
                 }
                 if self.ver > 11:
-                    c = decodeInt(f.read(4))
-                    s['camera_hint'] = f.read(c).decode("utf-8")
+                    c = f.i32()
+                    s['camera_hint'] = f.read_text(c)
                 self.slices.append(s)
-
-            print(f"entity_count offset: 0x{f.tell():08x}")
-            self.entity_count       = decodeInt(f.read(4))
-            self.entities           = []
-            for i in range(self.entity_count):
-                c = decodeInt(f.read(4))
-                e = {
-                    'name_len': c,
-                    'name':     f.read(c).decode("utf-8"),
-                    'x':        decodeFloat(f.read(4)),
-                    'y':        decodeFloat(f.read(4)),
-                    'z':        decodeFloat(f.read(4)),
-                    'xrot':     radToDeg(decodeFloat(f.read(4))),
-                    'yrot':     radToDeg(decodeFloat(f.read(4))),
-                    'zrot':     radToDeg(decodeFloat(f.read(4))),
-                    'xscale':   decodeFloat(f.read(4)),
-                    'yscale':   decodeFloat(f.read(4)),
-                    'zscale':   decodeFloat(f.read(4)),
-                }
-                e['property_count']         = decodeInt(f.read(4))
-                e['properties']             = []
-                for j in range(e['property_count']):
-                    p = {}
-                    c = decodeInt(f.read(4))
-                    p['name_len'] = c
-                    p['name'] = f.read(c).decode("utf-8")
-                    c = decodeInt(f.read(4))
-                    p['val_len'] = c
-                    p['val'] = f.read(c).decode("utf-8")
-                    e['properties'].append(p)
-                self.entities.append(e)
-
-            # audio propagation graph: per-node grid coord + connected coords
-            print(f"audio_count offset: 0x{f.tell():08x}")
-            self.audio_count        = decodeInt(f.read(4))
+            sec['records'] = self.slice_count
+
+        print(f"entity_count offset: 0x{f.tell():08x}")
+        with prof.section('load', 'entities', f) as sec:
+            self.entity_count       = f.i32()
+            self.entities, self.entity_transforms = readEntities(f, self.entity_count)
+            sec['records'] = self.entity_count
+
+        # audio propagation graph: per-node grid coord + connected coords
+        print(f"audio_count offset: 0x{f.tell():08x}")
+        with prof.section('load', 'audio', f) as sec:
+            self.audio_count        = f.i32()
             self.audio_raw          = []
             for i in range(self.audio_count):
                 a = {
-                    'audio_raw': f.read(12),
-                    'child_count': decodeInt(f.read(4)),
+                    'audio_raw': f.read_bytes(12),
+                    'child_count': f.i32(),
                     'children': []
                 }
                 for j in range(a['child_count']):
-                    a['children'].append(f.read(12))
+                    a['children'].append(f.read_bytes(12))
                 self.audio_raw.append(a)
-
-            # navmesh: length-prefixed Detour blob (kept raw; 0 bytes on most maps)
-            print(f"navigation_size offset: 0x{f.tell():08x}")
-            self.navigation_size    = decodeInt(f.read(4))
-            self.navmesh            = f.read(self.navigation_size)
-
-            # discovery / per-height-level cells (what the minimap is drawn from)
-            print(f"minimap_layer_count offset: 0x{f.tell():08x}")
-            self.minimap_bounds = { 'minx': 0.0, 'maxx': 0.0, 'miny': 0.0, 'maxy': 0.0 }
-            self.minimap_layer_count    = decodeInt(f.read(4))
+            sec['records'] = self.audio_count
+
+        # navmesh: length-prefixed Detour blob (kept raw; 0 bytes on most maps)
+        print(f"navigation_size offset: 0x{f.tell():08x}")
+        with prof.section('load', 'navmesh', f) as sec:
+            self.navigation_size    = f.i32()
+            self.navmesh            = f.read_bytes(self.navigation_size)
+
+        # discovery / per-height-level cells (what the minimap is drawn from)
+        print(f"minimap_layer_count offset: 0x{f.tell():08x}")
+        with prof.section('load', 'minimap', f) as sec:
+            self.minimap_layer_count    = f.i32()
             self.minimap_layers         = []
             for i in range(self.minimap_layer_count):
+                height = f.i32()
+                point_count = f.i32()
                 ly = {
-                    'height': decodeInt(f.read(4)),
-                    'point_count': decodeInt(f.read(4)),
-                    'points': []
+                    'height': height,
+                    'point_count': point_count,
+                    'points': readMinimapPoints(f, point_count)
                 }
-                for j in range(ly['point_count']):
-                    p = {
-                        'x': decodeInt(f.read(4)),
-                        'y': decodeInt(f.read(4))
-                    }
-                    ly['points'].append(p)
-                    self.minimap_bounds['minx'] = p['x'] if p['x'] < self.minimap_bounds['minx'] or self.minimap_bounds['minx'] == 0 else self.minimap_bounds['minx']
-                    self.minimap_bounds['maxx'] = p['x'] if p['x'] > self.minimap_bounds['maxx'] or self.minimap_bounds['maxx'] == 0 else self.minimap_bounds['maxx']
-                    self.minimap_bounds['miny'] = p['y'] if p['y'] < self.minimap_bounds['miny'] or self.minimap_bounds['miny'] == 0 else self.minimap_bounds['miny']
-                    self.minimap_bounds['maxy'] = p['y'] if p['y'] > self.minimap_bounds['maxy'] or self.minimap_bounds['maxy'] == 0 else self.minimap_bounds['maxy']
                 self.minimap_layers.append(ly)
-
-            # level collision hulls (static geometry players/projectiles hit)
-            self.level_hull_count   = 0
-            self.level_hulls        = []
-            if self.ver > 17:
-                print(f"level_hull_count offset: 0x{f.tell():08x}")
-                self.level_hull_count   = decodeInt(f.read(4))
-                for i in range(self.level_hull_count):
-                    self.level_hulls.append(readPlaneSet(f, self.ver))
-
-            # moving-entity collision hulls (grouped per entity: movers, doors, liquids)
-            self.moving_hull_group_count = 0
-            self.moving_hull_groups      = []
-            if self.ver > 20:
-                print(f"moving_hull_group_count offset: 0x{f.tell():08x}")
-                self.moving_hull_group_count = decodeInt(f.read(4))
+            self.UpdateMinimapBounds()
+            sec['records'] = sum(ly['point_count'] for ly in self.minimap_layers)
+
+        # level collision hulls (static geometry players/projectiles hit)
+        self.level_hull_count   = 0
+        self.level_hulls        = []
+        if self.ver > 17:
+            print(f"level_hull_count offset: 0x{f.tell():08x}")
+            with prof.section('load', 'level_hulls', f) as sec:
+                self.level_hull_count   = f.i32()
+                self.level_hulls        = readPlaneSets(f, self.ver, self.level_hull_count)
+                sec['records'] = self.level_hull_count
+
+        # moving-entity collision hulls (grouped per entity: movers, doors, liquids)
+        self.moving_hull_group_count = 0
+        self.moving_hull_groups      = []
+        if self.ver > 20:
+            print(f"moving_hull_group_count offset: 0x{f.tell():08x}")
+            with prof.section('load', 'moving_hulls', f) as sec:
+                self.moving_hull_group_count = f.i32()
                 for i in range(self.moving_hull_group_count):
-                    c = decodeInt(f.read(4))
+                    c = f.i32()
                     g = {
-                        'name':  f.read(c).decode("utf-8"),
-                        'hulls': []
+                        'name':  f.read_text(c),
                     }
-                    planeset_count = decodeInt(f.read(4))
-                    for j in range(planeset_count):
-                        g['hulls'].append(readPlaneSet(f, self.ver))
+                    planeset_count = f.i32()
+                    g['hulls'] = readPlaneSets(f, self.ver, planeset_count)
                     self.moving_hull_groups.append(g)
+                sec['records'] = sum(len(g['hulls']) for g in self.moving_hull_groups)
 
-            # Should be empty on all known versions; preserved so unknown trailing
-            # data from a future map format still round-trips through Save().
-            self.trailing = f.read()
-            if len(self.trailing):
-                print(f"warning: {len(self.trailing)} unparsed trailing bytes preserved")
+        # Should be empty on all known versions; preserved so unknown trailing
+        # data from a future map format still round-trips through Save().
+        with prof.section('load', 'trailing', f) as sec:
+            self.trailing = f.read_rest().tobytes()
+        if len(self.trailing):
+            print(f"warning: {len(self.trailing)} unparsed trailing bytes preserved")
 
     def EmptyMap(self):
         self.material_count = 0
         self.materials = []
         self.block_count = 0
-        self.blocks = []
+        self.blocks = np.zeros(0, dtype=BLOCK_DTYPE)
+        self.bounds = {'minx': 0, 'maxx': 0, 'miny': 0, 'maxy': 0, 'minz': 0, 'maxz': 0}
         self.slice_count = 0
         self.slices = []
         self.entity_count = 0
         self.entities = []
+        self.entity_transforms = np.zeros((0, 9), dtype=np.float32)
         self.audio_count = 0
         self.audio_raw = []
         self.navigation_size = 0
         self.navmesh = bytearray()
         self.minimap_layer_count = 0
         self.minimap_layers = []
+        self.UpdateMinimapBounds()
         self.level_hull_count = 0
         self.level_hulls = []
         self.moving_hull_group_count = 0
@@ -358,252 +443,777 @@ class MapObject:
     ##########################
     # PACK & SAVE A MAP FILE #
     ##########################
-    def Save(self, f):
+    def Save(self, f, profiler=None):
+        prof = profiler if profiler is not None else NullProfiler()
 
-        gf = BytesIO()  # the decompressed body
-        if True:
-            gf.write(encodeInt(self.material_count, 1))
+        gf = BinaryWriter()  # the decompressed body
+        with prof.section('save', 'materials', gf) as sec:
+            gf.i8(self.material_count)
             for m in self.materials:
-                gf.write(encodeInt(m['name_len'], 4))
-                gf.write(encodeString(m['name']))
-
-            gf.write(encodeInt(self.u2, 4))
-
-            gf.write(encodeInt(self.block_count, 4))
-            for b in self.blocks:
-                gf.write(encodeInt(b['x'], 4))
-                gf.write(encodeInt(b['y'], 4))
-                gf.write(encodeInt(b['z'], 4))
-                gf.write(encodeInt(b['type'], 1))
-                gf.write(encodeInt(b['u1'], 12))
-                gf.write(encodeInt(b['mats']['front'], 1))
-                gf.write(encodeInt(b['mats']['left'], 1))
-                gf.write(encodeInt(b['mats']['back'], 1))
-                gf.write(encodeInt(b['mats']['right'], 1))
-                gf.write(encodeInt(b['mats']['top'], 1))
-                gf.write(encodeInt(b['mats']['bottom'], 1))
-                gf.write(encodeInt(b['u2'], 1))
-                gf.write(encodeInt(b['mat_offs']['front']['x'], 1))
-                gf.write(encodeInt(b['mat_offs']['front']['y'], 1))
-                gf.write(encodeInt(b['mat_offs']['left']['x'], 1))
-                gf.write(encodeInt(b['mat_offs']['left']['y'], 1))
-                gf.write(encodeInt(b['mat_offs']['back']['x'], 1))
-                gf.write(encodeInt(b['mat_offs']['back']['y'], 1))
-                gf.write(encodeInt(b['mat_offs']['right']['x'], 1))
-                gf.write(encodeInt(b['mat_offs']['right']['y'], 1))
-                gf.write(encodeInt(b['mat_offs']['top']['x'], 1))
-                gf.write(encodeInt(b['mat_offs']['top']['y'], 1))
-                gf.write(encodeInt(b['mat_offs']['bottom']['x'], 1))
-                gf.write(encodeInt(b['mat_offs']['bottom']['y'], 1))
-
-                if self.ver > 24:
-                  gf.write(encodeInt(b['u3'], 6))
-                  gf.write(encodeInt(b['orient'], 1))
-                  gf.write(encodeInt(b['u4'], 2))
-                else:
-                  gf.write(encodeInt(b['orient'], 1))
-                  gf.write(encodeInt(b['u3'], 1))
-
-
-
-            gf.write(encodeInt(self.slice_count, 4))
+                gf.i32(m['name_len'])
+                gf.write(m['name'].encode())
+
+            gf.i32(self.u2)
+            sec['records'] = len(self.materials)
+
+        with prof.section('save', 'blocks', gf) as sec:
+            gf.i32(self.block_count)
+            writeBlocks(gf, self.blocks, self.ver)
+            sec['records'] = len(self.blocks)
+
+        with prof.section('save', 'slices', gf) as sec:
+            gf.i32(self.slice_count)
             for s in self.slices:
-                gf.write(encodeInt(s['sx'], 4))
-                gf.write(encodeInt(s['sy'], 4))
-                gf.write(encodeInt(s['sroom'], 4))
+                gf.i32(s['sx'])
+                gf.i32(s['sy'])
+                gf.i32(s['sroom'])
                 if self.ver > 11:
-                    hint = encodeString(s.get('camera_hint', ''))
-                    gf.write(encodeInt(len(hint), 4))
-                    gf.write(hint)
+                    gf.write_string(s.get('camera_hint', ''))
+            sec['records'] = len(self.slices)
 
-            gf.write(encodeInt(self.entity_count, 4))
+        with prof.section('save', 'entities', gf) as sec:
+            gf.i32(self.entity_count)
             for e in self.entities:
-                gf.write(encodeInt(e['name_len'], 4))
-                gf.write(encodeString(e['name']))
-                gf.write(encodeFloat(e['x']))
-                gf.write(encodeFloat(e['y']))
-                gf.write(encodeFloat(e['z']))
-                gf.write(encodeFloat(degToRad(e['xrot'])))
-                gf.write(encodeFloat(degToRad(e['yrot'])))
-                gf.write(encodeFloat(degToRad(e['zrot'])))
-                gf.write(encodeFloat(e['xscale']))
-                gf.write(encodeFloat(e['yscale']))
-                gf.write(encodeFloat(e['zscale']))
-                gf.write(encodeInt(e['property_count'], 4))
+                gf.i32(e['name_len'])
+                gf.write(e['name'].encode())
+                gf.write_struct(ENTITY_TRANSFORM, e['x'], e['y'], e['z'],
+                                degToRad(e['xrot']), degToRad(e['yrot']), degToRad(e['zrot']),
+                                e['xscale'], e['yscale'], e['zscale'])
+                gf.i32(e['property_count'])
                 for p in e['properties']:
-                    gf.write(encodeInt(p['name_len'], 4))
-                    gf.write(encodeString(p['name']))
-                    gf.write(encodeInt(p['val_len'], 4))
-                    gf.write(encodeString(p['val']))
-
-            gf.write(encodeInt(self.audio_count, 4))
+                    gf.i32(p['name_len'])
+                    gf.write(p['name'].encode())
+                    gf.i32(p['val_len'])
+                    gf.write(p['val'].encode())
+            sec['records'] = len(self.entities)
+
+        with prof.section('save', 'audio', gf) as sec:
+            gf.i32(self.audio_count)
             for a in self.audio_raw:
                 gf.write(a['audio_raw'])
-                gf.write(encodeInt(a['child_count'], 4))
+                gf.i32(a['child_count'])
                 for c in a['children']:
                     gf.write(c)
+            sec['records'] = len(self.audio_raw)
 
-            gf.write(encodeInt(self.navigation_size, 4))
+        with prof.section('save', 'navmesh', gf) as sec:
+            gf.i32(self.navigation_size)
             gf.write(self.navmesh)
 
-            gf.write(encodeInt(self.minimap_layer_count, 4))
+        with prof.section('save', 'minimap', gf) as sec:
+            gf.i32(self.minimap_layer_count)
             for ly in self.minimap_layers:
-                gf.write(encodeInt(ly['height'], 4))
-                gf.write(encodeInt(ly['point_count'], 4))
-                for p in ly['points']:
-                    gf.write(encodeInt(p['x'], 4))
-                    gf.write(encodeInt(p['y'], 4))
-
-            if self.ver > 17:
-                gf.write(encodeInt(self.level_hull_count, 4))
+                gf.i32(ly['height'])
+                gf.i32(ly['point_count'])
+                gf.write(np.asarray(ly['points'], dtype='<i4').tobytes())
+            sec['records'] = sum(len(ly['points']) for ly in self.minimap_layers)
+
+        if self.ver > 17:
+            with prof.section('save', 'level_hulls', gf) as sec:
+                gf.i32(self.level_hull_count)
                 for ps in self.level_hulls:
                     writePlaneSet(gf, ps, self.ver)
+                sec['records'] = len(self.level_hulls)
 
-            if self.ver > 20:
-                gf.write(encodeInt(self.moving_hull_group_count, 4))
+        if self.ver > 20:
+            with prof.section('save', 'moving_hulls', gf) as sec:
+                gf.i32(self.moving_hull_group_count)
                 for g in self.moving_hull_groups:
-                    name = encodeString(g['name'])
-                    gf.write(encodeInt(len(name), 4))
-                    gf.write(name)
-                    gf.write(encodeInt(len(g['hulls']), 4))
+                    gf.write_string(g['name'])
+                    gf.i32(len(g['hulls']))
                     for ps in g['hulls']:
                         writePlaneSet(gf, ps, self.ver)
+                sec['records'] = sum(len(g['hulls']) for g in self.moving_hull_groups)
 
+        with prof.section('save', 'trailing', gf) as sec:
             gf.write(self.trailing)
 
         body = gf.getbuffer()
 
         with open(f, 'wb') as out:
-            out.write(encodeString(self.rebm))
-            out.write(encodeInt(self.ver, 4))
-            out.write(encodeInt(self.u1, 4))
-            out.write(encodeInt(self.padding1, 4))
+            with prof.section('save', 'header', out) as sec:
+                hdr = BinaryWriter()
+                hdr.write(self.rebm.encode())
+                hdr.i32(self.ver)
+                hdr.i32(self.u1)
+                hdr.i32(self.padding1)
+
+                if self.ver > 21:
+                    # author block + name2 + gzip marker, then the gzip-compressed body
+                    hdr.write_string(self.author_name)
+                    hdr.i64(self.padding2)
+                out.write(hdr.getbuffer())
 
             if self.ver > 21:
-                # author block + name2 + gzip marker, then the gzip-compressed body
-                author = encodeString(self.author_name)
-                out.write(encodeInt(len(author), 4))
-                out.write(author)
-                out.write(encodeInt(self.padding2, 8))
-                gzipped = BytesIO()
-                with gzip.GzipFile(mode='wb', fileobj=gzipped) as gz:
-                    gz.write(body)
-                out.write(gzipped.getbuffer())
+                with prof.section('save', 'compress', out) as sec:
+                    gzipped = BytesIO()
+                    with gzip.GzipFile(mode='wb', fileobj=gzipped, mtime=getattr(self, 'gzip_mtime', 0)) as gz:
+                        gz.write(body)
+                    out.write(gzipped.getbuffer())
+                    sec['bytes_in'] = len(body)
             else:
                 # version <= 21 stores the body uncompressed with no author block
-                out.write(body)
+                with prof.section('save', 'write', out) as sec:
+                    out.write(body)
+
+    ###################################
+    # DIFF AGAINST ANOTHER MAP FILE   #
+    ###################################
+    # Compact summary of what changed from this map (old) to `other` (new).
+    # Blocks are joined by packed coordinate, entities are matched by name and
+    # position (within `tolerance` units) and hulls by id. Lists of examples
+    # are cut off after `limit` entries.
+    def Diff(self, other, tolerance=0.01, limit=50):
+        hull_ver = max(self.ver, other.ver)
+        return {
+            'header': {
+                'version': [self.ver, other.ver],
+                'author': [getattr(self, 'author_name', None), getattr(other, 'author_name', None)],
+            },
+            'materials': diffNames([m['name'] for m in self.materials], [m['name'] for m in other.materials]),
+            'blocks': diffBlocks(self.blocks, other.blocks, limit),
+            'slices': diffList(self.slices, other.slices),
+            'entities': diffEntities(self.entities, other.entities, tolerance, limit),
+            'audio': diffList(self.audio_raw, other.audio_raw),
+            'navmesh': {'old': len(self.navmesh), 'new': len(other.navmesh), 'changed': bytes(self.navmesh) != bytes(other.navmesh)},
+            'minimap': diffMinimap(self.minimap_layers, other.minimap_layers),
+            'level_hulls': diffHulls(self.level_hulls, other.level_hulls, hull_ver, limit),
+            'moving_hulls': diffHullGroups(self.moving_hull_groups, other.moving_hull_groups, hull_ver, limit),
+        }
 
-    def DrawMinimap(self, name):
-        from PIL import Image, ImageDraw, ImageFilter
+    #########
+    # HULLS #
+    #########
+    # Level hulls followed by the hulls of every moving group, in file order:
+    # (hulls, planes, offsets) with the planes of hull i in
+    # planes[offsets[i]:offsets[i + 1]], for vectorised queries over all of them.
+    def HullPlanes(self):
+        hulls = self.level_hulls + [ps for g in self.moving_hull_groups for ps in g['hulls']]
+        planes, offsets = planeTable(hulls)
+        return hulls, planes, offsets
+
+    ###########
+    # MINIMAP #
+    ###########
+    # Each minimap layer holds the discovered cells of one height level as an
+    # (n, 2) int32 array of x/y. Call UpdateMinimapBounds() after changing them.
+    def UpdateMinimapBounds(self):
+        self.minimap_grid = None
+        points = [ly['points'] for ly in self.minimap_layers if len(ly['points'])]
+        if points:
+            points = np.concatenate(points)
+            lo = points.min(axis=0)
+            hi = points.max(axis=0)
+            self.minimap_bounds = {'minx': int(lo[0]), 'maxx': int(hi[0]), 'miny': int(lo[1]), 'maxy': int(hi[1])}
+        else:
+            self.minimap_bounds = {'minx': 0, 'maxx': 0, 'miny': 0, 'maxy': 0}
 
-        layer_count = len(self.minimap_layers)
+    # Dense per-height bitmaps of all layers, built on first use
+    def MinimapGrid(self):
+        if getattr(self, 'minimap_grid', None) is None:
+            self.minimap_grid = MinimapGrid(self.minimap_layers, self.minimap_bounds)
+        return self.minimap_grid
 
-        if layer_count > 0:
-          colors = getColorArray(layer_count)
+    # heights of all layers that cover cell (x, y)
+    def HeightsAt(self, x, y):
+        return self.MinimapGrid().HeightsAt(x, y)
 
-          factor = 16
-          width = (abs(self.minimap_bounds['minx']) + self.minimap_bounds['maxx'])
-          height = (abs(self.minimap_bounds['miny']) + self.minimap_bounds['maxy'])
+    # number of cells covered by both height levels
+    def LayerOverlap(self, height_a, height_b):
+        return self.MinimapGrid().Overlap(height_a, height_b)
 
-          img = Image.new( mode = "RGB", size = (width, height) )
-          draw = ImageDraw.Draw(img)
+    # The minimap as a PIL image, None if the map has no minimap layers
+    def MinimapImage(self):
+        from PIL import Image, ImageFilter
 
+        layer_count = len(self.minimap_layers)
+        if layer_count == 0:
+            return None
 
-          for i, layer in enumerate(self.minimap_layers):
-              for point in layer['points']:
-                  x = (point['x'] + abs(self.minimap_bounds['minx']))
-                  y = (point['y'] + abs(self.minimap_bounds['miny']))
-                  draw.rectangle((x, y, x, y), fill=colors[i], outline=colors[i])
+        colors = getColorArray(layer_count)
+        grid = self.MinimapGrid()
 
-          img = img.transpose(method=Image.Transpose.FLIP_TOP_BOTTOM)
-          img = img.resize((width*factor, height*factor), resample=0)
-          img = img.filter(ImageFilter.ModeFilter(size=11))
-          img = img.filter(ImageFilter.EDGE_ENHANCE)
+        factor = 16
+        width = grid.width
+        height = grid.height
 
+        # later layers are drawn over earlier ones
+        pixels = np.zeros((height, width, 3), dtype=np.uint8)
+        for i in range(layer_count):
+            pixels[grid.Mask(i)] = tuple(bytes.fromhex(colors[i][1:]))
+
+        img = Image.fromarray(pixels, mode="RGB")
+        img = img.transpose(method=Image.Transpose.FLIP_TOP_BOTTOM)
+        img = img.resize((width*factor, height*factor), resample=0)
+        img = img.filter(ImageFilter.ModeFilter(size=11))
+        img = img.filter(ImageFilter.EDGE_ENHANCE)
+        return img
+
+    def DrawMinimap(self, name):
+        img = self.MinimapImage()
+
+        if img is not None:
           # img.show()
           img.save(name + ".png", "PNG")
         else:
           print("No minimap found in map file")
 
-def encodeInt(data, bytes):
-    return data.to_bytes(bytes, "little", signed=True)
-def encodeFloat(data):
-    return bytearray.fromhex(struct.pack('<f', data).hex())
-def encodeString(data):
-    return data.encode()
-def decodeInt(data):
-    return int.from_bytes(data, "little", signed=True)
-def decodeUInt(data):
-    return int.from_bytes(data, "little", signed=False)
-def decodeFloat(data):
-    return struct.unpack('<f', data)[0]
-def decodeDouble(data):
-    return struct.unpack('<d', data)[0]
-def encodeUInt(data, bytes):
-    return data.to_bytes(bytes, "little", signed=False)
-def encodeDouble(data):
-    return struct.pack('<d', data)
+    ###########
+    # SUMMARY #
+    ###########
+    # A small overview of the map for listings and map pages
+    def Summary(self):
+        entities = {}
+        for e in self.entities:
+            entities[e['name']] = entities.get(e['name'], 0) + 1
+        return {
+            'version':            self.ver,
+            'author':             getattr(self, 'author_name', None),
+            'block_count':        int(self.block_count),
+            'bounds':             self.bounds,
+            'materials':          [mat['name'] for mat in self.materials],
+            'entities':           entities,
+            'level_hull_count':   self.level_hull_count,
+            'moving_hull_groups': [g['name'] for g in self.moving_hull_groups],
+            'minimap_layers':     [ly['height'] for ly in self.minimap_layers],
+            'minimap_bounds':     self.minimap_bounds,
+        }
+
+    ########
+    # JSON #
+    ########
+    # The fields written by --json; arrays derived from other fields
+    # (DERIVED_FIELDS) are left out, so the JSON only has what's in the file
+    def JsonFields(self):
+        fields = {k: v for k, v in self.__dict__.items() if k not in DERIVED_FIELDS}
+        # points as {'x', 'y'} dicts, like before they were kept as arrays
+        fields['minimap_layers'] = [{**ly, 'points': pointsToDicts(ly['points'])} for ly in self.minimap_layers]
+        return fields
+
+# caches and bulk views of other fields
+DERIVED_FIELDS = ('entity_transforms', 'minimap_grid')
+
 def degToRad(degrees):
     return degrees * math.pi / 180
 def radToDeg(radians):
     return radians * 180 / math.pi
 
+# x, y, z, xrot, yrot, zrot (radians on disk, degrees in the entity dicts),
+# xscale, yscale, zscale
+ENTITY_TRANSFORM = struct.Struct('<9f')
+
+# Maps can have hundreds of thousands of entities. Each transform is read with
+# one unpack and all of them end up in one (n, 9) float32 array (rotations in
+# radians, as on disk) next to the entity dicts. Entity names and
+# property names/values repeat a lot (target, team, ...), so every distinct
+# one is decoded once and shared by all entities that use it.
+def readEntities(f, count):
+    strings = {}
+    read_string = f.read_shared_string
+    read_struct = f.read_struct
+    rows = []
+    entities = []
+
+    for _ in range(count):
+        name_len, name = read_string(strings)
+        # unpacked as the exact float32 values, as Python floats
+        row = read_struct(ENTITY_TRANSFORM)
+        rows.append(row)
+        x, y, z, xrot, yrot, zrot, xscale, yscale, zscale = row
+
+        property_count = f.i32()
+        properties = []
+        for _ in range(property_count):
+            pname_len, pname = read_string(strings)
+            val_len, val = read_string(strings)
+            properties.append({'name_len': pname_len, 'name': pname, 'val_len': val_len, 'val': val})
+
+        entities.append({
+            'name_len': name_len,
+            'name':     name,
+            'x':        x,
+            'y':        y,
+            'z':        z,
+            'xrot':     radToDeg(xrot),
+            'yrot':     radToDeg(yrot),
+            'zrot':     radToDeg(zrot),
+            'xscale':   xscale,
+            'yscale':   yscale,
+            'zscale':   zscale,
+            'property_count':   property_count,
+            'properties':       properties,
+        })
+
+    transforms = np.array(rows, dtype=np.float32).reshape(-1, 9)
+    return entities, transforms
+
+FACES = ['front', 'left', 'back', 'right', 'top', 'bottom']
+
+# In-memory layout of a block. It is the on-disk record, except that u3 (1
+# byte before version 25, 6 bytes since) is widened to an int64 so a map can
+# be saved with a different version than it was loaded with.
+BLOCK_DTYPE = np.dtype([
+    ('x',        '<i4'),
+    ('y',        '<i4'),
+    ('z',        '<i4'),
+    ('type',     'i1'),
+    ('u1',       'u1', (12,)),
+    ('mats',     'i1', (6,)),      # material per face, in FACES order
+    ('u2',       'i1'),
+    ('mat_offs', 'i1', (6, 2)),    # x/y per face, like a position on a sprite sheet
+    ('orient',   'i1'),
+    ('u3',       '<i8'),
+    ('u4',       '<i2'),
+])
+
+def blockDiskDtype(ver):
+    fields = [
+        ('x', '<i4'), ('y', '<i4'), ('z', '<i4'), ('type', 'i1'), ('u1', 'u1', (12,)),
+        ('mats', 'i1', (6,)), ('u2', 'i1'), ('mat_offs', 'i1', (6, 2)),
+    ]
+    if ver > 24:
+        return np.dtype(fields + [('u3', 'u1', (6,)), ('orient', 'i1'), ('u4', '<i2')])  # 53 bytes
+    return np.dtype(fields + [('orient', 'i1'), ('u3', 'i1')])                           # 46 bytes
+
+def readBlocks(f, ver, count):
+    disk = blockDiskDtype(ver)
+    raw = f.read_array(disk, count)
+    blocks = np.zeros(count, dtype=BLOCK_DTYPE)
+    for name in disk.names:
+        if name != 'u3':
+            blocks[name] = raw[name]
+    if ver > 24:
+        # sign-extend the 6-byte little-endian field to 8 bytes
+        u3 = np.empty((count, 8), dtype=np.uint8)
+        u3[:, :6] = raw['u3']
+        u3[:, 6:] = np.where(raw['u3'][:, 5:6] & 0x80, 0xFF, 0)
+        blocks['u3'] = u3.view('<i8')[:, 0]
+    else:
+        blocks['u3'] = raw['u3']
+    return blocks
+
+def writeBlocks(gf, blocks, ver):
+    disk = blockDiskDtype(ver)
+    raw = np.zeros(len(blocks), dtype=disk)
+    for name in disk.names:
+        if name != 'u3':
+            raw[name] = blocks[name]
+    if ver > 24:
+        raw['u3'] = blocks['u3'].astype('<i8').view(np.uint8).reshape(-1, 8)[:, :6]
+    else:
+        raw['u3'] = blocks['u3']
+    gf.write(raw.tobytes())
+
+# The nested per-block dicts older versions of this script produced, for JSON.
+def blocksToDicts(blocks):
+    cols = [blocks[name].tolist() for name in BLOCK_DTYPE.names]
+    result = []
+    for x, y, z, block_type, u1, mats, u2, mat_offs, orient, u3, u4 in zip(*cols):
+        result.append({
+            'x':        x,
+            'y':        y,
+            'z':        z,
+            'type':     block_type,
+            'u1':       int.from_bytes(bytes(u1), 'little', signed=True),
+            'mats':     {
+                'front': mats[0], 'left': mats[1], 'back': mats[2],
+                'right': mats[3], 'top': mats[4], 'bottom': mats[5],
+            },
+            'u2':       u2,
+            'mat_offs': {
+                'front': {'x': mat_offs[0][0], 'y': mat_offs[0][1]},
+                'left': {'x': mat_offs[1][0], 'y': mat_offs[1][1]},
+                'back': {'x': mat_offs[2][0], 'y': mat_offs[2][1]},
+                'right': {'x': mat_offs[3][0], 'y': mat_offs[3][1]},
+                'top': {'x': mat_offs[4][0], 'y': mat_offs[4][1]},
+                'bottom': {'x': mat_offs[5][0], 'y': mat_offs[5][1]},
+            },
+            'orient':   orient,
+            'u3':       u3,
+            'u4':       u4,
+        })
+    return result
+
+# Packs x/y/z (each within +-2^20) into a single int64 per block, so blocks can
+# be matched and deduplicated with numpy set operations.
+COORD_BIAS = 1 << 20
+
+def packCoords(blocks):
+    return (((blocks['x'].astype(np.int64) + COORD_BIAS) << 42) |
+            ((blocks['y'].astype(np.int64) + COORD_BIAS) << 21) |
+             (blocks['z'].astype(np.int64) + COORD_BIAS))
+
+def blockBounds(blocks):
+    if not len(blocks):
+        return {'minx': 0, 'maxx': 0, 'miny': 0, 'maxy': 0, 'minz': 0, 'maxz': 0}
+    return {
+        'minx': int(blocks['x'].min()), 'maxx': int(blocks['x'].max()),
+        'miny': int(blocks['y'].min()), 'maxy': int(blocks['y'].max()),
+        'minz': int(blocks['z'].min()), 'maxz': int(blocks['z'].max()),
+    }
+
+# (n, 3) coordinates of every cell in a box, both corners inclusive
+def boxCoords(min_xyz, max_xyz):
+    lo = np.minimum(min_xyz, max_xyz)
+    hi = np.maximum(min_xyz, max_xyz)
+    grid = np.mgrid[lo[0]:hi[0] + 1, lo[1]:hi[1] + 1, lo[2]:hi[2] + 1]
+    return grid.reshape(3, -1).T.astype(np.int32)
+
+def readMinimapPoints(f, count):
+    return f.read_array('<i4', count * 2).reshape(count, 2).astype(np.int32)
+
+def pointsToDicts(points):
+    return [{'x': x, 'y': y} for x, y in np.asarray(points).reshape(-1, 2).tolist()]
+
+POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+# Minimap layers as one packed bitset grid per layer: bits[layer, y, x // 8]
+# covering the minimap bounds, most significant bit first within each byte.
+class MinimapGrid:
+    def __init__(self, layers, bounds):
+        self.minx = bounds['minx']
+        self.miny = bounds['miny']
+        self.width = bounds['maxx'] - bounds['minx'] + 1
+        self.height = bounds['maxy'] - bounds['miny'] + 1
+        self.heights = np.array([ly['height'] for ly in layers], dtype=np.int32)
+
+        # every layer's points are set as bits directly, so no dense bool
+        # grid (8x the size of the bitsets) is ever built
+        self.bits = np.zeros((len(layers), self.height, (self.width + 7) >> 3), dtype=np.uint8)
+        for i, ly in enumerate(layers):
+            points = np.asarray(ly['points']).reshape(-1, 2)
+            cx = points[:, 0] - self.minx
+            np.bitwise_or.at(self.bits[i], (points[:, 1] - self.miny, cx >> 3), (0x80 >> (cx & 7)).astype(np.uint8))
+
+    def Layer(self, height):
+        idx = np.flatnonzero(self.heights == height)
+        if not len(idx):
+            raise KeyError(f"no minimap layer at height {height}")
+        return int(idx[0])
+
+    # boolean (height, width) mask of one layer, by index
+    def Mask(self, layer):
+        return np.unpackbits(self.bits[layer], axis=-1, count=self.width).astype(bool)
+
+    def HeightsAt(self, x, y):
+        cx = x - self.minx
+        cy = y - self.miny
+        if not (0 <= cx < self.width and 0 <= cy < self.height):
+            return []
+        hit = self.bits[:, cy, cx >> 3] & (0x80 >> (cx & 7))
+        return self.heights[hit != 0].tolist()
+
+    def Coverage(self, height):
+        return int(POPCOUNT8[self.bits[self.Layer(height)]].sum())
+
+    def Overlap(self, height_a, height_b):
+        both = self.bits[self.Layer(height_a)] & self.bits[self.Layer(height_b)]
+        return int(POPCOUNT8[both].sum())
+
 # A convex collision hull: levels::PlaneSet. Used by both the level-collision
 # section and the per-moving-entity collision section. On disk it is a fixed
 # 142-byte (138 for version < 23) double-precision header, then the owning
 # entity name, 14 bytes of slide/stairs fields, then plane_count x 32-byte
 # Plane records. A Plane is a half-space stored distance-first, then unit normal.
-def readPlaneSet(f, ver):
-    ps = {
-        'id':            decodeUInt(f.read(4)),
-        'max_radius':    decodeDouble(f.read(8)),
-        'origin':        [decodeDouble(f.read(8)) for _ in range(3)],
-        'origin_orig':   [decodeDouble(f.read(8)) for _ in range(3)],
-        'aabb_min':      [decodeDouble(f.read(8)) for _ in range(3)],
-        'block_pass':    decodeInt(f.read(1)),
-        'block_fire':    decodeInt(f.read(1)),
-        'aabb_extra':    [decodeDouble(f.read(8)) for _ in range(6)],  # aabb_max + rtree extents
-        'clip':          decodeInt(f.read(4)),
-        'collision_mask': decodeUInt(f.read(4)) if ver > 22 else 0,    # added in v23
-    }
-    c = decodeInt(f.read(4))
-    ps['name']       = f.read(c).decode("utf-8")  # owning entity name
-    ps['slide_type'] = decodeInt(f.read(4))
-    ps['is_stairs']  = decodeInt(f.read(1))
-    ps['stairs_yaw'] = decodeDouble(f.read(8))
-    ps['has_target'] = decodeInt(f.read(1))
-    plane_count = decodeInt(f.read(4))
-    ps['planes'] = []
-    for _ in range(plane_count):
-        ps['planes'].append({
-            'distance': decodeDouble(f.read(8)),
-            'normal':   [decodeDouble(f.read(8)) for _ in range(3)],
-        })
-    return ps
+PLANE_DTYPE = np.dtype([
+    ('distance', '<f8'),
+    ('normal',   '<f8', (3,)),
+])
+
+PLANE_SET_TAIL = struct.Struct('<ibdbi')   # slide_type, is_stairs, stairs_yaw, has_target, plane_count
+
+# the fixed header up to and including the length of the name
+@functools.lru_cache(maxsize=None)
+def planeSetHead(ver):
+    return struct.Struct('<Id3d3d3dbb6di' + ('I' if ver > 22 else '') + 'i')
+
+# Reads count hulls. Each header is decoded with one struct call and the planes
+# of all hulls end up in one flat PLANE_DTYPE array; ps['planes'] is a view of
+# that hull's slice of it (see planeTable()).
+def readPlaneSets(f, ver, count):
+    head = planeSetHead(ver)
+    hulls = []
+    chunks = []
+    offsets = [0]
+    for _ in range(count):
+        h = f.read_struct(head)
+        ps = {
+            'id':            h[0],
+            'max_radius':    h[1],
+            'origin':        list(h[2:5]),
+            'origin_orig':   list(h[5:8]),
+            'aabb_min':      list(h[8:11]),
+            'block_pass':    h[11],
+            'block_fire':    h[12],
+            'aabb_extra':    list(h[13:19]),  # aabb_max + rtree extents
+            'clip':          h[19],
+            'collision_mask': h[20] if ver > 22 else 0,    # added in v23
+        }
+        ps['name'] = f.read_text(h[-1])  # owning entity name
+        ps['slide_type'], ps['is_stairs'], ps['stairs_yaw'], ps['has_target'], plane_count = f.read_struct(PLANE_SET_TAIL)
+        chunks.append(f.read_array(PLANE_DTYPE, plane_count))
+        offsets.append(offsets[-1] + plane_count)
+        hulls.append(ps)
+
+    planes = np.concatenate(chunks) if chunks else np.zeros(0, dtype=PLANE_DTYPE)
+    for ps, start, end in zip(hulls, offsets, offsets[1:]):
+        ps['planes'] = planes[start:end]
+    return hulls
+
+# Planes as a PLANE_DTYPE array, also for hulls built by hand with a list of
+# {'distance': d, 'normal': [x, y, z]} dicts.
+def planeArray(planes):
+    if isinstance(planes, np.ndarray):
+        return planes.astype(PLANE_DTYPE, copy=False)
+    return np.array([(pl['distance'], pl['normal']) for pl in planes], dtype=PLANE_DTYPE)
+
+# The planes of many hulls as one flat PLANE_DTYPE array plus offsets, hull i
+# owns planes[offsets[i]:offsets[i + 1]].
+def planeTable(hulls):
+    parts = [planeArray(ps['planes']) for ps in hulls]
+    offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in parts], out=offsets[1:])
+    planes = np.concatenate(parts) if parts else np.zeros(0, dtype=PLANE_DTYPE)
+    return planes, offsets
 
 def writePlaneSet(gf, ps, ver):
-    gf.write(encodeUInt(ps['id'], 4))
-    gf.write(encodeDouble(ps['max_radius']))
-    for v in ps['origin']:      gf.write(encodeDouble(v))
-    for v in ps['origin_orig']: gf.write(encodeDouble(v))
-    for v in ps['aabb_min']:    gf.write(encodeDouble(v))
-    gf.write(encodeInt(ps['block_pass'], 1))
-    gf.write(encodeInt(ps['block_fire'], 1))
-    for v in ps['aabb_extra']:  gf.write(encodeDouble(v))
-    gf.write(encodeInt(ps['clip'], 4))
+    name = ps['name'].encode('utf-8')
+    values = [ps['id'], ps['max_radius'], *ps['origin'], *ps['origin_orig'], *ps['aabb_min'],
+              ps['block_pass'], ps['block_fire'], *ps['aabb_extra'], ps['clip']]
     if ver > 22:
-        gf.write(encodeUInt(ps['collision_mask'], 4))
-    name = encodeString(ps['name'])
-    gf.write(encodeInt(len(name), 4))
+        values.append(ps['collision_mask'])
+    gf.write_struct(planeSetHead(ver), *values, len(name))
     gf.write(name)
-    gf.write(encodeInt(ps['slide_type'], 4))
-    gf.write(encodeInt(ps['is_stairs'], 1))
-    gf.write(encodeDouble(ps['stairs_yaw']))
-    gf.write(encodeInt(ps['has_target'], 1))
-    gf.write(encodeInt(len(ps['planes']), 4))
-    for pl in ps['planes']:
-        gf.write(encodeDouble(pl['distance']))
-        for v in pl['normal']:  gf.write(encodeDouble(v))
+    planes = planeArray(ps['planes'])
+    gf.write_struct(PLANE_SET_TAIL, ps['slide_type'], ps['is_stairs'], ps['stairs_yaw'], ps['has_target'], len(planes))
+    gf.write_array(planes, PLANE_DTYPE)
+
+# The list of plane dicts older versions of this script produced, for JSON.
+def planesToDicts(planes):
+    return [{'distance': d, 'normal': n} for d, n in zip(planes['distance'].tolist(), planes['normal'].tolist())]
+
+#############
+# MAP DIFFS #
+#############
+
+def diffNames(old, new):
+    old_set, new_set = set(old), set(new)
+    return {
+        'old': len(old),
+        'new': len(new),
+        'added': sorted(new_set - old_set),
+        'removed': sorted(old_set - new_set),
+        'reordered': old != new and old_set == new_set,
+    }
+
+def diffList(old, new):
+    changed = sum(1 for a, b in zip(old, new) if a != b) + abs(len(old) - len(new))
+    return {'old': len(old), 'new': len(new), 'changed': changed}
+
+def diffBlocks(old, new, limit):
+    old_keys = packCoords(old)
+    new_keys = packCoords(new)
+    _, i_old, i_new = np.intersect1d(old_keys, new_keys, return_indices=True)
+    kept_old = np.zeros(len(old), dtype=bool)
+    kept_old[i_old] = True
+    kept_new = np.zeros(len(new), dtype=bool)
+    kept_new[i_new] = True
+    removed = old[~kept_old]
+    added = new[~kept_new]
+
+    a = old[i_old]
+    b = new[i_new]
+    face_changed = a['mats'] != b['mats']
+    mats_changed = face_changed.any(axis=1)
+    offs_changed = (a['mat_offs'] != b['mat_offs']).reshape(len(a), -1).any(axis=1)
+    type_changed = a['type'] != b['type']
+    orient_changed = a['orient'] != b['orient']
+    any_changed = mats_changed | offs_changed | type_changed | orient_changed
+
+    return {
+        'old': len(old),
+        'new': len(new),
+        'added': len(added),
+        'removed': len(removed),
+        'changed': int(any_changed.sum()),
+        'materials_changed': int(mats_changed.sum()),
+        'materials_changed_per_face': dict(zip(FACES, face_changed.sum(axis=0).tolist())),
+        'mat_offs_changed': int(offs_changed.sum()),
+        'type_changed': int(type_changed.sum()),
+        'orient_changed': int(orient_changed.sum()),
+        'added_bounds': blockBounds(added) if len(added) else None,
+        'removed_bounds': blockBounds(removed) if len(removed) else None,
+        'changed_bounds': blockBounds(b[any_changed]) if any_changed.any() else None,
+        'added_sample': blockCoords(added[:limit]),
+        'removed_sample': blockCoords(removed[:limit]),
+        'changed_sample': blockCoords(b[any_changed][:limit]),
+    }
+
+def blockCoords(blocks):
+    return np.stack((blocks['x'], blocks['y'], blocks['z']), axis=1).tolist()
+
+# Pairs up entities of the same name. Entities at the same position (within
+# tolerance) are matched first via a quantized position key; whatever is left
+# is paired nearest-first and reported as moved. Nearest-first needs the
+# distances of all leftover pairs of a name, so beyond MATCH_MATRIX_LIMIT of
+# them the leftovers are paired in file order instead.
+MATCH_MATRIX_LIMIT = 1 << 20
+
+def matchEntities(old, new, tolerance):
+    pos_old = np.array([[e['x'], e['y'], e['z']] for e in old], dtype=np.float64).reshape(-1, 3)
+    pos_new = np.array([[e['x'], e['y'], e['z']] for e in new], dtype=np.float64).reshape(-1, 3)
+    q_old = np.round(pos_old / tolerance).astype(np.int64).tolist()
+    q_new = np.round(pos_new / tolerance).astype(np.int64).tolist()
+
+    slots = {}
+    for j, e in enumerate(new):
+        slots.setdefault((e['name'], *q_new[j]), []).append(j)
+
+    pairs = []
+    left_old = {}
+    for i, e in enumerate(old):
+        js = slots.get((e['name'], *q_old[i]))
+        if js:
+            pairs.append((i, js.pop()))
+        else:
+            left_old.setdefault(e['name'], []).append(i)
+
+    left_new = {}
+    for js in slots.values():
+        for j in js:
+            left_new.setdefault(new[j]['name'], []).append(j)
+
+    moved = []
+    for name, ia in left_old.items():
+        ib = left_new.get(name)
+        if not ib:
+            continue
+        if len(ia) * len(ib) > MATCH_MATRIX_LIMIT:
+            n = min(len(ia), len(ib))
+            d = np.linalg.norm(pos_old[ia[:n]] - pos_new[ib[:n]], axis=1)
+            for a, b, dist in zip(ia, ib, d.tolist()):
+                (pairs if dist <= tolerance else moved).append((a, b))
+            continue
+        d = np.linalg.norm(pos_old[ia][:, None, :] - pos_new[ib][None, :, :], axis=2)
+        used_a, used_b = set(), set()
+        for k in np.argsort(d, axis=None).tolist():
+            a, b = divmod(k, len(ib))
+            if a in used_a or b in used_b:
+                continue
+            used_a.add(a)
+            used_b.add(b)
+            (pairs if d[a, b] <= tolerance else moved).append((ia[a], ib[b]))
+            if len(used_a) == len(ia) or len(used_b) == len(ib):
+                break
+
+    return pairs, moved
+
+def diffEntities(old, new, tolerance, limit):
+    pairs, moved = matchEntities(old, new, tolerance)
+    matched_old = {i for i, _ in pairs + moved}
+    matched_new = {j for _, j in pairs + moved}
+
+    transformed = []
+    properties = []
+    for i, j in pairs + moved:
+        a, b = old[i], new[j]
+        if any(abs(a[k] - b[k]) > tolerance for k in ('xrot', 'yrot', 'zrot', 'xscale', 'yscale', 'zscale')):
+            transformed.append((i, j))
+        pa = [(p['name'], p['val']) for p in a['properties']]
+        pb = [(p['name'], p['val']) for p in b['properties']]
+        if sorted(pa) != sorted(pb):
+            da, db = dict(pa), dict(pb)
+            properties.append({
+                'name': b['name'],
+                'position': [b['x'], b['y'], b['z']],
+                'added': {k: v for k, v in db.items() if k not in da},
+                'removed': {k: v for k, v in da.items() if k not in db},
+                'changed': {k: [da[k], db[k]] for k in da.keys() & db.keys() if da[k] != db[k]},
+            })
+
+    added = [new[j]['name'] for j in range(len(new)) if j not in matched_new]
+    removed = [old[i]['name'] for i in range(len(old)) if i not in matched_old]
+
+    return {
+        'old': len(old),
+        'new': len(new),
+        'added': len(added),
+        'removed': len(removed),
+        'moved': len(moved),
+        'rotated_or_scaled': len(transformed),
+        'properties_changed': len(properties),
+        'added_names': countNames(added),
+        'removed_names': countNames(removed),
+        'moved_sample': [
+            {'name': old[i]['name'], 'from': [old[i]['x'], old[i]['y'], old[i]['z']], 'to': [new[j]['x'], new[j]['y'], new[j]['z']]}
+            for i, j in moved[:limit]
+        ],
+        'properties_sample': properties[:limit],
+    }
+
+def countNames(names):
+    counts = {}
+    for n in names:
+        counts[n] = counts.get(n, 0) + 1
+    return dict(sorted(counts.items(), key=lambda kv: -kv[1]))
+
+def diffMinimap(old, new):
+    layers_old = {ly['height']: ly['points'] for ly in old}
+    layers_new = {ly['height']: ly['points'] for ly in new}
+    changed = {}
+    for h in sorted(layers_old.keys() & layers_new.keys()):
+        a = packPoints(layers_old[h])
+        b = packPoints(layers_new[h])
+        added = len(np.setdiff1d(b, a))
+        removed = len(np.setdiff1d(a, b))
+        if added or removed:
+            changed[h] = {'cells_added': added, 'cells_removed': removed}
+    return {
+        'old': len(old),
+        'new': len(new),
+        'added_heights': sorted(layers_new.keys() - layers_old.keys()),
+        'removed_heights': sorted(layers_old.keys() - layers_new.keys()),
+        'changed_heights': changed,
+    }
+
+def packPoints(points):
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    return (points[:, 0] << 32) | (points[:, 1] & 0xFFFFFFFF)
+
+# Hulls are compared in their encoded form, written with the same map version
+# on both sides so a version bump alone doesn't count as a change.
+def planeSetBytes(ps, ver):
+    buf = BinaryWriter()
+    writePlaneSet(buf, ps, ver)
+    return buf.getvalue()
+
+def diffHulls(old, new, ver, limit):
+    enc_old = {ps['id']: planeSetBytes(ps, ver) for ps in old}
+    enc_new = {ps['id']: planeSetBytes(ps, ver) for ps in new}
+    added = sorted(enc_new.keys() - enc_old.keys())
+    removed = sorted(enc_old.keys() - enc_new.keys())
+    regenerated = sorted(i for i in enc_old.keys() & enc_new.keys() if enc_old[i] != enc_new[i])
+    return {
+        'old': len(old),
+        'new': len(new),
+        'added': len(added),
+        'removed': len(removed),
+        'regenerated': len(regenerated),
+        'added_ids': added[:limit],
+        'removed_ids': removed[:limit],
+        'regenerated_ids': regenerated[:limit],
+    }
+
+def diffHullGroups(old, new, ver, limit):
+    groups_old = {g['name']: g['hulls'] for g in old}
+    groups_new = {g['name']: g['hulls'] for g in new}
+    result = diffNames(list(groups_old), list(groups_new))
+    result['groups'] = {}
+    for name in sorted(groups_old.keys() & groups_new.keys()):
+        d = diffHulls(groups_old[name], groups_new[name], ver, limit)
+        if d['added'] or d['removed'] or d['regenerated']:
+            result['groups'][name] = d
+    return result
 
 def getColorArray(size):
     HSV_tuples = [(x * 1.0 / size, 0.5, 0.5) for x in range(size)]
@@ -614,18 +1224,85 @@ def getColorArray(size):
     return hex_out
 
 
+# Per-section profiling for Load()/Save(). Every section records wall time, the
+# bytes it consumed (load) or produced (save) on its stream, how many records it
+# handled and what it allocated according to tracemalloc. Pass an instance as
+# `profiler=` and optionally a `hook` callable that receives each record as soon
+# as the section finishes.
+class SectionProfiler:
+    def __init__(self, source=None, hook=None):
+        self.source = source
+        self.hook = hook
+        self.sections = []
+        self._started_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def section(self, op, name, stream):
+        self.start()
+        rec = {'op': op, 'section': name, 'records': 0}
+        pos = stream.tell()
+        mem_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        yield rec
+        rec['wall_s'] = time.perf_counter() - t0
+        mem_after, mem_peak = tracemalloc.get_traced_memory()
+        rec['bytes'] = stream.tell() - pos
+        rec['alloc_bytes'] = mem_after - mem_before
+        rec['alloc_peak_bytes'] = max(mem_peak - mem_before, 0)
+        self.sections.append(rec)
+        if self.hook is not None:
+            self.hook(rec)
+
+    def report(self):
+        totals = {}
+        for rec in self.sections:
+            t = totals.setdefault(rec['op'], {'wall_s': 0.0, 'bytes': 0, 'records': 0, 'alloc_peak_bytes': 0})
+            t['wall_s'] += rec['wall_s']
+            t['bytes'] += rec['bytes']
+            t['records'] += rec['records']
+            t['alloc_peak_bytes'] = max(t['alloc_peak_bytes'], rec['alloc_peak_bytes'])
+        return {'source': self.source, 'sections': self.sections, 'totals': totals}
+
+class NullProfiler:
+    @contextlib.contextmanager
+    def section(self, op, name, stream):
+        yield {}
+
 class BytesEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, bytes):
+        if isinstance(obj, (bytes, bytearray)):
             return obj.hex()
+        if isinstance(obj, np.ndarray):
+            if obj.dtype == BLOCK_DTYPE:
+                return blocksToDicts(obj)
+            if obj.dtype == PLANE_DTYPE:
+                return planesToDicts(obj)
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if isinstance(obj, MinimapGrid):
+            return None  # derived from minimap_layers
         return json.JSONEncoder.default(self, obj)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='rbe-parser.py', description=".rbe map file parser for Diabotical")
-    parser.add_argument('source', type=argparse.FileType('r'), help="the .rbe map file")
+    parser.add_argument('source', type=source_arg, help="the .rbe map file, or an entry of a .dbp pack as PACK.dbp::maps/NAME.rbe")
     parser.add_argument('--json', action=argparse.BooleanOptionalAction, help="export to JSON in current working directory (CAUTION: the file will be huge)")
     parser.add_argument('--minimap', action=argparse.BooleanOptionalAction, help="create a minimap png in current working directory ")
     parser.add_argument('--test', action=argparse.BooleanOptionalAction, help="Use any official map as a \"template\", delete it's content and write new map")
+    parser.add_argument('--diff', type=source_arg, metavar='NEW_RBE', help="compare with a newer version of the map and write a change summary JSON to current working directory")
+    parser.add_argument('--profile', action=argparse.BooleanOptionalAction, help="write per-section load/save timings and allocations to a .profile.json in current working directory")
 
     if len(sys.argv)==1:
         parser.print_help(sys.stderr)
@@ -633,17 +1310,31 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    prof = SectionProfiler(args.source) if args.profile else None
+
     print("Parsing started ...")
     m = MapObject()
-    m.Load(args.source.name)
+    m.Load(args.source, profiler=prof)
     print("Done parsing")
 
-    fileOut = str(Path(PureWindowsPath(args.source.name)).stem)
+    fileOut = str(Path(PureWindowsPath(args.source)).stem)
 
     if args.json:
         print("\ncreating json ...")
         with open('./' + fileOut + '.json', 'w', encoding='utf-8') as f:
-            json.dump(m.__dict__, f, ensure_ascii=False, indent=4, cls=BytesEncoder)
+            json.dump(m.JsonFields(), f, ensure_ascii=False, indent=4, cls=BytesEncoder)
+
+    if args.diff:
+        print("\ncomparing with " + args.diff + " ...")
+        other = MapObject()
+        other.Load(args.diff)
+        d = m.Diff(other)
+        with open('./' + fileOut + '.diff.json', 'w', encoding='utf-8') as f:
+            json.dump(d, f, ensure_ascii=False, indent=4, cls=BytesEncoder)
+        b, e = d['blocks'], d['entities']
+        print(f"blocks: +{b['added']} -{b['removed']} ~{b['changed']}, "
+              f"entities: +{e['added']} -{e['removed']} moved {e['moved']} properties {e['properties_changed']}, "
+              f"level hulls regenerated: {d['level_hulls']['regenerated']}")
 
     if args.minimap:
         print("\ncreating minimap ...")
@@ -653,6 +1344,12 @@ if __name__ == '__main__':
         print("\ncreating test map ...")
         m.EmptyMap()
         m.AddBlock(10, 20, 30)
-        m.Save('wo_ws_test.rbe')
+        m.Save('wo_ws_test.rbe', profiler=prof)
+
+    if args.profile:
+        prof.stop()
+        print("\nwriting profile ...")
+        with open('./' + fileOut + '.profile.json', 'w', encoding='utf-8') as f:
+            json.dump(prof.report(), f, indent=4)
 
     print("DONE")
\ No newline at end of file
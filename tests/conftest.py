@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the tools are scripts in the repository root, loaded with dbtools.load_script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
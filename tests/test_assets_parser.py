@@ -0,0 +1,32 @@
+import pytest
+
+from dbtools import load_script
+
+assets_parser = load_script('assets-parser')
+
+def evaluate(text, contexts):
+    columns, n = assets_parser.context_columns(contexts)
+    return assets_parser.compile_condition(text).evaluate(columns, n).tolist()
+
+def test_negative_number_literal():
+    contexts = [{'offset_y': -1}, {'offset_y': 0}, {'offset_y': 1}]
+    assert evaluate('offset_y == -1', contexts) == [True, False, False]
+    assert evaluate('offset_y > -.5', contexts) == [False, True, True]
+    assert evaluate('offset_y>-1', contexts) == [False, True, True]
+
+def test_number_against_word_is_false():
+    contexts = [{'offset_y': -1}, {'offset_y': 0}]
+    for op in ('==', '!=', '<', '>='):
+        assert evaluate(f'offset_y {op} empty', contexts) == [False, False]
+    assert evaluate('!(offset_y == empty)', contexts) == [True, True]
+
+def test_invalid_condition_still_fails():
+    with pytest.raises(ValueError):
+        assets_parser.compile_condition('offset_y == $')
+
+def test_parse_negative_condition_without_warning(tmp_path, capsys):
+    path = tmp_path / 'a.assets'
+    path.write_text('asset a\n{\ndynamic_rule\n{\nif offset_y == -1\n}\n}\n')
+    assets = assets_parser.parse_assets(str(path))
+    assert assets[0]['dynamic_rules'][0]['conditions'] == ['offset_y == -1']
+    assert 'WARNING' not in capsys.readouterr().out
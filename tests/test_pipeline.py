@@ -0,0 +1,37 @@
+from dbtools import load_script
+
+pipeline = load_script('pipeline')
+dbp_packer = load_script('dbp-packer')
+
+GOOD_ASSETS = b'asset a\n{\nk v\n}\n'
+BROKEN_ASSETS = b'asset b\n{\nk v\n}\n}\nasset c\n{\n}\n'
+
+def write_pack(path, entries):
+    dbp_packer.DBPWriter.write_entries(sorted(entries), open(path, 'wb'))
+
+def run(tmp_path):
+    state = pipeline.State(tmp_path / 'state.sqlite')
+    tasks = pipeline.build_graph(state, tmp_path / 'packs', tmp_path / 'unpacked', tmp_path / 'out', jobs=1)
+    result = pipeline.run_graph(tasks, state, jobs=1)
+    state.close()
+    return result
+
+def test_broken_asset_fails_only_its_task(tmp_path, capsys, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'packs').mkdir()
+    write_pack(tmp_path / 'packs' / 'p1.dbp', [('assets\\a.assets', GOOD_ASSETS)])
+    write_pack(tmp_path / 'packs' / 'p2.dbp', [('assets\\b.assets', BROKEN_ASSETS)])
+
+    ran, skipped, failed = run(tmp_path)
+    out = capsys.readouterr().out
+    assert failed == ['assets']
+    assert sorted(ran) == ['unpack:p1.dbp', 'unpack:p2.dbp']
+    assert "ERROR: assets:" in out
+    assert "couldn't match closing bracket" in out
+
+    # the failed task runs again once the asset is fixed
+    write_pack(tmp_path / 'packs' / 'p2.dbp', [('assets\\b.assets', GOOD_ASSETS)])
+    ran, skipped, failed = run(tmp_path)
+    assert failed == []
+    assert sorted(ran) == ['assets', 'unpack:p2.dbp']
+    assert skipped == ['unpack:p1.dbp']
@@ -0,0 +1,28 @@
+import tracemalloc
+
+from dbtools import load_script
+
+rbe_parser = load_script('rbe-parser')
+
+def entity(name, x, y=0, z=0):
+    return {'name': name, 'x': x, 'y': y, 'z': z}
+
+def test_match_entities_nearest_first():
+    old = [entity('light', 0), entity('light', 10)]
+    new = [entity('light', 11), entity('light', 1), entity('light', 10.0001)]
+    pairs, moved = rbe_parser.matchEntities(old, new, 0.01)
+    assert pairs == [(1, 2)]
+    assert moved == [(0, 1)]
+
+def test_match_entities_many_moved_pairs_in_order():
+    n = 3000
+    old = [entity('spawn', i) for i in range(n)]
+    new = [entity('spawn', i + 0.5) for i in range(n)]
+    tracemalloc.start()
+    pairs, moved = rbe_parser.matchEntities(old, new, 0.01)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert pairs == []
+    assert moved == [(i, i) for i in range(n)]
+    # an n x n distance matrix alone would be 72MB
+    assert peak < 16 << 20
@@ -1,5 +1,5 @@
 #!/bin/bash
 
-for filename in _packs/*.dbp; do
-  ./dbp-packer.py unpack "$filename" _unpacked
-done
\ No newline at end of file
+# Unpacks every .dbp file in _packs to _unpacked. Only entries that are missing
+# or changed since the last run are written, see pipeline.md.
+exec ./pipeline.py run --only unpack "$@"